@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Throughput of BulkMessageGenerator with 1, 2, 4, ... worker processes, up
+to the number of cores, rendering reminder documents to a scratch file.
+
+    python bench_bulk_messages.py [recipients] [chunk_size]
+"""
+
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')] + sys.path
+from ciscotropowebapi import BulkMessageGenerator
+
+
+def recipients(count):
+    for i in range(count):
+        yield {'to': '+1415%07d' % i, 'name': 'Customer %d' % i, 'time': '%d:%02d' % (9 + i % 8, i % 60)}
+
+
+def main(count=200000, chunk_size=2000):
+    cores = multiprocessing.cpu_count()
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= cores:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != cores:
+        worker_counts.append(cores)
+    fd, path = tempfile.mkstemp(suffix='.ndjson')
+    os.close(fd)
+    try:
+        print("%d recipients, chunks of %d, %d cores" % (count, chunk_size, cores))
+        print("%8s %10s %12s %8s" % ("workers", "seconds", "docs/sec", "speedup"))
+        baseline = None
+        for workers in worker_counts:
+            generator = BulkMessageGenerator("Hi %(name)s, this is a reminder of your appointment at %(time)s.",
+                                             workers=workers, chunk_size=chunk_size,
+                                             channel='TEXT', network='SMS')
+            start = time.time()
+            written = generator.generate(recipients(count), path)
+            elapsed = time.time() - start
+            if baseline is None:
+                baseline = elapsed
+            print("%8d %10.2f %12d %7.2fx" % (workers, elapsed, written / elapsed, baseline / elapsed))
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
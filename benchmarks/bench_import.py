@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Cold-start report for ciscotropowebapi: runs "import ciscotropowebapi" in
+fresh interpreters under python -X importtime (Python 3.7 or later) and
+prints the median cumulative import time, plus the slowest modules it
+pulled in.
+
+    python bench_import.py [runs] [max_usec]
+
+With max_usec, exits with status 1 if the median is above it, so the
+number can be tracked as a regression check.
+"""
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+def import_times(statement="import ciscotropowebapi"):
+    """
+    Run statement in a new interpreter and return {module: (self, cumulative)}
+    in microseconds, from -X importtime.
+    """
+    env = dict(os.environ)
+    # a deployed app has its .pyc files; don't time the compiler
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    process = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', statement],
+                               cwd=ROOT, env=env, stderr=subprocess.PIPE)
+    output = process.communicate()[1].decode('utf-8')
+    if process.returncode:
+        raise RuntimeError(output)
+    times = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        own, cumulative, name = line[len('import time:'):].split('|')
+        times[name.strip()] = (int(own), int(cumulative))
+    return times
+
+
+def main(runs=20, max_usec=None):
+    if sys.version_info < (3, 7):
+        sys.exit("-X importtime needs Python 3.7 or later")
+    import_times()
+    samples = []
+    slowest = {}
+    for i in range(runs):
+        times = import_times()
+        samples.append(times['ciscotropowebapi'][1])
+        for name, (own, cumulative) in times.items():
+            slowest[name] = slowest.get(name, 0) + cumulative
+    samples.sort()
+    median = samples[len(samples) // 2]
+    print("ciscotropowebapi import: median %d usec, min %d, max %d over %d runs"
+          % (median, samples[0], samples[-1], runs))
+    print("%-30s %12s" % ("module", "usec (mean)"))
+    ranked = sorted(slowest.items(), key=lambda item: item[1], reverse=True)
+    for name, total in ranked[:10]:
+        print("%-30s %12d" % (name, total // runs))
+    if max_usec is not None and median > max_usec:
+        print("FAIL: median import time %d usec is over %d" % (median, max_usec))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    args = [int(arg) for arg in sys.argv[1:3]]
+    sys.exit(main(*args))
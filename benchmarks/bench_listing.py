@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""
+Compares the SAX ListBucketHandler with the incremental ListBucketParser on
+generated bucket listings.
+
+    python bench_listing.py [key count ...]
+
+Each listing is parsed whole, fed to ListBucketParser in 16KB chunks the
+way it would arrive from a socket, and parsed into a columnar ListingTable.
+"""
+
+import os
+import sys
+import time
+import xml.sax
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples')] + sys.path
+import GoogleS3
+
+CHUNK_SIZE = 16 * 1024
+
+
+def make_listing(count):
+    contents = []
+    for i in range(count):
+        contents.append(
+            "<Contents><Key>recordings/2010/01/01/call-%08d.wav</Key>"
+            "<LastModified>2010-01-01T00:00:00.000Z</LastModified>"
+            "<ETag>&quot;828ef3fdfa96f00ad9f27c383fc9ac7f&quot;</ETag><Size>%d</Size>"
+            "<Owner><ID>bcaf1ffd86f41161ca5fb16fd081034f</ID><DisplayName>webfile</DisplayName></Owner>"
+            "<StorageClass>STANDARD</StorageClass></Contents>" % (i, 5120 + i))
+    return ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            '<Name>recordings</Name><Prefix></Prefix><Marker></Marker>'
+            '<MaxKeys>%d</MaxKeys><IsTruncated>false</IsTruncated>%s</ListBucketResult>'
+            % (count, "".join(contents))).encode('utf-8')
+
+
+def parse_sax(body):
+    handler = GoogleS3.ListBucketHandler()
+    xml.sax.parseString(body, handler)
+    return handler.entries
+
+
+def parse_expat(body):
+    parser = GoogleS3.ListBucketParser()
+    parser.feed(body)
+    parser.close()
+    return parser.entries
+
+
+def parse_expat_chunked(body):
+    parser = GoogleS3.ListBucketParser()
+    for i in range(0, len(body), CHUNK_SIZE):
+        parser.feed(body[i:i + CHUNK_SIZE])
+    parser.close()
+    return parser.entries
+
+
+def parse_expat_table(body):
+    table = GoogleS3.ListingTable()
+    parser = GoogleS3.ListBucketParser(table)
+    parser.feed(body)
+    parser.close()
+    return table
+
+
+def best_of(func, body, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        entries = func(body)
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, len(entries)
+
+
+def main(counts):
+    print("%10s %-22s %10s %12s" % ("keys", "parser", "seconds", "keys/sec"))
+    for count in counts:
+        body = make_listing(count)
+        repeat = count <= 10000 and 5 or 1
+        baseline = None
+        for label, func in (("ListBucketHandler", parse_sax),
+                            ("ListBucketParser", parse_expat),
+                            ("ListBucketParser/16K", parse_expat_chunked),
+                            ("ListBucketParser/table", parse_expat_table)):
+            elapsed, parsed = best_of(func, body, repeat)
+            assert parsed == count
+            if baseline is None:
+                baseline = elapsed
+            print("%10d %-22s %10.4f %12d  x%.2f" % (count, label, elapsed, count / elapsed, baseline / elapsed))
+
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [1000, 100000])
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Size and latency report for Tropo document rendering: default RenderJson,
+compact RenderJson, and RenderResponse with gzip, on a few typical
+documents.
+
+    python bench_render.py
+"""
+
+import os
+import sys
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')] + sys.path
+from ciscotropowebapi import Tropo
+
+
+def greeting():
+    tropo = Tropo()
+    tropo.say("Welcome to Acme.")
+    tropo.on(event="continue", next="/menu.json")
+    return tropo
+
+
+def ivr_menu():
+    tropo = Tropo()
+    tropo.say("Welcome to Acme.")
+    tropo.say("Calls may be recorded for quality purposes.")
+    tropo.startRecording("http://example.com/receive_recording.py")
+    tropo.on(event="error", next="/error.json", say="An error occurred.")
+    tropo.ask("[1 DIGIT]", say="For sales press 1, for support press 2.",
+              attempts=3, bargein=True, name="menu", timeout=5)
+    tropo.on(event="continue", next="/menu.json?uri=choice")
+    return tropo
+
+
+def long_prompt():
+    tropo = Tropo()
+    tropo.say(["http://example.com/prompts/%04d.wav" % i for i in range(200)], name=None)
+    tropo.hangup()
+    return tropo
+
+
+def say_run():
+    tropo = Tropo()
+    for i in range(50):
+        tropo.say("Your balance on account %d is %d dollars." % (i, i * 17))
+    tropo.hangup()
+    return tropo
+
+
+def per_call(func, repeat):
+    start = time.time()
+    for i in range(repeat):
+        result = func()
+    return (time.time() - start) / repeat * 1e6, result
+
+
+def main(repeat=2000):
+    print("%-12s %-10s %8s %8s %10s" % ("document", "rendering", "bytes", "saved", "usec/call"))
+    for name, build in (("greeting", greeting), ("ivr_menu", ivr_menu),
+                        ("long_prompt", long_prompt), ("say_run", say_run)):
+        tropo = build()
+        usec, json = per_call(tropo.RenderJson, repeat)
+        baseline = len(json.encode('utf-8'))
+        rows = [("default", usec, baseline)]
+        usec, json = per_call(lambda: tropo.RenderJson(compact=True), repeat)
+        rows.append(("compact", usec, len(json.encode('utf-8'))))
+        usec, response = per_call(lambda: tropo.RenderResponse(accept_encoding="gzip"), repeat)
+        rows.append(("gzip", usec, len(response[0])))
+        for label, usec, size in rows:
+            print("%-12s %-10s %8d %8d %10.1f" % (name, label, size, baseline - size, usec))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""
+Loading stored Result bodies for analytics: one Result object per body
+(getValue) against ResultBatch columns, with NumPy if it is installed.
+
+    python bench_results.py [count]
+"""
+
+import os
+import random
+import sys
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')] + sys.path
+import ciscotropowebapi
+from ciscotropowebapi import Result, ResultBatch
+
+
+def make_results(count, seed=1):
+    rnd = random.Random(seed)
+    results = []
+    for i in range(count):
+        disposition = rnd.random() < 0.85 and "SUCCESS" or "NOMATCH"
+        results.append(ciscotropowebapi.jsonlib.dumps({"result": {
+            "sessionId": "%032x" % i, "sequence": 1, "complete": True, "state": "ANSWERED",
+            "actions": {"name": "zip", "attempts": rnd.randint(1, 3), "disposition": disposition,
+                        "confidence": rnd.randint(10, 100), "interpretation": "%05d" % rnd.randint(0, 99999)}}}))
+    return results
+
+
+def main(count=100000):
+    logging = ciscotropowebapi.logging
+    logging.getLogger().setLevel(logging.WARNING)
+    results = make_results(count)
+
+    start = time.time()
+    values = [Result(body).getValue() for body in results]
+    print("%-28s %8.3f s" % ("Result().getValue()", time.time() - start))
+
+    for label, use_numpy in (("ResultBatch (array)", False), ("ResultBatch (numpy)", True)):
+        try:
+            start = time.time()
+            batch = ResultBatch.load(results, use_numpy=use_numpy)
+            loaded = time.time() - start
+        except ImportError:
+            print("%-28s %8s" % (label, "n/a"))
+            continue
+        start = time.time()
+        stats = batch.confidence_stats(name="zip")
+        counts = batch.disposition_counts()
+        print("%-28s %8.3f s load, %6.3f s stats" % (label, loaded, time.time() - start))
+    print("%d results, mean confidence %.1f, %r" % (len(values), stats['mean'], counts))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""
+End-to-end GoogleS3 benchmark against the in-process LocalS3 server: no
+network, no AWS account.
+
+    python bench_s3_local.py [recording count] [recording size in KB]
+
+Times uploading recordings one at a time and with put_many, walking the
+bucket with iter_bucket and list_bucket_table, and signing playback URLs
+one at a time and with generate_urls.
+"""
+
+import os
+import sys
+import time
+
+sys.path = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples')] + sys.path
+import GoogleS3
+import LocalS3
+
+BUCKET = 'recordings'
+
+
+def timed(label, count, func):
+    start = time.time()
+    result = func()
+    elapsed = time.time() - start
+    print("%-32s %8d %10.3f %12.0f/sec" % (label, count, elapsed, count / elapsed))
+    return result
+
+
+def main(count, size_kb):
+    server = LocalS3.LocalS3Server()
+    server.start()
+    try:
+        conn = server.connection()
+        conn.create_bucket(BUCKET)
+        wav = b"\0" * (size_kb * 1024)
+        keys = ["calls/2010/01/01/call-%08d.wav" % i for i in range(count)]
+        headers = {'Content-Type': 'audio/wav'}
+
+        print("%-32s %8s %10s %16s" % ("operation", "count", "seconds", "rate"))
+        half = count // 2
+        timed("put (serial)", half,
+              lambda: [conn.put(BUCKET, key, wav, headers) for key in keys[:half]])
+        timed("put_many (8 threads)", count - half,
+              lambda: conn.put_many(BUCKET, [(key, wav) for key in keys[half:]], headers))
+
+        timed("iter_bucket", count,
+              lambda: sum(1 for entry in conn.iter_bucket(BUCKET, prefix='calls/')))
+        timed("list_bucket_table", count,
+              lambda: len(conn.list_bucket_table(BUCKET, prefix='calls/')))
+
+        generator = GoogleS3.QueryStringAuthGenerator('local', 'local', is_secure=False,
+                server=server.host, port=server.port, calling_format=GoogleS3.CallingFormat.PATH)
+        generator.set_expires_in(3600)
+        timed("generate_url (one by one)", count,
+              lambda: [generator.get(BUCKET, key) for key in keys])
+        timed("generate_urls (bulk)", count,
+              lambda: generator.generate_urls('GET', BUCKET, keys))
+        print("connections opened: %d, requests served: %d" % (server.connections, server.requests))
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    count = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+    size_kb = len(sys.argv) > 2 and int(sys.argv[2]) or 16
+    main(count, size_kb)
@@ -31,22 +31,139 @@ NOTE: This module requires python 2.5 or higher.
 
 """
 
+import importlib
+
+import io
+
+import os
+
+import sys
+
+import time
+
 try:
-    import cjson as jsonlib
-    jsonlib.dumps = jsonlib.encode
-    jsonlib.loads = jsonlib.decode
+    from thread import allocate_lock
 except ImportError:
-    try:
-        from django.utils import simplejson as jsonlib
-    except ImportError:
+    from _thread import allocate_lock
+
+
+class _LazyModule(object):
+    """
+    Stands in for a module until one of its attributes is first used, then
+    imports it with loader() and replaces itself in this module's globals,
+    so only the first use goes through the proxy.
+    """
+    def __init__(self, name, loader):
+        self._name = name
+        self._loader = loader
+        self._module = None
+
+    def __getattr__(self, attribute):
+        module = self._module
+        if module is None:
+            module = self._module = self._loader()
+            globals()[self._name] = module
+        return getattr(module, attribute)
+
+
+def _import_cjson():
+    import cjson
+    cjson.dumps = cjson.encode
+    cjson.loads = cjson.decode
+    return cjson
+
+def _import_django_json():
+    from django.utils import simplejson
+    return simplejson
+
+def _import_simplejson():
+    import simplejson
+    return simplejson
+
+def _import_json():
+    import json
+    return json
+
+_JSON_BACKENDS = {
+    'cjson': _import_cjson,
+    'django': _import_django_json,
+    'simplejson': _import_simplejson,
+    'json': _import_json,
+}
+
+# tried in this order the first time JSON is needed; 'django' is only used
+# when asked for with use_json_backend()
+_JSON_BACKEND_ORDER = ('cjson', 'simplejson', 'json')
+
+def _load_json():
+    for name in _JSON_BACKEND_ORDER:
         try:
-            import simplejson as jsonlib
+            return _JSON_BACKENDS[name]()
         except ImportError:
-            import json as jsonlib
+            pass
+    raise ImportError("no JSON library available")
 
-import logging
+def use_json_backend(name):
+    """
+    Use the named JSON library ('cjson', 'django', 'simplejson' or 'json')
+    instead of the first one found.  Raises ImportError if it isn't
+    installed.
+    """
+    global jsonlib, _compact_encode
+    if name not in _JSON_BACKENDS:
+        raise ValueError("unknown JSON backend %r" % name)
+    jsonlib = _JSON_BACKENDS[name]()
+    _compact_encode = None
+    return jsonlib
+
+def _import_logging():
+    import logging
+    return logging
+
+def _import_threading():
+    import threading
+    return threading
+
+def _import_pickle():
+    try:
+        import cPickle as pickle
+    except ImportError:
+        import pickle
+    return pickle
 
-import keyword
+def _import_queue():
+    try:
+        import Queue as queue
+    except ImportError:
+        import queue
+    return queue
+
+# resolved on first use, so importing this module doesn't pay for them
+jsonlib = _LazyModule('jsonlib', _load_json)
+logging = _LazyModule('logging', _import_logging)
+pickle = _LazyModule('pickle', _import_pickle)
+queue = _LazyModule('queue', _import_queue)
+threading = _LazyModule('threading', _import_threading)
+
+try:
+    _string_types = (basestring,)
+except NameError:
+    _string_types = (str,)
+
+# keyword.kwlist for the running Python, as a set.  Session attributes with
+# these names get a trailing underscore ("from" becomes "from_").
+if sys.version_info[0] < 3:
+    _KEYWORDS = frozenset((
+        'and', 'as', 'assert', 'break', 'class', 'continue', 'def', 'del', 'elif',
+        'else', 'except', 'exec', 'finally', 'for', 'from', 'global', 'if', 'import',
+        'in', 'is', 'lambda', 'not', 'or', 'pass', 'print', 'raise', 'return', 'try',
+        'while', 'with', 'yield'))
+else:
+    _KEYWORDS = frozenset((
+        'False', 'None', 'True', 'and', 'as', 'assert', 'async', 'await', 'break',
+        'class', 'continue', 'def', 'del', 'elif', 'else', 'except', 'finally', 'for',
+        'from', 'global', 'if', 'import', 'in', 'is', 'lambda', 'nonlocal', 'not', 'or',
+        'pass', 'raise', 'return', 'try', 'while', 'with', 'yield'))
 
 
 class TropoAction(object):
@@ -483,23 +600,1336 @@ class Result(object):
         return dict['interpretation']
 
 
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+_numpy = None
+
+def _get_numpy():
+    global _numpy
+    if _numpy is None:
+        _numpy = _import_numpy() or False
+    return _numpy or None
+
+NaN = float('nan')
+
+
+class ResultBatch(object):
+    """
+    Many Result payloads loaded into columns, one row per action, for
+    analytics over stored webhooks.
+
+        batch = ResultBatch.load_ndjson("results-2010-01-01.ndjson")
+        batch.confidence_stats(name="zip")
+        batch.disposition_counts()
+
+    Numeric columns (confidence, duration, attempts, sequence) are kept in
+    arrays, NaN or 0 where an action didn't have the field, and text
+    columns (session_id, name, disposition, interpretation, utterance) in
+    lists.  column() returns numeric columns as NumPy arrays sharing the
+    same memory when NumPy is installed (or use_numpy=True), and as
+    array.array otherwise.  The statistics methods use NumPy when it's
+    available too.
+    """
+    __slots__ = ('session_id', 'sequence', 'name', 'disposition', 'interpretation',
+                 'utterance', 'confidence', 'duration', 'attempts', 'results', 'use_numpy')
+
+    text_columns = ('session_id', 'name', 'disposition', 'interpretation', 'utterance')
+    numeric_columns = ('confidence', 'duration', 'attempts', 'sequence')
+
+    def __init__(self, use_numpy=None):
+        self.session_id = []
+        self.name = []
+        self.disposition = []
+        self.interpretation = []
+        self.utterance = []
+        # array pulls in collections.abc, so it isn't imported until needed
+        from array import array
+        self.sequence = array('l')
+        self.confidence = array('d')
+        self.duration = array('d')
+        self.attempts = array('l')
+        self.results = 0
+        if use_numpy is None:
+            use_numpy = _get_numpy() is not None
+        elif use_numpy and _get_numpy() is None:
+            raise ImportError("NumPy is not installed")
+        self.use_numpy = use_numpy
+
+    @classmethod
+    def load(cls, results, use_numpy=None):
+        """
+        Build a batch from an iterable of Result bodies: JSON strings (blank
+        lines are skipped) or already decoded dicts.
+        """
+        batch = cls(use_numpy)
+        batch.extend(results)
+        return batch
+
+    @classmethod
+    def load_ndjson(cls, path, use_numpy=None):
+        """
+        Build a batch from a file with one Result body per line.
+        """
+        with open(path) as f:
+            return cls.load(f, use_numpy)
+
+    def __len__(self):
+        return len(self.name)
+
+    def extend(self, results):
+        loads = jsonlib.loads
+        append = self.append
+        for result in results:
+            if not isinstance(result, dict):
+                if not result.strip():
+                    continue
+                result = loads(result)
+            append(result)
+
+    def append(self, result_data):
+        """
+        Add one decoded Result body.
+        """
+        result = result_data['result']
+        actions = result.get('actions')
+        if actions is None:
+            actions = []
+        elif not isinstance(actions, list):
+            actions = [actions]
+        session_id = result.get('sessionId')
+        sequence = result.get('sequence') or 0
+        for action in actions:
+            self.session_id.append(session_id)
+            self.sequence.append(sequence)
+            self.name.append(action.get('name'))
+            self.disposition.append(action.get('disposition'))
+            self.interpretation.append(action.get('interpretation'))
+            self.utterance.append(action.get('utterance'))
+            confidence = action.get('confidence')
+            if confidence is None:
+                confidence = NaN
+            self.confidence.append(float(confidence))
+            duration = action.get('duration')
+            if duration is None:
+                duration = NaN
+            self.duration.append(float(duration))
+            self.attempts.append(action.get('attempts') or 0)
+        self.results += 1
+
+    def column(self, name):
+        """
+        Return a column by name: a list for text columns, a NumPy array or
+        array.array for numeric ones.
+        """
+        if name in self.text_columns:
+            return getattr(self, name)
+        if name not in self.numeric_columns:
+            raise KeyError(name)
+        values = getattr(self, name)
+        if self.use_numpy:
+            numpy = _get_numpy()
+            dtype = values.typecode == 'd' and numpy.float64 or numpy.dtype('l')
+            if not values:
+                return numpy.zeros(0, dtype)
+            return numpy.frombuffer(values, dtype=dtype)
+        return values
+
+    def indexes(self, name=None, disposition=None):
+        """
+        Return the row numbers of the actions with this name and disposition.
+        Criteria left as None are not applied.
+        """
+        rows = range(len(self.name))
+        if name is not None:
+            names = self.name
+            rows = [i for i in rows if names[i] == name]
+        if disposition is not None:
+            dispositions = self.disposition
+            rows = [i for i in rows if dispositions[i] == disposition]
+        return list(rows)
+
+    def take(self, indexes):
+        batch = ResultBatch(self.use_numpy)
+        for column in self.text_columns:
+            values = getattr(self, column)
+            setattr(batch, column, [values[i] for i in indexes])
+        for column in self.numeric_columns:
+            values = getattr(self, column)
+            setattr(batch, column, type(values)(values.typecode, [values[i] for i in indexes]))
+        batch.results = len(set(zip(batch.session_id, batch.sequence)))
+        return batch
+
+    def select(self, name=None, disposition=None):
+        return self.take(self.indexes(name, disposition))
+
+    def disposition_counts(self, name=None):
+        """
+        Return {disposition: number of actions}, for actions called name if
+        given.
+        """
+        counts = {}
+        dispositions = self.disposition
+        rows = name is None and range(len(dispositions)) or self.indexes(name)
+        for i in rows:
+            disposition = dispositions[i]
+            counts[disposition] = counts.get(disposition, 0) + 1
+        return counts
+
+    def confidence_stats(self, name=None, disposition=None):
+        """
+        Return a dict of the count, mean, min, median and p10 (10th
+        percentile) of the recognition confidence, over actions that
+        reported one.
+        """
+        return self._stats('confidence', name, disposition)
+
+    def duration_stats(self, name=None, disposition=None):
+        return self._stats('duration', name, disposition)
+
+    def _stats(self, column, name, disposition):
+        values = self.column(column)
+        filtered = name is not None or disposition is not None
+        if self.use_numpy:
+            numpy = _get_numpy()
+            if filtered:
+                values = values[numpy.array(self.indexes(name, disposition), dtype=numpy.intp)]
+            values = numpy.sort(values[~numpy.isnan(values)])
+            mean = len(values) and float(values.mean())
+        else:
+            if filtered:
+                values = [values[i] for i in self.indexes(name, disposition)]
+            values = sorted(v for v in values if v == v)
+            mean = len(values) and sum(values) / len(values)
+        count = len(values)
+        if not count:
+            return {'count': 0, 'mean': NaN, 'min': NaN, 'median': NaN, 'p10': NaN}
+        middle = count // 2
+        if count % 2:
+            median = float(values[middle])
+        else:
+            median = (float(values[middle - 1]) + float(values[middle])) / 2
+        return {'count': count, 'mean': mean, 'min': float(values[0]),
+                'median': median, 'p10': float(values[int(0.1 * count)])}
+
+
+class Endpoint(object):
+    """
+    The "from" or "to" of a Session.
+
+        { "id": String,
+          "name": String,
+          "channel": String,
+          "network": String }
+
+    Fields can also be read as endpoint['id'] or endpoint.get('id'), the
+    way the raw dict was.
+    """
+    __slots__ = ('id', 'name', 'channel', 'network')
+
+    def __init__(self, id=None, name=None, channel=None, network=None):
+        self.id = id
+        self.name = name
+        self.channel = channel
+        self.network = network
+
+    @classmethod
+    def from_dict(cls, data):
+        if data is None:
+            return None
+        return cls(data.get('id'), data.get('name'), data.get('channel'), data.get('network'))
+
+    def __getitem__(self, key):
+        if key not in self.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        if key not in self.__slots__:
+            return default
+        return getattr(self, key)
+
+    def __eq__(self, other):
+        if not isinstance(other, Endpoint):
+            return NotImplemented
+        return (self.id, self.name, self.channel, self.network) == \
+            (other.id, other.name, other.channel, other.network)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "Endpoint(id=%r, name=%r, channel=%r, network=%r)" % (
+            self.id, self.name, self.channel, self.network)
+
+
+class NameAddr(object):
+    """
+    One address from a SIP header such as Diversion or P-Asserted-Identity:
+
+        "Alice" <sip:+14155550100@sbc.example.com>;reason=unconditional;counter=1
+
+    gives display_name 'Alice', uri 'sip:+14155550100@sbc.example.com' and
+    params {'reason': 'unconditional', 'counter': '1'}.  Parameter names
+    are lower case; a parameter without a value maps to None.
+    """
+    __slots__ = ('display_name', 'uri', 'params')
+
+    def __init__(self, display_name, uri, params=None):
+        self.display_name = display_name
+        self.uri = uri
+        self.params = params or {}
+
+    @classmethod
+    def parse(cls, text):
+        text = text.strip()
+        display_name = None
+        if '<' in text:
+            start = text.index('<')
+            end = text.find('>', start)
+            if end < 0:
+                end = len(text)
+            display_name = text[:start].strip().strip('"') or None
+            uri = text[start + 1:end].strip()
+            rest = text[end + 1:]
+        else:
+            uri, _, rest = text.partition(';')
+            uri = uri.strip()
+            rest = ';' + rest
+        params = {}
+        for param in rest.split(';'):
+            name, equals, value = param.partition('=')
+            name = name.strip().lower()
+            if name:
+                params[name] = equals and value.strip().strip('"') or None
+        return cls(display_name, uri, params)
+
+    @property
+    def user(self):
+        """
+        The user part of the URI: the number in sip:+14155550100@host or
+        tel:+14155550100.
+        """
+        uri = self.uri
+        scheme, colon, rest = uri.partition(':')
+        if colon and scheme.lower() in ('sip', 'sips', 'tel'):
+            uri = rest
+        return uri.split('@', 1)[0].split(';', 1)[0]
+
+    def __repr__(self):
+        return "NameAddr(%r, %r, %r)" % (self.display_name, self.uri, self.params)
+
+
+def split_header_values(value):
+    """
+    Split a comma-separated SIP header value into its entries, leaving
+    commas inside quotes and <...> alone.
+    """
+    values = []
+    start = 0
+    quoted = False
+    angle = False
+    for i, c in enumerate(value):
+        if c == '"':
+            quoted = not quoted
+        elif quoted:
+            continue
+        elif c == '<':
+            angle = True
+        elif c == '>':
+            angle = False
+        elif c == ',' and not angle:
+            values.append(value[start:i].strip())
+            start = i + 1
+    values.append(value[start:].strip())
+    return [v for v in values if v]
+
+
+class Headers(object):
+    """
+    The SIP headers of a Session, read-only.  Names are case-insensitive,
+    and a header sent more than once (as a list, or under names differing
+    only in case) keeps all its values:
+
+        headers['diversion']           the first value, or KeyError
+        headers.get('Diversion')       the first value, or a default
+        headers.get_all('Diversion')   every value, in order
+
+    A header sent as an empty list has no values and isn't there at all.
+    keys(), values() and items() give the names and values as sent, as
+    they were when the headers were a dict.
+
+    The index is built once, when the Headers is made.  The typed accessors
+    (diversion, asserted_identity, sbc, ...) parse on first use and keep
+    the result.
+    """
+    __slots__ = ('_raw', '_index', '_parsed')
+
+    def __init__(self, raw=None):
+        self._raw = raw = raw or {}
+        self._parsed = {}
+        index = {}
+        for name, value in raw.items():
+            if isinstance(value, list):
+                if value:
+                    index.setdefault(name.lower(), []).extend(value)
+            else:
+                index.setdefault(name.lower(), []).append(value)
+        self._index = index
+
+    def __getitem__(self, name):
+        return self._index[name.lower()][0]
+
+    def get(self, name, default=None):
+        values = self._index.get(name.lower())
+        if values:
+            return values[0]
+        return default
+
+    def get_all(self, name):
+        return list(self._index.get(name.lower(), ()))
+
+    def __contains__(self, name):
+        return name.lower() in self._index
+
+    def __iter__(self):
+        return iter(self._index)
+
+    def __len__(self):
+        return len(self._index)
+
+    def keys(self):
+        return [name for name, value in self.items()]
+
+    def values(self):
+        return [value for name, value in self.items()]
+
+    def items(self):
+        return [(name, value) for name, value in self._raw.items() if value != []]
+
+    def raw(self):
+        return self._raw
+
+    def with_prefix(self, prefix):
+        """
+        Return {name: first value} for the headers whose (lower case) name
+        starts with prefix, with the prefix removed.
+        """
+        prefix = prefix.lower()
+        cut = len(prefix)
+        return dict((name[cut:], values[0]) for name, values in self._index.items()
+                    if name.startswith(prefix) and values)
+
+    def addresses(self, name):
+        """
+        Return every address in the named header as a NameAddr, splitting
+        comma-separated values.
+        """
+        key = name.lower()
+        parsed = self._parsed.get(key)
+        if parsed is None:
+            parsed = []
+            for value in self._index.get(key, ()):
+                parsed.extend(NameAddr.parse(entry) for entry in split_header_values(value))
+            self._parsed[key] = parsed
+        return parsed
+
+    @property
+    def diversion(self):
+        """
+        The Diversion addresses, most recent redirection first.
+        """
+        return self.addresses('diversion')
+
+    @property
+    def asserted_identity(self):
+        """
+        The first P-Asserted-Identity address, or None.
+        """
+        addresses = self.addresses('p-asserted-identity')
+        return addresses and addresses[0] or None
+
+    @property
+    def sbc(self):
+        """
+        The x-sbc-* headers, as {name without 'x-sbc-': value}.
+        """
+        sbc = self._parsed.get('x-sbc-')
+        if sbc is None:
+            sbc = self._parsed['x-sbc-'] = self.with_prefix('x-sbc-')
+        return sbc
+
+    @property
+    def call_id(self):
+        return self.get('call-id')
+
+    @property
+    def user_agent(self):
+        return self.get('user-agent')
+
+
+# Session keys kept as they arrive
+_SESSION_ATTRIBUTES = frozenset(('accountId', 'callId', 'id', 'initialText', 'parameters',
+                                 'timestamp', 'userType'))
+
 class Session(object):
     """
     Session is the payload sent as an HTTP POST to your web application when a new session arrives.
     (See https://www.tropo.com/docs/webapi/session.htm)
+
+        { "session": {
+            "accountId": String,
+            "callId": String,
+            "from": Endpoint,
+            "headers": Headers,
+            "id": String,
+            "initialText": String,
+            "parameters": Object,
+            "timestamp": String,
+            "to": Endpoint,
+            "userType": String } }
+
+    These are attributes, None when not sent; "from" is read as from_.  Any
+    other key is available as an attribute too (with a trailing underscore
+    if it's a Python keyword).  session_json may also be the payload already
+    decoded into a dict.  headers are indexed into a Headers object the
+    first time they're used; with parse_headers=False they are skipped
+    altogether and headers is None.
     """
-    def __init__(self, session_json):
-        logging.info ("POST data: %s" % session_json)
-        session_data = jsonlib.loads(session_json)
+    __slots__ = ('accountId', 'callId', 'from_', 'id', 'initialText', 'parameters',
+                 'timestamp', 'to', 'userType', '_raw_headers', '_headers', '_extra')
+
+    def __init__(self, session_json, parse_headers=True):
+        logging.info ("POST data: %s", session_json)
+        if isinstance(session_json, dict):
+            session_data = session_json
+        else:
+            session_data = jsonlib.loads(session_json)
         session_dict = session_data['session']
-        for key in session_dict:
-            val = session_dict[key]
-            logging.info ("key: %s val: %s" % (key, val))
-            if key in keyword.kwlist:
-                key = key + '_'
-                logging.info ("changed key: %s val: %s" % (key, val))
+        self.accountId = self.callId = self.from_ = self.id = self.initialText = None
+        self.parameters = self.timestamp = self.to = self.userType = None
+        self._raw_headers = self._headers = None
+        self._extra = extra = {}
+        for key, val in session_dict.items():
+            if key in _SESSION_ATTRIBUTES:
+                setattr(self, key, val)
+            elif key == 'from':
+                self.from_ = Endpoint.from_dict(val)
+            elif key == 'to':
+                self.to = Endpoint.from_dict(val)
+            elif key == 'headers':
+                if parse_headers:
+                    self._raw_headers = val
+            elif key in _KEYWORDS:
+                extra[key + '_'] = val
+                logging.info ("changed key: %s_ val: %s", key, val)
+            else:
+                extra[key] = val
+
+    def __getattr__(self, name):
+        # only called for names that aren't slots, or slots never set
+        if name != '_extra':
+            try:
+                return self._extra[name]
+            except KeyError:
+                pass
+        raise AttributeError(name)
+
+    @property
+    def headers(self):
+        """
+        The SIP headers as a Headers object, or None if none were sent.
+        """
+        headers = self._headers
+        if headers is None and self._raw_headers is not None:
+            headers = self._headers = Headers(self._raw_headers)
+        return headers
+
 
-            setattr(self, key, val)
+# documents smaller than this are not worth gzipping
+GZIP_MIN_SIZE = 1024
+
+# the encode method of a reused compact encoder for jsonlib; dumps() builds
+# a new encoder on every call it's given separators
+_compact_encode = None
+
+def _compact_encoder():
+    encoder = getattr(jsonlib, 'JSONEncoder', None)
+    if encoder is None:
+        # json libraries such as cjson don't take separators
+        return jsonlib.dumps
+    return encoder(separators=(',', ':')).encode
+
+def dumps_compact(obj):
+    """
+    Encode obj as JSON without spaces after the separators.
+    """
+    global _compact_encode
+    if _compact_encode is None:
+        _compact_encode = _compact_encoder()
+    return _compact_encode(obj)
+
+def _is_say_step(step):
+    return len(step) == 1 and 'say' in step
+
+def _without_none(entry):
+    if isinstance(entry, dict) and None in entry.values():
+        # copying and deleting is cheaper than building a new dict
+        entry = entry.copy()
+        for k in [k for k, v in entry.items() if v is None]:
+            del entry[k]
+    return entry
+
+def compact_steps(steps):
+    """
+    Return a compacted copy of a list of steps, leaving the originals alone:
+    runs of adjacent "say" steps are merged into a single "say" array, which
+    Tropo plays in the same order, and options set to None are dropped from
+    "say" entries.  Steps with nothing to merge or drop aren't copied.
+    """
+    compacted = []
+    merged = None       # the entries of the say run being built
+    owned = False       # merged is a new list, already in compacted[-1]
+    for step in steps:
+        if len(step) != 1 or 'say' not in step:
+            merged = None
+            compacted.append(step)
+            continue
+        say = step['say']
+        entries = isinstance(say, list) and say or [say]
+        for entry in entries:
+            if isinstance(entry, dict) and None in entry.values():
+                entries = [_without_none(e) for e in entries]
+                break
+        if merged is not None:
+            if not owned:
+                merged = list(merged)
+                compacted[-1] = {'say': merged}
+                owned = True
+            merged.extend(entries)
+        elif (entries is say and len(say) != 1) or entries[0] is say:
+            merged, owned = entries, False
+            compacted.append(step)
+        else:
+            merged, owned = entries, False
+            compacted.append({'say': len(entries) == 1 and entries[0] or entries})
+    return compacted
+
+def accepts_gzip(accept_encoding):
+    """
+    Whether an Accept-Encoding header value allows a gzipped response.
+    """
+    for coding in (accept_encoding or '').split(','):
+        parts = coding.strip().split(';')
+        if parts[0].strip().lower() not in ('gzip', '*'):
+            continue
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    if float(value) == 0:
+                        break
+                except ValueError:
+                    break
+        else:
+            return True
+    return False
+
+def gzip_bytes(data, level=6):
+    """
+    Gzip data (bytes).
+    """
+    import zlib
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+# (text, spoken form) pairs used by TextNormalizer unless told otherwise.
+# Entries match whole words only, and case-sensitively, and never a letter
+# of a dotted abbreviation such as "U.S.".  Compass points are only read
+# out where they give a direction, and units only after a number.
+COMPASS_POINTS = (
+    ('N', 'North'), ('S', 'South'), ('E', 'East'), ('W', 'West'),
+    ('NE', 'North East'), ('NW', 'North West'), ('SE', 'South East'), ('SW', 'South West'),
+    ('NNE', 'North North East'), ('ENE', 'East North East'), ('ESE', 'East South East'),
+    ('SSE', 'South South East'), ('SSW', 'South South West'), ('WSW', 'West South West'),
+    ('WNW', 'West North West'), ('NNW', 'North North West'),
+)
+
+UNITS = (
+    ('mph', 'miles per hour'), ('km/h', 'kilometers per hour'), ('kph', 'kilometers per hour'),
+    ('ft', 'feet'), ('mi', 'miles'), ('km', 'kilometers'), ('lbs', 'pounds'), ('kg', 'kilograms'),
+    (u'\u00b0F', 'degrees Fahrenheit'), (u'\u00b0C', 'degrees Celsius'), ('%', 'percent'),
+)
+
+ABBREVIATIONS = (
+    ('Mr.', 'Mister'), ('Mrs.', 'Missus'), ('Dr.', 'Doctor'),
+    ('Ave.', 'Avenue'), ('Blvd.', 'Boulevard'), ('Rd.', 'Road'), ('Apt.', 'Apartment'),
+    ('Dept.', 'Department'), ('approx.', 'approximately'), ('e.g.', 'for example'),
+    ('i.e.', 'that is'), ('etc.', 'et cetera'), ('&', 'and'),
+)
+
+DEFAULT_SUBSTITUTIONS = ABBREVIATIONS
+
+def _import_re():
+    import re
+    return re
+
+re = _LazyModule('re', _import_re)
+
+
+class TextNormalizer(object):
+    """
+    Rewrites text for text-to-speech in one pass: words from a substitution
+    table (by default common abbreviations), units after a number, compass
+    points used as directions, phone numbers and long digit runs.
+
+        normalize = TextNormalizer()
+        normalize("Wind: NW at 10 mph")            # 'Wind: North West at 10 miles per hour'
+        normalize("Vitamin E, U.S. Army")          # unchanged
+        normalize("Call (415) 555-0100")           # 'Call 4 1 5, 5 5 5, 0 1 0 0'
+
+    A compass point counts as a direction next to a number ("45 N",
+    "N 45"), after "at", "from", "towards", "heading" or "wind" (as
+    in "winds from the SW"), or before "at" ("NW at 10 mph").
+
+    The table, phone number and digit patterns are compiled into a single
+    regular expression the first time it's used, so each string is scanned
+    once however large the table.  Phone numbers (North American, with or
+    without +1) are read digit by digit in groups; other runs of at least
+    digit_group_min digits, other than in decimals, are read digit by digit
+    in fours (None turns this off).  The last cache_size distinct strings are remembered.
+    """
+    def __init__(self, substitutions=DEFAULT_SUBSTITUTIONS, phone_numbers=True,
+                 digit_group_min=7, cache_size=1024, units=UNITS, directions=COMPASS_POINTS):
+        self.substitutions = dict(substitutions)
+        self.units = dict(units)
+        self.directions = dict(directions)
+        self.phone_numbers = phone_numbers
+        self.digit_group_min = digit_group_min
+        self.cache = LRUCache(cache_size, float('inf'))
+        self._pattern = None
+        self._before_direction = None
+        self._after_direction = None
+
+    def _compile(self):
+        parts = []
+        if self.phone_numbers:
+            parts.append(r'(?P<phone>(?<![\w+])(?:\+?1[ .-]?)?(?:\(\d{3}\)|\d{3})[ .-]?\d{3}[ .-]?\d{4}(?!\w))')
+        if self.digit_group_min:
+            # not the parts of a decimal, but a full stop may end the sentence
+            parts.append(r'(?P<digits>(?<![\w.])\d{%d,}(?!\w|\.\d))' % self.digit_group_min)
+        if self.units:
+            # directly after a number, or after a number and a space
+            parts.append(r'(?P<unit>(?:(?<=\d)|(?<=\d ))(?:%s))' % self._words(self.units))
+        if self.directions:
+            # whether it is a direction is decided by _replace
+            parts.append('(?P<direction>%s)' % self._words(self.directions))
+        if self.substitutions:
+            parts.append('(?P<word>%s)' % self._words(self.substitutions))
+        self._before_direction = re.compile(
+            r'(?:\d\s*' + u'\u00b0' + r'?|\b(?:at|from|towards?|heading|winds?)(?:\s+the)?\W*)$',
+            re.IGNORECASE | re.UNICODE)
+        self._after_direction = re.compile(r'\s*(?:\d|at\b)', re.IGNORECASE | re.UNICODE)
+        return re.compile('|'.join(parts) or '(?!)', re.UNICODE)
+
+    def _words(self, table):
+        words = []
+        # longest first, so "NNE" is tried before "N"
+        for word in sorted(table, key=len, reverse=True):
+            pattern = re.escape(word)
+            if word[0].isalnum():
+                # a word may follow a number directly, as in "10mph", but
+                # not a letter and dot, as the S in "U.S."
+                pattern = r'(?<![^\W\d])(?<!\w\.)' + pattern
+            if word[-1].isalnum():
+                pattern = pattern + r'(?!\w)(?!\.\w)'
+            words.append(pattern)
+        return '|'.join(words)
+
+    def __call__(self, text):
+        normalized = self.cache.get(text)
+        if normalized is None:
+            if self._pattern is None:
+                self._pattern = self._compile()
+            normalized = self._pattern.sub(self._replace, text)
+            self.cache.put(text, normalized)
+        return normalized
+
+    normalize = __call__
+
+    def _replace(self, match):
+        kind = match.lastgroup
+        if kind == 'direction':
+            text = match.string
+            start, end = match.span()
+            if not (self._before_direction.search(text, max(0, start - 16), start)
+                    or self._after_direction.match(text, end)):
+                return match.group()
+            return self._spoken(self.directions, match)
+        if kind == 'unit':
+            return self._spoken(self.units, match)
+        if kind == 'word':
+            return self._spoken(self.substitutions, match)
+        digits = ''.join([c for c in match.group() if c.isdigit()])
+        if kind == 'phone':
+            if len(digits) == 11:
+                digits = digits[1:]
+            groups = [digits[:3], digits[3:6], digits[6:]]
+        else:
+            groups = [digits[i:i + 4] for i in range(0, len(digits), 4)]
+        return ', '.join(' '.join(group) for group in groups)
+
+    def _spoken(self, table, match):
+        spoken = table[match.group()]
+        # keep "50%" and "10mph" apart from the words they become
+        text = match.string
+        start, end = match.span()
+        if start and text[start - 1].isalnum():
+            spoken = ' ' + spoken
+        if end < len(text) and text[end].isalnum():
+            spoken = spoken + ' '
+        return spoken
+
+
+_default_normalizer = None
+
+def normalize_text(text):
+    """
+    Normalize text for speech with a shared default TextNormalizer.
+    """
+    global _default_normalizer
+    if _default_normalizer is None:
+        _default_normalizer = TextNormalizer()
+    return _default_normalizer(text)
+
+def _normalize_say(message, normalize):
+    # audio URLs and SSML are left alone
+    if not isinstance(message, _string_types) or '://' in message or message.lstrip().startswith('<'):
+        return message
+    return normalize(message)
+
+
+def ssml_escape(text):
+    """
+    Escape text for use in SSML content or attribute values.
+    """
+    # written out rather than looped over: this runs for every say_as()
+    # value, and most need no escaping at all
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '<' in text:
+        text = text.replace('<', '&lt;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    if '"' in text:
+        text = text.replace('"', '&quot;')
+    if "'" in text:
+        text = text.replace("'", '&apos;')
+    return text
+
+# escaped text by text, and rendered elements and opening tags by their
+# arguments, a level of dicts for each (the last argument innermost), so a
+# lookup doesn't have to build a key; each dict is cleared when it fills up
+_ssml_texts = {}
+_ssml_say_as = {}       # format -> interpret_as -> opening tag
+_ssml_audio = {}        # fallback -> src -> element
+_ssml_breaks = {}       # strength -> milliseconds -> element
+_ssml_prosody = {}      # pitch -> volume -> rate -> opening tag
+_ssml_emphasis = {}     # level -> opening tag
+_NO_FRAGMENTS = {}
+SSML_FRAGMENT_CACHE_SIZE = 4096
+
+def _ssml_cache(cache, keys, fragment):
+    for key in keys[:-1]:
+        level = cache.get(key)
+        if level is None:
+            if len(cache) >= SSML_FRAGMENT_CACHE_SIZE:
+                cache.clear()
+            level = cache[key] = {}
+        cache = level
+    if len(cache) >= SSML_FRAGMENT_CACHE_SIZE:
+        cache.clear()
+    cache[keys[-1]] = fragment
+    return fragment
+
+def _ssml_string(value):
+    if isinstance(value, _string_types):
+        return value
+    return str(value)
+
+def _ssml_attributes(attributes):
+    return ''.join(' %s="%s"' % (name, ssml_escape(_ssml_string(value)))
+                   for name, value in attributes if value is not None)
+
+def _ssml_element(tag, attributes, content=None):
+    attrs = _ssml_attributes(attributes)
+    if content is None:
+        return '<%s%s/>' % (tag, attrs)
+    return '<%s%s>%s</%s>' % (tag, attrs, content, tag)
+
+def _ssml_pieces(parts):
+    # the strings and slots of a builder's parts, with the spaces between them
+    pieces = []
+    for part in parts:
+        if pieces:
+            pieces.append(' ')
+        if isinstance(part, tuple):
+            pieces.extend(part)
+        else:
+            pieces.append(part)
+    return pieces
+
+def _ssml_joined(parts):
+    # the parts as one string, or as a tuple of pieces if there are slots
+    try:
+        return ' '.join(parts)
+    except TypeError:
+        return tuple(_ssml_pieces(parts))
+
+
+class SSMLSlot(object):
+    """
+    A named blank in an SSML prompt, filled in by SSMLTemplate.render().
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return 'SSMLSlot(%r)' % self.name
+
+
+class SSML(object):
+    """
+    Builds SSML for say values.  Each method appends a piece and returns
+    the builder, so prompts can be written as one expression:
+
+        prompt = SSML().text("Your balance is").say_as("1234", "digits") \\
+                       .pause(300).audio("http://example.com/thanks.wav", "Thank you.")
+        tropo.say(prompt)      # or prompt.render()
+
+    Text and attributes are escaped.  Each piece is kept as its rendered
+    string, so rendering joins the strings once.  Escaped text, audio,
+    breaks and opening tags are cached by their arguments across all
+    builders (say_as() values aren't), so prompts assembled from the same
+    text, prompts and wrappers reuse strings built earlier.  A builder can
+    itself be appended to another (add(), or as the content of prosody()
+    and emphasis()).
+
+    For a prompt spoken on every call with only a few values changing, put
+    SSMLSlot objects where the values go and compile() it once; rendering
+    the SSMLTemplate then only escapes the values and joins the pieces.
+
+        balance = SSML("Your balance is").say_as(SSMLSlot("amount"), "currency").compile()
+        tropo.say(balance.render(amount="$12.50"))
+    """
+    __slots__ = ('_parts', '_rendered')
+
+    def __init__(self, text=None):
+        # rendered pieces, or tuples of strings and slots for pieces with slots
+        self._parts = []
+        # (number of parts, document) for the last render()
+        self._rendered = (0, None)
+        if text is not None:
+            self._parts.append(_ssml_texts.get(text) or self._content(text))
+
+    def _content(self, content):
+        # text, a slot, or another builder, as a piece
+        piece = _ssml_texts.get(content)
+        if piece is not None:
+            return piece
+        if isinstance(content, SSML):
+            return _ssml_joined(content._parts)
+        if isinstance(content, SSMLSlot):
+            return (content,)
+        return _ssml_cache(_ssml_texts, (content,), ssml_escape(content))
+
+    def _wrap(self, open_tag, content, close_tag):
+        if isinstance(content, SSML):
+            content = _ssml_joined(content._parts)
+        else:
+            content = self._content(content)
+        if isinstance(content, tuple):
+            self._parts.append((open_tag,) + content + (close_tag,))
+        else:
+            self._parts.append(open_tag + content + close_tag)
+        return self
+
+    def text(self, text):
+        self._parts.append(self._content(text))
+        return self
+
+    def add(self, fragment):
+        """
+        Append another SSML builder, or a string of SSML as is.
+        """
+        if isinstance(fragment, SSML):
+            fragment = self._content(fragment)
+        self._parts.append(fragment)
+        return self
+
+    def say_as(self, value, interpret_as, format=None):
+        """
+        interpret_as is, for example, 'digits', 'characters', 'date',
+        'telephone' or 'currency'.  value may be an SSMLSlot.
+        """
+        open_tag = _ssml_say_as.get(format, _NO_FRAGMENTS).get(interpret_as)
+        if open_tag is None:
+            open_tag = _ssml_cache(_ssml_say_as, (format, interpret_as), '<say-as%s>' % _ssml_attributes(
+                (('interpret-as', interpret_as), ('format', format))))
+        if isinstance(value, SSMLSlot):
+            self._parts.append((open_tag, value, '</say-as>'))
+        elif type(value) is int:
+            # digits never need escaping
+            self._parts.append(open_tag + str(value) + '</say-as>')
+        else:
+            # values change from call to call, so they aren't cached
+            if not isinstance(value, _string_types):
+                value = str(value)
+            self._parts.append(open_tag + ssml_escape(value) + '</say-as>')
+        return self
+
+    def audio(self, src, fallback=None):
+        """
+        Play the audio at src, or speak fallback if it can't be played.
+        """
+        element = _ssml_audio.get(fallback, _NO_FRAGMENTS).get(src)
+        if element is None:
+            element = _ssml_cache(_ssml_audio, (fallback, src), _ssml_element(
+                'audio', (('src', src),), fallback is not None and ssml_escape(fallback) or None))
+        self._parts.append(element)
+        return self
+
+    def pause(self, milliseconds=None, strength=None):
+        element = _ssml_breaks.get(strength, _NO_FRAGMENTS).get(milliseconds)
+        if element is None:
+            time = milliseconds is not None and '%dms' % milliseconds or None
+            element = _ssml_cache(_ssml_breaks, (strength, milliseconds), _ssml_element(
+                'break', (('time', time), ('strength', strength))))
+        self._parts.append(element)
+        return self
+
+    def prosody(self, content, rate=None, pitch=None, volume=None):
+        open_tag = _ssml_prosody.get(pitch, _NO_FRAGMENTS).get(volume, _NO_FRAGMENTS).get(rate)
+        if open_tag is None:
+            open_tag = _ssml_cache(_ssml_prosody, (pitch, volume, rate), '<prosody%s>' % _ssml_attributes(
+                (('rate', rate), ('pitch', pitch), ('volume', volume))))
+        return self._wrap(open_tag, content, '</prosody>')
+
+    def emphasis(self, content, level=None):
+        open_tag = _ssml_emphasis.get(level)
+        if open_tag is None:
+            open_tag = _ssml_cache(_ssml_emphasis, (level,), '<emphasis%s>' % _ssml_attributes(
+                (('level', level),)))
+        return self._wrap(open_tag, content, '</emphasis>')
+
+    def compile(self):
+        """
+        Return an SSMLTemplate for this prompt.
+        """
+        return SSMLTemplate(['<speak>'] + _ssml_pieces(self._parts) + ['</speak>'])
+
+    def inner(self):
+        """
+        The pieces appended so far, without the <speak> element.
+        """
+        try:
+            return ' '.join(self._parts)
+        except TypeError:
+            for piece in _ssml_pieces(self._parts):
+                if isinstance(piece, SSMLSlot):
+                    raise ValueError("slot %r has no value; compile() the prompt and render() "
+                                     "the template instead" % piece.name)
+            raise
+
+    def render(self):
+        """
+        Return the SSML document as a string, for use as a say value.
+        """
+        parts = self._parts
+        count, rendered = self._rendered
+        if count != len(parts) or rendered is None:
+            try:
+                rendered = '<speak>' + ' '.join(parts) + '</speak>'
+            except TypeError:
+                self.inner()
+                raise
+            self._rendered = (len(parts), rendered)
+        return rendered
+
+    __str__ = render
+
+    def __repr__(self):
+        return 'SSML(%r)' % ''.join(isinstance(piece, SSMLSlot) and '{%s}' % piece.name or piece
+                                    for piece in _ssml_pieces(self._parts))
+
+
+class SSMLTemplate(object):
+    """
+    A compiled SSML prompt: the fixed text between its slots, already
+    joined, and where each slot's value goes.  See SSML.compile().
+    """
+    __slots__ = ('_pieces', '_slots')
+
+    def __init__(self, parts):
+        pieces = []
+        slots = []
+        for part in parts:
+            if isinstance(part, SSMLSlot):
+                slots.append((len(pieces), part.name))
+                pieces.append(None)
+            elif pieces and pieces[-1] is not None:
+                pieces[-1] += part
+            else:
+                pieces.append(part)
+        self._pieces = pieces
+        self._slots = slots
+
+    @property
+    def slot_names(self):
+        return [name for index, name in self._slots]
+
+    def render(self, **values):
+        """
+        Return the SSML document with each slot replaced by its (escaped)
+        value.  Raises KeyError for a missing value.
+        """
+        pieces = list(self._pieces)
+        for index, name in self._slots:
+            # escaped directly: caching per-call values would only push the
+            # fixed fragments out of the cache
+            pieces[index] = ssml_escape(_ssml_string(values[name]))
+        return ''.join(pieces)
+
+
+# ITU country calling codes, for telling where the country code ends in
+# an international number.  Codes never share a prefix, so at most one of
+# the first three digits' prefixes matches.
+COUNTRY_CODES = frozenset("""
+1 7 20 27 30 31 32 33 34 36 39 40 41 43 44 45 46 47 48 49 51 52 53 54 55 56 57 58
+60 61 62 63 64 65 66 81 82 84 86 90 91 92 93 94 95 98
+211 212 213 216 218 220 221 222 223 224 225 226 227 228 229 230 231 232 233 234 235
+236 237 238 239 240 241 242 243 244 245 246 247 248 249 250 251 252 253 254 255 256
+257 258 260 261 262 263 264 265 266 267 268 269 290 291 297 298 299
+350 351 352 353 354 355 356 357 358 359 370 371 372 373 374 375 376 377 378 379 380
+381 382 383 385 386 387 389 420 421 423 500 501 502 503 504 505 506 507 508 509
+590 591 592 593 594 595 596 597 598 599 670 672 673 674 675 676 677 678 679 680 681
+682 683 685 686 687 688 689 690 691 692 800 808 850 852 853 855 856 870 878 880 881
+882 883 886 888 960 961 962 963 964 965 966 967 968 970 971 972 973 974 975 976 977
+979 992 993 994 995 996 998
+""".split())
+
+def country_code(digits):
+    """
+    Return the country calling code at the start of an international
+    number's digits, or None.
+    """
+    for length in (1, 2, 3):
+        if digits[:length] in COUNTRY_CODES:
+            return digits[:length]
+    return None
+
+
+class PhoneNumberNormalizer(object):
+    """
+    Rewrites phone numbers in E.164 form ("+14155550100").
+
+        normalize = PhoneNumberNormalizer()
+        normalize("(415) 555-0100")                   # '+14155550100'
+        normalize("tel:+44-20-7946-0018")             # '+442079460018'
+        normalize("sip:4155550100@sbc.example.com")   # 'sip:+14155550100@sbc.example.com'
+        normalize("sip:alice@example.com")            # unchanged
+
+    Numbers without a + (or an international prefix such as 00 or 011)
+    are only ever national numbers in default_country, with its trunk
+    prefix (a leading 0, except in North America) dropped.  The country
+    code must be one of COUNTRY_CODES and the whole number 8 to 15
+    digits; North American numbers must have ten digits after the 1.
+    Otherwise ValueError is raised.  SIP URIs keep their scheme, host and
+    parameters, with a numeric user part normalized; other SIP users and
+    addresses with letters are returned as they are.  A "(0)" after the
+    country code, marking the trunk prefix dialled within the country, is
+    dropped.
+
+    normalize_or_keep() is for values that may not be phone numbers at
+    all: those with letters or an @, and SMS short codes (up to eight
+    digits with nothing else), come back unchanged instead of raising.
+
+    The last cache_size distinct inputs are remembered, so normalizing a
+    repeat caller is a cache lookup.
+    """
+    def __init__(self, default_country='1', cache_size=4096):
+        if default_country not in COUNTRY_CODES:
+            raise ValueError("unknown country code %r" % default_country)
+        self.default_country = default_country
+        self.cache = LRUCache(cache_size, float('inf'))
+
+    def __call__(self, number):
+        normalized = self.cache.get(number)
+        if normalized is None:
+            try:
+                normalized = self._normalize(number)
+            except ValueError as e:
+                # remembered as (message,), so repeats fail fast too
+                normalized = (str(e),)
+            self.cache.put(number, normalized)
+        if isinstance(normalized, tuple):
+            raise ValueError(normalized[0])
+        return normalized
+
+    normalize = __call__
+
+    def is_valid(self, number):
+        try:
+            self(number)
+        except ValueError:
+            return False
+        return True
+
+    def normalize_or_none(self, number):
+        try:
+            return self(number)
+        except ValueError:
+            return None
+
+    def normalize_or_keep(self, number):
+        try:
+            return self(number)
+        except ValueError:
+            text = number.strip()
+            if '@' in text or any(c.isalpha() for c in text) or (text.isdigit() and len(text) <= 8):
+                return number
+            raise
+
+    def _normalize(self, number):
+        text = number.strip()
+        scheme = text[:4].lower()
+        if scheme == 'tel:':
+            return self._e164(text[4:].split(';', 1)[0], number)
+        if scheme in ('sip:', 'sips'):
+            prefix, colon, address = text.partition(':')
+            user, at, host = address.partition('@')
+            user, semicolon, user_params = user.partition(';')
+            if not at or not self._numeric(user):
+                return text
+            return '%s:%s%s%s@%s' % (prefix, self._e164(user, number), semicolon, user_params, host)
+        return self._e164(text, number)
+
+    def _numeric(self, text):
+        return any(c.isdigit() for c in text) and not any(c.isalpha() for c in text)
+
+    def _e164(self, text, original):
+        if [c for c in text if c.isalpha()]:
+            raise ValueError("%r is not a phone number" % original)
+        if '(0)' in text:
+            # "+44 (0)20 ...": the trunk prefix, only dialled within the country
+            text = text.replace('(0)', '')
+        digits = ''.join([c for c in text if c.isdigit()])
+        if text.lstrip().startswith('+'):
+            pass
+        elif digits.startswith('011') and self.default_country == '1':
+            digits = digits[3:]
+        elif digits.startswith('00') and self.default_country != '1':
+            digits = digits[2:]
+        elif self.default_country == '1':
+            # a national number: ten digits, or eleven with the leading 1.
+            # anything else isn't read as an international number without
+            # its prefix
+            if len(digits) == 10:
+                digits = '1' + digits
+            elif len(digits) != 11 or digits[0] != '1':
+                raise ValueError("%r is not a valid North American number" % original)
+        else:
+            digits = self.default_country + digits.lstrip('0')
+        code = country_code(digits)
+        if code is None or not 8 <= len(digits) <= 15:
+            raise ValueError("%r is not a valid phone number" % original)
+        if code == '1' and (len(digits) != 11 or digits[1] in '01'):
+            raise ValueError("%r is not a valid North American number" % original)
+        return '+' + digits
+
+
+_default_phone_normalizer = None
+
+def _get_phone_normalizer():
+    global _default_phone_normalizer
+    if _default_phone_normalizer is None:
+        _default_phone_normalizer = PhoneNumberNormalizer()
+    return _default_phone_normalizer
+
+def normalize_number(number):
+    """
+    Return number in E.164 form, using a shared PhoneNumberNormalizer for
+    North America.  Raises ValueError for numbers that aren't valid.
+    """
+    return _get_phone_normalizer()(number)
+
+def _normalize_numbers(to, normalize):
+    # apply a builder method's normalize= option to a to (or from) value;
+    # values that aren't phone numbers are left alone
+    if normalize is True:
+        normalize = _get_phone_normalizer()
+    if isinstance(normalize, PhoneNumberNormalizer):
+        normalize = normalize.normalize_or_keep
+    if isinstance(to, list):
+        return [normalize(number) for number in to]
+    if isinstance(to, _string_types):
+        return normalize(to)
+    return to
+
+def _normalize_options(options, normalize):
+    if isinstance(options.get('from'), _string_types):
+        options['from'] = _normalize_numbers(options['from'], normalize)
+    return options
+
+
+class TropoPrefix(object):
+    """
+    A frozen run of steps shared by the documents made with Tropo.fork().
+    The steps are encoded to JSON once, on first use.
+    """
+    __slots__ = ('steps', '_json', '_compact_steps', '_compact_json')
+
+    def __init__(self, steps):
+        self.steps = tuple(steps)
+        self._json = None
+        self._compact_steps = None
+        self._compact_json = None
+
+    @property
+    def json(self):
+        """
+        The steps as JSON array members, without the enclosing brackets.
+        """
+        if self._json is None:
+            self._json = jsonlib.dumps(list(self.steps))[1:-1]
+        return self._json
+
+    @property
+    def compact_steps(self):
+        if self._compact_steps is None:
+            self._compact_steps = compact_steps(self.steps)
+        return self._compact_steps
+
+    @property
+    def compact_json(self):
+        """
+        The compacted steps as tightly encoded JSON array members.
+        """
+        if self._compact_json is None:
+            self._compact_json = dumps_compact(self.compact_steps)[1:-1]
+        return self._compact_json
 
 
 class Tropo(object):
@@ -514,8 +1944,49 @@ class Tropo(object):
       The optional arguments for these methods are described here:
       https://www.tropo.com/docs/webapi/
     """
-    def  __init__(self):
+    def  __init__(self, prefix=None):
+        self._prefix = prefix
         self._steps = []
+        self._fork_prefix = None
+
+    def fork(self):
+        """
+        Return a new Tropo object that starts with all the steps added to
+        this one so far.  The steps are shared, not copied, and their JSON
+        is encoded once and reused by every fork that renders them, so a
+        fork only pays for the steps added to it afterwards.
+
+        Typical use is a module-level preamble forked once per request:
+
+            PREAMBLE = Tropo()
+            PREAMBLE.say("Welcome to Acme.")
+            PREAMBLE.on(event="error", next="/error.json")
+
+            tropo = PREAMBLE.fork()
+            tropo.ask(choices, say="Please enter your account number.")
+
+        Steps added to this object after the fork do not show up in it.
+        """
+        prefix = self._fork_prefix
+        if prefix is None or len(prefix.steps) != self._step_count():
+            if not self._steps:
+                prefix = self._prefix
+            elif self._prefix is None:
+                prefix = TropoPrefix(self._steps)
+            else:
+                prefix = TropoPrefix(self._prefix.steps + tuple(self._steps))
+            self._fork_prefix = prefix
+        return Tropo(prefix)
+
+    def _step_count(self):
+        if self._prefix is None:
+            return len(self._steps)
+        return len(self._prefix.steps) + len(self._steps)
+
+    def _all_steps(self):
+        if self._prefix is None:
+            return self._steps
+        return list(self._prefix.steps) + self._steps
 
     def ask(self, choices, **options):
         """
@@ -525,14 +1996,20 @@ class Tropo(object):
         """
         self._steps.append(Ask(choices, **options).obj)
 
-    def call (self, to, **options):
+    def call (self, to, normalize=None, **options):
         """
 	 Places a call or sends an an IM, Twitter, or SMS message. To start a call, use the Session API to tell Tropo to launch your code.
 
 	 Arguments: to is a String.
+	 Argument: normalize is True to put to and from in E.164 form with normalize_number(), or a
+	           PhoneNumberNormalizer (or any function of a string); short codes and other
+	           values that aren't phone numbers are left alone
 	 Argument: **options is a set of optional keyword arguments.
 	 See https://www.tropo.com/docs/webapi/call.htm
         """
+        if normalize:
+            to = _normalize_numbers(to, normalize)
+            options = _normalize_options(options, normalize)
         self._steps.append(Call (to, **options).obj)
 
     def conference(self, id, **options):
@@ -552,15 +2029,21 @@ class Tropo(object):
         """
         self._steps.append(Hangup().obj)
 
-    def message (self, say_obj, to, **options):
+    def message (self, say_obj, to, normalize=None, **options):
         """
 	A shortcut method to create a session, say something, and hang up, all in one step. This is particularly useful for sending out a quick SMS or IM.
 
  	Argument: "say_obj" is a Say object
-        Argument: "to" is a String
+        Argument: "to" is a String, or a List of Strings
+        Argument: normalize is True to put to and from in E.164 form with normalize_number(), or a
+                  PhoneNumberNormalizer (or any function of a string); short codes and other
+                  values that aren't phone numbers are left alone
         Argument: **options is a set of optional keyword arguments.
         See https://www.tropo.com/docs/webapi/message.htm
         """
+        if normalize:
+            to = _normalize_numbers(to, normalize)
+            options = _normalize_options(options, normalize)
         if isinstance(say_obj, str):
             say = Say(say_obj).obj
         else:
@@ -585,13 +2068,18 @@ class Tropo(object):
         """
         self._steps.append(Record(**options).obj)
 
-    def redirect(self, id, **options):
+    def redirect(self, id, normalize=None, **options):
         """
         Forwards an incoming call to another destination / phone number before answering it.
         Argument: id is a String
+        Argument: normalize is True to put id in E.164 form with normalize_number(), or a
+                  PhoneNumberNormalizer (or any function of a string); short codes and other
+                  values that aren't phone numbers are left alone
         Argument: **options is a set of optional keyword arguments.
         See https://www.tropo.com/docs/webapi/redirect.htm
         """
+        if normalize:
+            id = _normalize_numbers(id, normalize)
         self._steps.append(Redirect(id, **options).obj)
 
     def reject(self):
@@ -601,14 +2089,27 @@ class Tropo(object):
         """
         self._steps.append(Reject().obj)
 
-    def say(self, message, **options):
+    def say(self, message, normalize=None, **options):
         """
 	When the current session is a voice channel this key will either play a message or an audio file from a URL.
 	In the case of an text channel it will send the text back to the user via i nstant messaging or SMS.
-        Argument: message is a string
+        Argument: message is a string, an SSML builder, or a List of them
+        Argument: normalize is True to rewrite the text with normalize_text(), or a TextNormalizer
+                  (or any function of a string); audio URLs are left alone
         Argument: **options is a set of optional keyword arguments.
         See https://www.tropo.com/docs/webapi/say.htm
         """
+        if isinstance(message, SSML):
+            message = message.render()
+        elif isinstance(message, list):
+            message = [isinstance(m, SSML) and m.render() or m for m in message]
+        if normalize:
+            if normalize is True:
+                normalize = normalize_text
+            if isinstance(message, list):
+                message = [_normalize_say(m, normalize) for m in message]
+            else:
+                message = _normalize_say(message, normalize)
         self._steps.append(Say(message, **options).obj)
 
     def startRecording(self, url, **options):
@@ -627,23 +2128,43 @@ class Tropo(object):
         """
         self._steps.append(StopRecording().obj)
 
-    def transfer(self, to, **options):
+    def transfer(self, to, normalize=None, **options):
         """
         Transfers an already answered call to another destination / phone number.
 	Argument: to is a string
+        Argument: normalize is True to put to and from in E.164 form with normalize_number(), or a
+                  PhoneNumberNormalizer (or any function of a string); short codes and other
+                  values that aren't phone numbers are left alone
         Argument: **options is a set of optional keyword arguments.
         See https://www.tropo.com/docs/webapi/transfer.htm
         """
+        if normalize:
+            to = _normalize_numbers(to, normalize)
+            options = _normalize_options(options, normalize)
         self._steps.append(Transfer(to, **options).obj)
 
-    def RenderJson(self, pretty=False):
+    def RenderJson(self, pretty=False, compact=False):
         """
         Render a Tropo object into a Json string.
+        With compact, the output is compacted as described in compact_steps()
+        and written without spaces after separators.  That trades CPU for
+        bytes: it's only worth it when the response isn't gzipped, as gzip
+        takes out most of the same redundancy.
         """
-        steps = self._steps
+        if compact and not pretty:
+            return self._render_compact()
+        if self._prefix is not None and not pretty:
+            shared = self._prefix.json
+            if self._steps:
+                own = jsonlib.dumps(self._steps)[1:-1]
+                shared = shared and "%s, %s" % (shared, own) or own
+            json = '{"tropo": [%s]}' % shared
+            logging.info ("json: %s", json)
+            return json
+        steps = self._all_steps()
         topdict = {}
         topdict['tropo'] = steps
-        logging.info ("topdict: %s" % topdict)
+        logging.info ("topdict: %s", topdict)
         if pretty:
             try:
                 json = jsonlib.dumps(topdict, indent=4, sort_keys=False)
@@ -653,6 +2174,1546 @@ class Tropo(object):
             json = jsonlib.dumps(topdict)
         return json
 
+    def RenderResponse(self, accept_encoding='', compact=True, gzip_min_size=GZIP_MIN_SIZE):
+        """
+        Render a Tropo object into an HTTP response body and headers.
+        The body is gzipped when accept_encoding (the request's
+        Accept-Encoding header) allows it and the JSON is at least
+        gzip_min_size bytes; small documents aren't worth the CPU.
+        Returns (body, headers), with the body as bytes.
+        """
+        body = self.RenderJson(compact=compact).encode('utf-8')
+        headers = {'Content-Type': 'application/json'}
+        if gzip_min_size is not None and len(body) >= gzip_min_size and accepts_gzip(accept_encoding):
+            body = gzip_bytes(body)
+            headers['Content-Encoding'] = 'gzip'
+        headers['Content-Length'] = str(len(body))
+        return body, headers
+
+    def _render_compact(self):
+        prefix = self._prefix
+        if prefix is not None:
+            shared = prefix.compact_steps
+            own = compact_steps(self._steps)
+            # a say step on each side of the join would have to be merged,
+            # which the pre-encoded prefix can't do
+            if not (shared and own and _is_say_step(shared[-1]) and _is_say_step(own[0])):
+                json = prefix.compact_json
+                if own:
+                    own = dumps_compact(own)[1:-1]
+                    json = json and "%s,%s" % (json, own) or own
+                json = '{"tropo":[%s]}' % json
+                logging.info ("json: %s", json)
+                return json
+        json = dumps_compact({'tropo': compact_steps(self._all_steps())})
+        logging.info ("json: %s", json)
+        return json
+
+def _message_lines(text, mode, token, options, recipients):
+    # the output lines for a chunk of recipients; also run in worker processes
+    formatted = '%(' in text
+    lines = []
+    for recipient in recipients:
+        if not isinstance(recipient, dict):
+            recipient = {'to': recipient}
+        message = text
+        if formatted:
+            message = text % recipient
+        if mode == 'session':
+            payload = dict(options)
+            payload.update(token=token, numberToDial=recipient['to'], message=message)
+        else:
+            payload = {'tropo': [Message({'say': {'value': message}}, recipient['to'], **options).obj]}
+        lines.append(dumps_compact(payload))
+    lines.append('')
+    return '\n'.join(lines)
+
+def _render_message_chunk(job):
+    return _message_lines(*job)
+
+
+class BulkMessageGenerator(object):
+    """
+    Renders one message per recipient, for sending reminders or alerts in
+    bulk, using every core.
+
+        reminders = BulkMessageGenerator("Hi %(name)s, see you at %(time)s.",
+                                         channel='TEXT', network='SMS')
+        reminders.generate(recipients, "reminders.ndjson")
+
+    Recipients are numbers, or dicts with a 'to' number and the values
+    for text's %(name)s fields.  Each becomes one line of output: a Tropo
+    document with a message action (mode='document'), or a Session API
+    launch payload with token, numberToDial and message (mode='session').
+    Other keyword arguments are message options (channel, network, from,
+    ...) or, for sessions, extra launch parameters.
+
+    generate() reads recipients lazily in chunks of chunk_size, renders
+    the chunks in worker processes (a ProcessPoolExecutor, or a
+    multiprocessing pool where concurrent.futures isn't available) and
+    writes them in input order.  Each chunk crosses the process boundary
+    once each way, as a list of recipients and as one string.  At most two
+    chunks per worker are in flight, so memory doesn't grow with the
+    input.  workers=1 renders in this process.
+    """
+    def __init__(self, text, mode='document', token=None, workers=None, chunk_size=1000, **options):
+        if mode not in ('document', 'session'):
+            raise ValueError("mode should be 'document' or 'session', not %r" % mode)
+        if mode == 'session' and token is None:
+            raise ValueError("session launch payloads need a token")
+        self.text = text
+        self.mode = mode
+        self.token = token
+        self.workers = workers
+        self.chunk_size = chunk_size
+        self.options = options
+
+    def render(self, recipient):
+        """
+        Return the output line (without its newline) for one recipient.
+        """
+        return _message_lines(self.text, self.mode, self.token, self.options, [recipient])[:-1]
+
+    def _chunks(self, recipients):
+        chunk = []
+        for recipient in recipients:
+            chunk.append(recipient)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def generate(self, recipients, output):
+        """
+        Write a line per recipient to output, a file name or a file object
+        open for writing text.  Returns the number of lines written.
+        """
+        if isinstance(output, _string_types):
+            with open(output, 'w') as f:
+                return self.generate(recipients, f)
+        workers = self.workers or _cpu_count()
+        job = (self.text, self.mode, self.token, self.options)
+        count = 0
+        if workers == 1:
+            for chunk in self._chunks(recipients):
+                output.write(_message_lines(*(job + (chunk,))))
+                count += len(chunk)
+            return count
+        from collections import deque
+        pool, submit = _process_pool(workers)
+        try:
+            window = deque()
+            for chunk in self._chunks(recipients):
+                window.append((len(chunk), submit(_render_message_chunk, job + (chunk,))))
+                if len(window) >= 2 * workers:
+                    size, result = window.popleft()
+                    output.write(result())
+                    count += size
+            while window:
+                size, result = window.popleft()
+                output.write(result())
+                count += size
+        finally:
+            _close_pool(pool)
+        return count
+
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _process_pool(workers):
+    # returns the pool and submit(fn, arg), which returns a function that
+    # waits for the result
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        import multiprocessing
+        pool = multiprocessing.Pool(workers)
+        return pool, lambda fn, arg: pool.apply_async(fn, (arg,)).get
+    pool = ProcessPoolExecutor(workers)
+    return pool, lambda fn, arg: pool.submit(fn, arg).result
+
+def _close_pool(pool):
+    if hasattr(pool, 'shutdown'):
+        pool.shutdown()
+    else:
+        pool.close()
+        pool.join()
+
+
+def _import_zlib():
+    import zlib
+    return zlib
+
+zlib = _LazyModule('zlib', _import_zlib)
+
+def _bloom_hashes(item):
+    # CRC-32 rather than hash(), which is randomized per process, so the
+    # same input gives the same false positives on every run
+    if not isinstance(item, bytes):
+        item = item.encode('utf-8')
+    return zlib.crc32(item) & 0xffffffff, zlib.crc32(item[::-1]) & 0xffffffff | 1
+
+
+class BloomFilter(object):
+    """
+    A set of strings in a fixed amount of memory, sized for capacity items
+    with a false positive rate of error_rate: "item in bloom" is never
+    wrong when it says False, and wrong with probability about error_rate
+    when it says True.  add() returns whether the item was (probably)
+    already present.  Items are hashed with CRC-32, so which ones collide
+    is the same from one run to the next.
+    """
+    __slots__ = ('capacity', 'error_rate', 'size', 'hashes', 'bits', 'count')
+
+    def __init__(self, capacity=1000000, error_rate=0.0001):
+        import math
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, int(round(self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    # double hashing: the i-th bit for an item is (h1 + i * h2) % size
+
+    def __contains__(self, item):
+        bits = self.bits
+        size = self.size
+        h1, h2 = _bloom_hashes(item)
+        for i in range(self.hashes):
+            position = h1 % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+            h1 += h2
+        return True
+
+    def add(self, item):
+        bits = self.bits
+        size = self.size
+        h1, h2 = _bloom_hashes(item)
+        present = True
+        for i in range(self.hashes):
+            position = h1 % size
+            byte = position >> 3
+            mask = 1 << (position & 7)
+            if not bits[byte] & mask:
+                present = False
+                bits[byte] |= mask
+            h1 += h2
+        if not present:
+            self.count += 1
+        return present
+
+    def __len__(self):
+        return self.count
+
+
+class BroadcastReport(object):
+    """
+    What a BroadcastPlanner did with its input: how many numbers it read,
+    kept, dropped as duplicates or as invalid, and how many batches it
+    made.
+    """
+    __slots__ = ('total', 'accepted', 'duplicates', 'invalid', 'batches')
+
+    def __init__(self):
+        self.total = self.accepted = self.duplicates = self.invalid = self.batches = 0
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
+
+    def __repr__(self):
+        return 'BroadcastReport(%s)' % ', '.join('%s=%d' % (name, getattr(self, name))
+                                                  for name in self.__slots__)
+
+
+class BroadcastPlanner(object):
+    """
+    Turns a list of raw phone numbers into batches for SMS broadcasts.
+
+        planner = BroadcastPlanner(batch_size=100)
+        for json in planner.documents(numbers, "Polls close at 8pm tonight.",
+                                      channel='TEXT', network='SMS'):
+            ...                                  # one message per 100 numbers
+        print(planner.report)
+
+    Numbers are normalized (normalize, by default E.164 with
+    normalize_number(), returning None for anything that isn't a valid
+    phone number) and deduplicated as they stream through, then
+    grouped into to arrays of batch_size.  Duplicates are tracked in a
+    BloomFilter sized for capacity numbers, so memory stays fixed however
+    long the list; about error_rate of the unique numbers will be wrongly
+    dropped as duplicates.  exact=True uses a set instead, which is faster
+    but grows with the number of distinct numbers.  report counts
+    numbers read, accepted, duplicate and invalid, and batches made.
+    """
+    def __init__(self, batch_size=100, normalize=None, capacity=1000000, error_rate=0.0001,
+                 exact=False):
+        if batch_size < 1:
+            raise ValueError("batch_size must be at least 1")
+        self.batch_size = batch_size
+        self.normalize = normalize or _get_phone_normalizer().normalize_or_none
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.exact = exact
+        self.report = BroadcastReport()
+
+    def batches(self, numbers):
+        """
+        Yield lists of up to batch_size normalized, distinct numbers.
+        """
+        report = self.report = BroadcastReport()
+        normalize = self.normalize
+        if self.exact:
+            seen = set()
+        else:
+            seen = BloomFilter(self.capacity, self.error_rate)
+        batch = []
+        for number in numbers:
+            report.total += 1
+            number = normalize(number)
+            if number is None:
+                report.invalid += 1
+                continue
+            if self.exact:
+                duplicate = number in seen
+                seen.add(number)
+            else:
+                duplicate = seen.add(number)
+            if duplicate:
+                report.duplicates += 1
+                continue
+            report.accepted += 1
+            batch.append(number)
+            if len(batch) >= self.batch_size:
+                report.batches += 1
+                yield batch
+                batch = []
+        if batch:
+            report.batches += 1
+            yield batch
+
+    def documents(self, numbers, text, **options):
+        """
+        Yield a Tropo document with one message action per batch.  options
+        are message options (channel, network, from, ...).
+        """
+        say = Say(text).obj
+        for batch in self.batches(numbers):
+            yield dumps_compact({'tropo': [Message(say, batch, **options).obj]})
+
+
+def result_interpretation(result_json):
+    """
+    Return the interpretation of the first action in a Result payload, or
+    None if there isn't one.  The same value as Result(result_json).getValue(),
+    without building a Result.
+    """
+    actions = jsonlib.loads(result_json)['result'].get('actions')
+    if isinstance(actions, list):
+        actions = actions and actions[0] or None
+    if not actions:
+        return None
+    return actions.get('interpretation')
+
+
+class FlowState(object):
+    """
+    One state of a CallFlow.  See CallFlow.state() for the arguments.
+    """
+    __slots__ = ('name', 'say', 'ask', 'choices', 'next', 'transfer', 'hangup',
+                 'on_incomplete', 'on_error', 'default', 'ask_options')
+
+    def __init__(self, name, say=None, ask=None, choices=None, next=None, transfer=None,
+                 hangup=False, on_incomplete=None, on_error=None, default=None, **ask_options):
+        self.name = name
+        self.say = say
+        self.ask = ask
+        self.choices = choices
+        self.next = next
+        self.transfer = transfer
+        self.hangup = hangup
+        self.on_incomplete = on_incomplete
+        self.on_error = on_error
+        self.default = default
+        self.ask_options = ask_options
+
+    def targets(self):
+        targets = [self.next, self.on_incomplete, self.on_error, self.default]
+        if self.choices:
+            targets.extend(self.choices.values())
+        return [target for target in targets if target is not None]
+
+
+class CallFlow(object):
+    """
+    A multi-step IVR described as states, compiled once into pre-rendered
+    Tropo documents and a transition table.
+
+        flow = CallFlow("/ivr", start="menu")
+        flow.state("menu", say="Welcome to Acme.",
+                   ask="For sales press 1, for support press 2.",
+                   choices={"1": "sales", "2": "support"},
+                   on_incomplete="goodbye", attempts=3, timeout=5)
+        flow.state("sales", say="Connecting you to sales.", transfer="+14155550100")
+        flow.state("support", say="Connecting you to support.", transfer="+14155550101")
+        flow.state("goodbye", say="Sorry we couldn't help. Goodbye.", hangup=True)
+        ivr = flow.compile()
+
+    Point the Tropo application at base_path and route everything under it
+    to ivr.respond(path, body), or mount ivr as a WSGI application.
+    """
+    def __init__(self, base_path, start):
+        self.base_path = base_path.rstrip('/')
+        self.start = start
+        self.states = {}
+
+    def state(self, name, say=None, ask=None, choices=None, next=None, transfer=None,
+              hangup=False, on_incomplete=None, on_error=None, default=None, **ask_options):
+        """
+        Add a state.  When the call enters it, Tropo is sent, in order:
+
+          say            a String or List of Strings to speak
+          ask            a prompt, answered with one of the choices keys;
+                         choices maps each answer to the state it leads to
+          transfer       a number to transfer the call to
+          hangup         True to end the call
+
+        Afterwards the call moves to next, if given.  An ask answered with
+        something that isn't in choices goes to default (the same state,
+        asked again, unless given); an ask with no usable answer goes to
+        on_incomplete, and any error to on_error.  Other keyword arguments
+        (attempts, bargein, timeout, voice, ...) are passed to the ask.
+        """
+        if name in self.states:
+            raise ValueError("duplicate state %r" % name)
+        if choices and not ask:
+            raise ValueError("state %r has choices but nothing to ask" % name)
+        if ask and next is not None:
+            raise ValueError("state %r can't have both an ask and a next state" % name)
+        self.states[name] = FlowState(name, say, ask, choices, next, transfer, hangup,
+                                      on_incomplete, on_error, default, **ask_options)
+        return self
+
+    def path(self, state_name):
+        return "%s/%s" % (self.base_path, state_name)
+
+    def answer_path(self, state_name):
+        return "%s/%s/answer" % (self.base_path, state_name)
+
+    def compile(self):
+        """
+        Check the flow and return a CompiledFlow for it.
+        """
+        if self.start not in self.states:
+            raise ValueError("start state %r is not defined" % self.start)
+        for state in self.states.values():
+            for target in state.targets():
+                if target not in self.states:
+                    raise ValueError("state %r leads to undefined state %r" % (state.name, target))
+
+        documents = {}
+        for name, state in self.states.items():
+            documents[name] = self._render(state)
+
+        routes = {}
+        transitions = {}
+        for name, state in self.states.items():
+            routes[self.path(name)] = documents[name]
+            if state.choices:
+                table = {}
+                for answer, target in state.choices.items():
+                    table[answer] = documents[target]
+                transitions[self.answer_path(name)] = (table, documents[state.default or name])
+        routes[self.base_path] = routes[self.base_path + '/'] = documents[self.start]
+        return CompiledFlow(documents, routes, transitions)
+
+    def _render(self, state):
+        tropo = Tropo()
+        if state.on_error is not None:
+            tropo.on(event="error", next=self.path(state.on_error))
+        if state.say is not None:
+            tropo.say(state.say)
+        if state.ask is not None:
+            choices = state.choices and ", ".join(sorted(state.choices)) or ""
+            tropo.ask(Choices(choices).obj, say=Say(state.ask).json, **state.ask_options)
+            tropo.on(event="continue", next=self.answer_path(state.name))
+            if state.on_incomplete is not None:
+                tropo.on(event="incomplete", next=self.path(state.on_incomplete))
+        if state.transfer is not None:
+            tropo.transfer(state.transfer)
+        if state.next is not None:
+            tropo.on(event="continue", next=self.path(state.next))
+        if state.hangup:
+            tropo.hangup()
+        return tropo.RenderJson(compact=True)
+
+
+class CompiledFlow(object):
+    """
+    The runtime side of a CallFlow: serving a webhook is a dict lookup for
+    the path and, for answers, one for the caller's choice.  Nothing is
+    built per request.
+    """
+    def __init__(self, documents, routes, transitions):
+        self.documents = documents
+        self.routes = routes
+        self.transitions = transitions
+
+    def respond(self, path, body=None):
+        """
+        Return the Tropo JSON for a webhook POSTed to path, or None if the
+        path isn't part of the flow.  body is only read for answers.
+        """
+        document = self.routes.get(path)
+        if document is not None:
+            return document
+        transition = self.transitions.get(path)
+        if transition is None:
+            return None
+        table, default = transition
+        answer = body and result_interpretation(body)
+        return table.get(answer, default)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        body = None
+        if path in self.transitions:
+            try:
+                length = int(environ.get('CONTENT_LENGTH') or 0)
+            except ValueError:
+                length = 0
+            body = environ['wsgi.input'].read(length).decode('utf-8')
+        document = self.respond(path, body)
+        if document is None:
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return [b'Not Found']
+        document = document.encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(document)))])
+        return [document]
+
+
+def _address_key(address):
+    """
+    Reduce a Session 'to' id to the form AppRegistry indexes numbers by:
+    E.164 for phone numbers ("+1 (415) 555-0100", "14155550100" and
+    "4155550100" match), digits only for other numbers such as short
+    codes, lower case for SIP and IM addresses.
+    """
+    address = address.strip()
+    if address[:4].lower() in ('tel:', 'sip:'):
+        address = address[4:]
+    if '@' in address:
+        return address.lower()
+    number = _get_phone_normalizer().normalize_or_none(address)
+    if number is not None:
+        return number
+    digits = ''.join([c for c in address if c.isdigit()])
+    return digits or address.lower()
+
+
+class TropoApp(object):
+    """
+    One application registered with an AppRegistry.  handler is a callable
+    or a "package.module:function" string, imported the first time the
+    handler is needed.  Any extra options are kept in config.
+    """
+    __slots__ = ('name', 'handler_path', 'numbers', 'account_id', 'application_id',
+                 'config', '_handler', '_lock')
+
+    def __init__(self, name, handler, numbers=(), account_id=None, application_id=None, **config):
+        self.name = name
+        if callable(handler):
+            self.handler_path = None
+            self._handler = handler
+        else:
+            if ':' not in handler:
+                raise ValueError("handler for %r should look like 'module:function', not %r" % (name, handler))
+            self.handler_path = handler
+            self._handler = None
+        self.numbers = tuple(numbers)
+        self.account_id = account_id
+        self.application_id = application_id
+        self.config = config
+        self._lock = allocate_lock()
+
+    @property
+    def loaded(self):
+        return self._handler is not None
+
+    @property
+    def handler(self):
+        handler = self._handler
+        if handler is None:
+            with self._lock:
+                if self._handler is None:
+                    module_name, attribute = self.handler_path.split(':', 1)
+                    logging.info ("importing handler %s for app %s", self.handler_path, self.name)
+                    module = importlib.import_module(module_name)
+                    self._handler = getattr(module, attribute)
+                handler = self._handler
+        return handler
+
+
+class AppRegistry(object):
+    """
+    Maps inbound sessions to the application that should handle them, for
+    deployments that serve many Tropo applications from one process.
+
+        registry = AppRegistry()
+        registry.register("support", "apps.support:handle", numbers=["+14155550100"])
+        registry.register("alerts", "apps.alerts:handle", application_id="123456")
+        ...
+        app = registry.lookup(Session(body))
+        json = app.handler(session)
+
+    A session is matched by its applicationId, then by the number or address
+    it was sent to, then by its accountId.  Each lookup is a dict access, and
+    handler modules are imported the first time their app gets a session, so
+    startup doesn't grow with the number of applications registered.
+    """
+    def __init__(self):
+        self.apps = {}
+        self._by_application_id = {}
+        self._by_address = {}
+        self._by_account_id = {}
+
+    def __len__(self):
+        return len(self.apps)
+
+    def __contains__(self, name):
+        return name in self.apps
+
+    def register(self, name, handler, numbers=(), account_id=None, application_id=None, **config):
+        """
+        Add an application.  numbers are the phone numbers and SIP or IM
+        addresses it answers; account_id catches every session of an account
+        not claimed by a more specific entry.  Registering the same number or
+        id twice raises ValueError.
+        """
+        if name in self.apps:
+            raise ValueError("duplicate app %r" % name)
+        app = TropoApp(name, handler, numbers, account_id, application_id, **config)
+        keys = [_address_key(number) for number in app.numbers]
+        claims = [(self._by_address, key) for key in keys]
+        if application_id is not None:
+            claims.append((self._by_application_id, str(application_id)))
+        if account_id is not None:
+            claims.append((self._by_account_id, str(account_id)))
+        for index, key in claims:
+            if key in index:
+                raise ValueError("%r is already registered to app %r" % (key, index[key].name))
+        for index, key in claims:
+            index[key] = app
+        self.apps[name] = app
+        return app
+
+    def get(self, name):
+        return self.apps.get(name)
+
+    def lookup(self, session):
+        """
+        Return the TropoApp for a Session, or None if no app claims it.
+        """
+        application_id = getattr(session, 'applicationId', None)
+        if application_id is not None:
+            app = self._by_application_id.get(str(application_id))
+            if app is not None:
+                return app
+        to = getattr(session, 'to', None)
+        if to is not None:
+            to = to.get('id')
+        if to:
+            app = self._by_address.get(_address_key(to))
+            if app is not None:
+                return app
+        account_id = getattr(session, 'accountId', None)
+        if account_id is not None:
+            return self._by_account_id.get(str(account_id))
+        return None
+
+    def loaded(self):
+        """
+        Return the names of the apps whose handlers have been imported.
+        """
+        return sorted(name for name, app in self.apps.items() if app.loaded)
+
+
+class LRUCache(object):
+    """
+    A dict bounded to max_size entries, least recently used dropped first,
+    whose entries expire ttl seconds after they're stored.  Expired entries
+    aren't returned by get() but stay until evicted, so get_stale() can
+    still serve them.  Safe to share between threads.
+    """
+    def __init__(self, max_size=10000, ttl=300.0, clock=time.time):
+        from collections import OrderedDict
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        self._lock = allocate_lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _lookup(self, key):
+        # called with the lock held; returns (value, expires) or None
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._entries[key] = entry
+        return entry
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._lookup(key)
+            if entry is None or entry[1] <= self.clock():
+                self.misses += 1
+                return default
+            self.hits += 1
+            return entry[0]
+
+    def get_stale(self, key, default=None):
+        """
+        Return the value stored for key even if it has expired.
+        """
+        with self._lock:
+            entry = self._lookup(key)
+        if entry is None:
+            return default
+        return entry[0]
+
+    def put(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            entries = self._entries
+            entries.pop(key, None)
+            entries[key] = (value, self.clock() + ttl)
+            while len(entries) > self.max_size:
+                entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self._entries), 'max_size': self.max_size, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+
+def webhook_key(body):
+    """
+    Return the key that identifies a webhook delivery: ('result', sessionId,
+    sequence) for a Result, ('session', id) for a new Session, or None if
+    body is neither.  Tropo sends the same body again when it retries.
+    """
+    try:
+        data = jsonlib.loads(body)
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    result = data.get('result')
+    if isinstance(result, dict) and result.get('sessionId') is not None:
+        return ('result', result['sessionId'], result.get('sequence'))
+    session = data.get('session')
+    if isinstance(session, dict) and session.get('id') is not None:
+        return ('session', session['id'])
+    return None
+
+
+class WebhookDeduplicator(object):
+    """
+    Makes webhook handlers idempotent.  Tropo retries a webhook that times
+    out, so a slow handler can run twice for the same step; with this in
+    front, the retry gets the response the first run rendered and the
+    handler isn't run again.
+
+        dedup = WebhookDeduplicator()
+        json = dedup.respond(self.request.body, handle_recording)
+
+    or, around a WSGI application,
+
+        application = WebhookDeduplicator().middleware(application)
+
+    Deliveries are matched with webhook_key().  Responses are kept in an
+    LRUCache of max_size entries for ttl seconds.  A retry that arrives
+    while the first run is still going waits up to wait_timeout seconds for
+    its response.  Responses are only cached when the handler returns
+    (and, for the middleware, with a 2xx status).
+    """
+    def __init__(self, max_size=10000, ttl=300.0, wait_timeout=10.0):
+        self.cache = LRUCache(max_size, ttl)
+        self.wait_timeout = wait_timeout
+        self._in_flight = {}
+        self._lock = allocate_lock()
+        self.handled = 0
+        self.replayed = 0
+
+    def respond(self, body, handler, *args, **kwargs):
+        """
+        Return handler(body, *args, **kwargs), or the response it returned
+        for an earlier delivery of the same webhook.
+        """
+        key = webhook_key(body)
+        if key is None:
+            return handler(body, *args, **kwargs)
+        return self._respond(key, lambda: handler(body, *args, **kwargs))
+
+    def _respond(self, key, run):
+        while True:
+            response = self.cache.get(key)
+            if response is not None:
+                with self._lock:
+                    self.replayed += 1
+                return response
+            with self._lock:
+                running = self._in_flight.get(key)
+                if running is None:
+                    running = self._in_flight[key] = threading.Event()
+                    break
+            # a delivery of the same webhook is being handled; take its
+            # response, or handle this one if it failed or took too long
+            if not running.wait(self.wait_timeout):
+                return run()
+        try:
+            response = run()
+            if response is not None:
+                self.cache.put(key, response)
+            with self._lock:
+                self.handled += 1
+            return response
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            running.set()
+
+    def middleware(self, app):
+        """
+        Wrap a WSGI application so repeated webhook POSTs are answered
+        from the cache.  Only requests with a JSON Content-Type and a
+        Content-Length are looked at.
+        """
+        def deduplicated(environ, start_response):
+            # only JSON bodies of known length are read here; anything else,
+            # such as a recording upload or a chunked body, goes to the app
+            # untouched
+            if 'json' not in environ.get('CONTENT_TYPE', '').lower():
+                return app(environ, start_response)
+            try:
+                length = int(environ['CONTENT_LENGTH'])
+            except (KeyError, ValueError):
+                return app(environ, start_response)
+            body = environ['wsgi.input'].read(length)
+            environ['wsgi.input'] = io.BytesIO(body)
+            key = webhook_key(body.decode('utf-8', 'replace'))
+            if key is None:
+                return app(environ, start_response)
+            def run():
+                captured = []
+                def capture(status, headers, exc_info=None):
+                    captured[:] = [status, headers]
+                    return lambda data: chunks.append(data)
+                chunks = []
+                result = app(environ, capture)
+                try:
+                    chunks.extend(result)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+                status, headers = captured
+                response = (status, headers, b''.join(chunks))
+                if not status.startswith('2'):
+                    # still answer this request, but don't cache it
+                    raise _UncachedResponse(response)
+                return response
+            try:
+                status, headers, data = self._respond(key, run)
+            except _UncachedResponse as e:
+                status, headers, data = e.response
+            start_response(status, headers)
+            return [data]
+        return deduplicated
+
+    def stats(self):
+        """
+        Return a dict of counters: handled, replayed, in_flight and the
+        cache's size, hits, misses and evictions.
+        """
+        stats = self.cache.stats()
+        with self._lock:
+            stats.update(handled=self.handled, replayed=self.replayed,
+                         in_flight=len(self._in_flight))
+        return stats
+
+
+class _UncachedResponse(Exception):
+    def __init__(self, response):
+        Exception.__init__(self)
+        self.response = response
+
+
+class CircuitOpenError(RuntimeError):
+    """
+    Raised by CachedLookup.get() when the upstream is failing and there is
+    neither a stale value nor a fallback to serve.
+    """
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling an upstream that keeps failing.  After failure_threshold
+    failures in a row the breaker opens and allow() returns False for
+    reset_timeout seconds; then one call is let through (half open) and
+    its outcome closes or reopens the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._lock = allocate_lock()
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self.clock() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.trips += 1
+                self.state = self.OPEN
+                self.opened_at = self.clock()
+
+
+class _PendingLookup(object):
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+_MISSING = object()
+
+class CachedLookup(object):
+    """
+    Wraps a slow or unreliable lookup, such as a weather API called from a
+    webhook handler, with a cache and a circuit breaker.
+
+        def fetch_weather(zip):
+            ...
+        weather = CachedLookup(fetch_weather, ttl=600, timeout=3,
+                               fallback="Weather information is not available right now.")
+        tropo.say(weather.get(zip))
+
+    Values are cached for ttl seconds per key (at most max_size keys).
+    Concurrent misses for the same key share one call to fetch.  With
+    timeout, callers wait at most that many seconds for fetch; a late
+    answer is still cached for the next caller.  When fetch fails or times
+    out, or the breaker (failure_threshold, reset_timeout) is open, get()
+    returns the expired value for the key if there is one, else fallback
+    (called with the key if it is callable), else raises: the fetch error,
+    or CircuitOpenError.
+
+    stats() returns the counters, the cache's and the breaker's state.
+    """
+    def __init__(self, fetch, ttl=300.0, max_size=10000, timeout=None, fallback=_MISSING,
+                 failure_threshold=5, reset_timeout=30.0, clock=time.time):
+        self.fetch = fetch
+        self.timeout = timeout
+        self.fallback = fallback
+        self.cache = LRUCache(max_size, ttl, clock)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout, clock)
+        self._pending = {}
+        self._lock = allocate_lock()
+        self.fetches = 0
+        self.failures = 0
+        self.coalesced = 0
+        self.stale_served = 0
+        self.fallbacks_served = 0
+
+    def get(self, key):
+        value = self.cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if not self.breaker.allow():
+            return self._degraded(key, None)
+        with self._lock:
+            pending = self._pending.get(key)
+            leader = pending is None
+            if leader:
+                pending = self._pending[key] = _PendingLookup()
+                self.fetches += 1
+            else:
+                self.coalesced += 1
+        if leader:
+            if self.timeout is None:
+                self._run(key, pending)
+            else:
+                worker = threading.Thread(target=self._run, args=(key, pending),
+                                          name="tropo-lookup")
+                worker.daemon = True
+                worker.start()
+        if not pending.done.wait(self.timeout):
+            if leader:
+                with self._lock:
+                    self.failures += 1
+                self.breaker.record_failure()
+            return self._degraded(key, None)
+        if pending.error is not None:
+            return self._degraded(key, pending.error)
+        return pending.value
+
+    def _run(self, key, pending):
+        try:
+            pending.value = self.fetch(key)
+        except Exception as e:
+            pending.error = e
+            logging.warning("lookup of %r failed: %s", key, e)
+            with self._lock:
+                self.failures += 1
+            self.breaker.record_failure()
+        else:
+            self.cache.put(key, pending.value)
+            self.breaker.record_success()
+        finally:
+            with self._lock:
+                del self._pending[key]
+            pending.done.set()
+
+    def _degraded(self, key, error):
+        value = self.cache.get_stale(key, _MISSING)
+        if value is not _MISSING:
+            with self._lock:
+                self.stale_served += 1
+            return value
+        if self.fallback is not _MISSING:
+            with self._lock:
+                self.fallbacks_served += 1
+            if callable(self.fallback):
+                return self.fallback(key)
+            return self.fallback
+        if error is not None:
+            raise error
+        raise CircuitOpenError("lookup of %r is unavailable" % (key,))
+
+    def stats(self):
+        """
+        Return a dict of fetches, failures, coalesced, stale_served and
+        fallbacks_served counts, the breaker state and trips, and the
+        cache's size, hits, misses and evictions.
+        """
+        stats = self.cache.stats()
+        with self._lock:
+            stats.update(fetches=self.fetches, failures=self.failures, coalesced=self.coalesced,
+                         stale_served=self.stale_served, fallbacks_served=self.fallbacks_served,
+                         pending=len(self._pending))
+        stats.update(breaker=self.breaker.state, breaker_trips=self.breaker.trips)
+        return stats
+
+
+BUSY_MESSAGE = "We're sorry, all of our lines are busy. Please call back later."
+
+def request_start_time(environ):
+    """
+    Return when a front-end proxy received the request, from its
+    X-Request-Start header ("t=1262304000123" or "1262304000.123"; seconds,
+    milliseconds or microseconds since the epoch), or None.
+    """
+    value = environ.get('HTTP_X_REQUEST_START')
+    if not value:
+        return None
+    if value.startswith('t='):
+        value = value[2:]
+    try:
+        start = float(value)
+    except ValueError:
+        return None
+    if start > 1e14:
+        return start / 1e6
+    if start > 1e11:
+        return start / 1e3
+    return start
+
+
+class AdmissionController(object):
+    """
+    Load shedding for a webhook server.  Once max_in_flight webhooks are
+    being handled, or a request has waited longer than max_queue_delay
+    seconds before reaching the application (going by request_start, which
+    defaults to request_start_time()), further webhooks are answered at
+    once with a fallback document instead of being handed to the
+    application.
+
+        application = AdmissionController(max_in_flight=50, max_queue_delay=2.0).middleware(application)
+
+    fallback is sent to calls already in progress; by default it says
+    BUSY_MESSAGE and hangs up.  new_session_fallback, if given, is sent
+    instead to webhooks starting a new session; a Tropo with a reject() is
+    the usual choice.  Both are rendered and encoded once, here, so shedding
+    a request costs no more than writing out those bytes.
+    """
+    def __init__(self, max_in_flight=100, max_queue_delay=None, fallback=None,
+                 new_session_fallback=None, request_start=request_start_time, clock=time.time):
+        if fallback is None:
+            fallback = Tropo()
+            fallback.say(BUSY_MESSAGE)
+            fallback.hangup()
+        self.max_in_flight = max_in_flight
+        self.max_queue_delay = max_queue_delay
+        self.fallback = self._encode(fallback)
+        if new_session_fallback is not None:
+            new_session_fallback = self._encode(new_session_fallback)
+        self.new_session_fallback = new_session_fallback
+        self.request_start = request_start
+        self.clock = clock
+        self._lock = allocate_lock()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.admitted = 0
+        self.shed = 0
+        self.longest_queue_delay = 0.0
+
+    def _encode(self, document):
+        if isinstance(document, Tropo):
+            document = document.RenderJson(compact=True)
+        if not isinstance(document, bytes):
+            document = document.encode('utf-8')
+        return document
+
+    def admit(self, queue_delay=None):
+        """
+        Count a webhook in and return True, or return False if it should be
+        shed.  Every True must be followed by a release().
+        """
+        with self._lock:
+            if queue_delay is not None and queue_delay > self.longest_queue_delay:
+                self.longest_queue_delay = queue_delay
+            if self.in_flight >= self.max_in_flight or (
+                    self.max_queue_delay is not None and queue_delay is not None and
+                    queue_delay > self.max_queue_delay):
+                self.shed += 1
+                return False
+            self.in_flight += 1
+            self.admitted += 1
+            if self.in_flight > self.peak_in_flight:
+                self.peak_in_flight = self.in_flight
+            return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+    def fallback_for(self, body):
+        """
+        Return the fallback document (bytes) for a webhook body.
+        """
+        if self.new_session_fallback is not None and b'"session"' in body.lstrip()[:32]:
+            return self.new_session_fallback
+        return self.fallback
+
+    def middleware(self, app):
+        """
+        Wrap a WSGI application with admission control.
+        """
+        def controlled(environ, start_response):
+            queue_delay = None
+            started = self.request_start(environ)
+            if started is not None:
+                queue_delay = max(0.0, self.clock() - started)
+            if not self.admit(queue_delay):
+                body = b''
+                if self.new_session_fallback is not None:
+                    try:
+                        length = int(environ.get('CONTENT_LENGTH') or 0)
+                    except ValueError:
+                        length = 0
+                    body = environ['wsgi.input'].read(length)
+                document = self.fallback_for(body)
+                start_response('200 OK', [('Content-Type', 'application/json'),
+                                          ('Content-Length', str(len(document)))])
+                return [document]
+            try:
+                # read the response here, so the webhook counts as in
+                # flight until it has been produced
+                result = app(environ, start_response)
+                try:
+                    return list(result)
+                finally:
+                    if hasattr(result, 'close'):
+                        result.close()
+            finally:
+                self.release()
+        return controlled
+
+    def stats(self):
+        """
+        Return a dict of in_flight, peak_in_flight, admitted and shed
+        counts and the longest queue delay seen.
+        """
+        with self._lock:
+            return {'in_flight': self.in_flight, 'peak_in_flight': self.peak_in_flight,
+                    'max_in_flight': self.max_in_flight, 'admitted': self.admitted,
+                    'shed': self.shed, 'longest_queue_delay': self.longest_queue_delay}
+
+
+class DeferredTask(object):
+    """
+    A unit of work handed to a DeferredExecutor: a callable, its arguments,
+    when it was queued and how many times it has been tried.
+    """
+    __slots__ = ('id', 'fn', 'args', 'kwargs', 'queued_at', 'attempts')
+
+    def __init__(self, id, fn, args, kwargs):
+        self.id = id
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.queued_at = time.time()
+        self.attempts = 0
+
+    def __getstate__(self):
+        return (self.id, self.fn, self.args, self.kwargs, self.queued_at, self.attempts)
+
+    def __setstate__(self, state):
+        self.id, self.fn, self.args, self.kwargs, self.queued_at, self.attempts = state
+
+
+class DeferredExecutor(object):
+    """
+    Runs work a webhook handler hands off with defer(), so the handler can
+    return its Tropo document without waiting for slow side effects such as
+    an S3 upload or an outbound HTTP call.
+
+    Tasks run on max_workers threads, started on the first defer().  At most
+    max_queue tasks wait at once; beyond that defer() raises queue.Full.  A
+    task that raises is retried up to max_attempts times in all, waiting
+    retry_delay seconds before the first retry and twice as long before each
+    one after that.
+
+    If spool_dir is given, each task is pickled there until it finishes, and
+    recover() queues whatever a previous process left behind.  Spooled tasks
+    must be picklable: module-level functions, not lambdas or bound methods
+    of request handlers.  Tasks that use up their attempts are left in the
+    spool with a .failed suffix.
+
+    stats() reports queue depth, lag and counters for monitoring.
+
+    The worker threads have to outlive the request that deferred the work,
+    so this is for long-running server processes.  Runtimes that don't let
+    background threads outlive a request, such as App Engine's classic
+    python runtime, would lose the work.
+    """
+    def __init__(self, max_workers=4, max_queue=1000, max_attempts=3,
+                 retry_delay=1.0, spool_dir=None):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.spool_dir = spool_dir
+        self._queue = queue.Queue(max_queue)
+        self._lock = threading.Lock()
+        self._workers = []
+        self._timers = set()
+        # ids of the tasks queued, running or waiting to be retried here
+        self._pending = set()
+        self._next_id = 0
+        self._shutdown = False
+        self._running = 0
+        self._completed = 0
+        self._failed = 0
+        self._retried = 0
+        self._max_lag = 0.0
+
+    def defer(self, fn, *args, **kwargs):
+        """
+        Queue fn(*args, **kwargs) to run in the background.
+        Returns the task id.
+        """
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError("DeferredExecutor has been shut down")
+            self._next_id += 1
+            task_id = "%d-%d-%d" % (os.getpid(), int(time.time() * 1000), self._next_id)
+            self._pending.add(task_id)
+        task = DeferredTask(task_id, fn, args, kwargs)
+        if self.spool_dir is not None:
+            self._spool(task)
+        try:
+            self._queue.put(task, False)
+        except queue.Full:
+            self._unspool(task)
+            with self._lock:
+                self._pending.discard(task_id)
+            raise
+        self._start_workers()
+        return task_id
+
+    def recover(self):
+        """
+        Queue the tasks found in spool_dir, other than those this executor
+        already has.  Returns how many were queued.  Once the queue is full
+        the rest are left in the spool for a later recover().
+        """
+        if self.spool_dir is None or not os.path.isdir(self.spool_dir):
+            return 0
+        # workers first, so the queue drains while the spool is read
+        self._start_workers()
+        count = 0
+        for name in sorted(os.listdir(self.spool_dir)):
+            if not name.endswith('.task'):
+                continue
+            with self._lock:
+                if name[:-len('.task')] in self._pending:
+                    continue
+            path = os.path.join(self.spool_dir, name)
+            try:
+                with open(path, 'rb') as f:
+                    task = pickle.load(f)
+            except Exception:
+                # unless it finished since the directory was listed
+                if os.path.exists(path):
+                    logging.exception("could not load deferred task %s" % path)
+                continue
+            with self._lock:
+                if task.id in self._pending:
+                    continue
+                self._pending.add(task.id)
+            try:
+                self._queue.put(task, False)
+            except queue.Full:
+                with self._lock:
+                    self._pending.discard(task.id)
+                break
+            count += 1
+        return count
+
+    def stats(self):
+        """
+        Return a dict of queue depth, running and finished task counts, and
+        the lag (in seconds) between queueing a task and starting it: the
+        age of the oldest waiting task, and the worst lag seen so far.
+        """
+        with self._queue.mutex:
+            waiting = list(self._queue.queue)
+        now = time.time()
+        lag = 0.0
+        if waiting:
+            lag = now - min(task.queued_at for task in waiting)
+        with self._lock:
+            return {'queued': len(waiting),
+                    'scheduled_retries': len(self._timers),
+                    'running': self._running,
+                    'completed': self._completed,
+                    'failed': self._failed,
+                    'retried': self._retried,
+                    'lag': lag,
+                    'max_lag': max(self._max_lag, lag),
+                    'workers': len(self._workers)}
+
+    def join(self, timeout=None):
+        """
+        Wait until every queued task (not counting pending retries) is done.
+        """
+        if timeout is None:
+            self._queue.join()
+            return True
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self._queue.all_tasks_done:
+                if not self._queue.unfinished_tasks:
+                    return True
+            time.sleep(0.01)
+        return False
+
+    def shutdown(self, wait=True):
+        """
+        Stop accepting work.  With wait, run what is queued and then stop
+        the workers; pending retries are cancelled, but stay in the spool.
+        """
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._workers)
+            timers = list(self._timers)
+            self._timers.clear()
+        for timer in timers:
+            timer.cancel()
+        for worker in workers:
+            self._queue.put(None)
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _start_workers(self):
+        with self._lock:
+            while len(self._workers) < self.max_workers and not self._shutdown:
+                worker = threading.Thread(target=self._work, name="tropo-deferred-%d" % len(self._workers))
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                self._run(task)
+            finally:
+                self._queue.task_done()
+
+    def _run(self, task):
+        lag = time.time() - task.queued_at
+        with self._lock:
+            self._running += 1
+            if lag > self._max_lag:
+                self._max_lag = lag
+        task.attempts += 1
+        try:
+            task.fn(*task.args, **task.kwargs)
+        except Exception:
+            logging.exception("deferred task %s failed (attempt %d of %d)"
+                              % (task.id, task.attempts, self.max_attempts))
+            with self._lock:
+                self._running -= 1
+            self._retry(task)
+        else:
+            # out of the spool before it stops being pending, or recover()
+            # could find it there and run it again
+            self._unspool(task)
+            with self._lock:
+                self._running -= 1
+                self._completed += 1
+                self._pending.discard(task.id)
+
+    def _retry(self, task):
+        if task.attempts >= self.max_attempts:
+            self._unspool(task, failed=True)
+            with self._lock:
+                self._failed += 1
+                self._pending.discard(task.id)
+            return
+        if self.spool_dir is not None:
+            self._spool(task)
+        delay = self.retry_delay * (2 ** (task.attempts - 1))
+        timer = threading.Timer(delay, self._requeue, (task,))
+        timer.daemon = True
+        with self._lock:
+            if self._shutdown:
+                return
+            self._retried += 1
+            self._timers.add(timer)
+        timer.start()
+
+    def _requeue(self, task):
+        with self._lock:
+            self._timers.discard(threading.current_thread())
+            if self._shutdown:
+                return
+        task.queued_at = time.time()
+        self._queue.put(task)
+
+    def _spool_path(self, task):
+        return os.path.join(self.spool_dir, "%s.task" % task.id)
+
+    def _spool(self, task):
+        if not os.path.isdir(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        path = self._spool_path(task)
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump(task, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+    def _unspool(self, task, failed=False):
+        if self.spool_dir is None:
+            return
+        path = self._spool_path(task)
+        try:
+            if failed:
+                os.rename(path, path + '.failed')
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+_deferred_executor = None
+_deferred_lock = allocate_lock()
+
+def configure_deferred(**options):
+    """
+    Replace the executor used by defer() with one built from options (see
+    DeferredExecutor).  The previous executor finishes its queued work.
+    """
+    global _deferred_executor
+    with _deferred_lock:
+        previous = _deferred_executor
+        _deferred_executor = DeferredExecutor(**options)
+    if previous is not None:
+        previous.shutdown(wait=False)
+    return _deferred_executor
+
+def get_deferred_executor():
+    """
+    Return the executor used by defer(), creating a default one if needed.
+    """
+    global _deferred_executor
+    if _deferred_executor is None:
+        with _deferred_lock:
+            if _deferred_executor is None:
+                _deferred_executor = DeferredExecutor()
+    return _deferred_executor
+
+def defer(fn, *args, **kwargs):
+    """
+    Run fn(*args, **kwargs) in the background after the handler returns.
+
+        @post('/recording')
+        def recording(request):
+            defer(put_in_s3, request.POST['filename'])
+            tropo = Tropo()
+            tropo.say("Thanks, got it.")
+            return tropo.RenderJson()
+    """
+    return get_deferred_executor().defer(fn, *args, **kwargs)
+
 if __name__ == '__main__':
     print ("""
 
@@ -12,83 +12,175 @@
 # edited to work with Google App Engine - Maciej Ceglowski 
 
 import base64
+import calendar
+import errno
+import hashlib
 import hmac
-import httplib
 import re
-import sha
 import sys
+import threading
 import time
-import urllib
-import urlparse
 import xml.sax
-from google.appengine.api.urlfetch import * 
+from array import array
+from xml.parsers import expat
+from multiprocessing.pool import ThreadPool
+
+try:
+    import httplib
+    import urlparse
+    from urllib import quote_plus
+except ImportError:
+    import http.client as httplib
+    import urllib.parse as urlparse
+    from urllib.parse import quote_plus
+
+try:
+    from google.appengine.api.urlfetch import *
+except ImportError:
+    fetch = None
 
 DEFAULT_HOST = 's3.amazonaws.com'
 PORTS_BY_SECURITY = { True: 443, False: 80 }
 METADATA_PREFIX = 'x-amz-meta-'
 AMAZON_HEADER_PREFIX = 'x-amz-'
-
-# generates the aws canonical string for the given parameters
-def canonical_string(method, bucket="", key="", query_args={}, headers={}, expires=None):
-    interesting_headers = {}
+# regional endpoints whose names don't follow s3-<location>.amazonaws.com
+REGION_HOSTS = { 'EU': 's3-eu-west-1.amazonaws.com' }
+# how much of a streamed response body is read off the socket at a time
+READ_CHUNK_SIZE = 16384
+# how many redirects a request may follow before giving up
+MAX_REDIRECTS = 5
+
+# 64-bit signed integer array type; python 2 has no 'q', but its 'l' is
+# 64 bits wide on the platforms App Engine runs on
+try:
+    array('q')
+    INT64_TYPECODE = 'q'
+except ValueError:
+    INT64_TYPECODE = 'l'
+
+# sub-resources that take part in the canonical string, in precedence order
+SIGNED_SUBRESOURCES = ('acl', 'torrent', 'logging', 'location')
+
+# generates the header part of the aws canonical string: the method and
+# the signed headers, each on its own line
+def canonical_headers(method, headers={}, expires=None):
+    content_md5 = ''
+    content_type = ''
+    date = None
+    amz_headers = {}
     for header_key in headers:
         lk = header_key.lower()
-        if lk in ['content-md5', 'content-type', 'date'] or lk.startswith(AMAZON_HEADER_PREFIX):
-            interesting_headers[lk] = headers[header_key].strip()
-
-    # these keys get empty strings if they don't exist
-    if not interesting_headers.has_key('content-type'):
-        interesting_headers['content-type'] = ''
-    if not interesting_headers.has_key('content-md5'):
-        interesting_headers['content-md5'] = ''
+        if lk == 'content-md5':
+            content_md5 = headers[header_key].strip()
+        elif lk == 'content-type':
+            content_type = headers[header_key].strip()
+        elif lk == 'date':
+            date = headers[header_key].strip()
+        elif lk.startswith(AMAZON_HEADER_PREFIX):
+            amz_headers[lk] = headers[header_key].strip()
 
     # just in case someone used this.  it's not necessary in this lib.
-    if interesting_headers.has_key('x-amz-date'):
-        interesting_headers['date'] = ''
+    if 'x-amz-date' in amz_headers:
+        date = ''
 
     # if you're using expires for query string auth, then it trumps date
     # (and x-amz-date)
     if expires:
-        interesting_headers['date'] = str(expires)
-
-    sorted_header_keys = interesting_headers.keys()
-    sorted_header_keys.sort()
+        date = str(expires)
+
+    # content-md5, content-type and date always sort ahead of the x-amz-
+    # headers, so only the (usually empty) amz set needs sorting
+    parts = [method, content_md5, content_type]
+    if date is not None:
+        parts.append(date)
+    if amz_headers:
+        for header_key in sorted(amz_headers):
+            parts.append("%s:%s" % (header_key, amz_headers[header_key]))
+    parts.append('')
+    return "\n".join(parts)
+
+# generates the sub-resource suffix of the canonical resource, if any
+def canonical_subresource(query_args={}):
+    for subresource in SIGNED_SUBRESOURCES:
+        if subresource in query_args:
+            return "?" + subresource
+    return ''
 
-    buf = "%s\n" % method
-    for header_key in sorted_header_keys:
-        if header_key.startswith(AMAZON_HEADER_PREFIX):
-            buf += "%s:%s\n" % (header_key, interesting_headers[header_key])
-        else:
-            buf += "%s\n" % interesting_headers[header_key]
-
-    # append the bucket if it exists
+# generates the aws canonical string for the given parameters
+def canonical_string(method, bucket="", key="", query_args={}, headers={}, expires=None):
+    # append the bucket if it exists.  add the key even if it doesn't exist,
+    # the slash is always there
     if bucket != "":
-        buf += "/%s" % bucket
-
-    # add the key.  even if it doesn't exist, add the slash
-    buf += "/%s" % urllib.quote_plus(key)
-
-    # handle special query string arguments
-
-    if query_args.has_key("acl"):
-        buf += "?acl"
-    elif query_args.has_key("torrent"):
-        buf += "?torrent"
-    elif query_args.has_key("logging"):
-        buf += "?logging"
-    elif query_args.has_key("location"):
-        buf += "?location"
-
-    return buf
+        resource = "/%s/%s" % (bucket, quote_plus(key))
+    else:
+        resource = "/%s" % quote_plus(key)
+
+    return canonical_headers(method, headers, expires) + resource + \
+           canonical_subresource(query_args)
+
+class HmacSigner:
+    """
+    Signs canonical strings with a secret access key.
+
+    The HMAC is keyed once, when the signer is created, and copied for every
+    signature instead of being rebuilt from the secret each time.
+    """
+    def __init__(self, aws_secret_access_key):
+        if not isinstance(aws_secret_access_key, bytes):
+            aws_secret_access_key = aws_secret_access_key.encode('utf-8')
+        self._hmac = hmac.new(aws_secret_access_key, digestmod=hashlib.sha1)
+
+    def sign(self, string_to_sign, urlencode=False):
+        if not isinstance(string_to_sign, bytes):
+            string_to_sign = string_to_sign.encode('utf-8')
+        mac = self._hmac.copy()
+        mac.update(string_to_sign)
+        b64_hmac = base64.b64encode(mac.digest()).decode('ascii')
+        if urlencode:
+            return quote_plus(b64_hmac)
+        else:
+            return b64_hmac
 
 # computes the base64'ed hmac-sha hash of the canonical string and the secret
 # access key, optionally urlencoding the result
 def encode(aws_secret_access_key, str, urlencode=False):
-    b64_hmac = base64.encodestring(hmac.new(aws_secret_access_key, str, sha).digest()).strip()
-    if urlencode:
-        return urllib.quote_plus(b64_hmac)
-    else:
-        return b64_hmac
+    return HmacSigner(aws_secret_access_key).sign(str, urlencode)
+
+class SignedURLCache:
+    """
+    Remembers signed URLs for the expiry value they were signed with.
+
+    Entries signed for an older expiry are dropped as soon as a URL with a
+    newer expiry is stored, so the cache only ever holds the current window.
+    """
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._expires = None
+        self._urls = {}
+
+    def get(self, expires, cache_key):
+        with self._lock:
+            if expires != self._expires:
+                return None
+            return self._urls.get(cache_key)
+
+    def put(self, expires, cache_key, url):
+        with self._lock:
+            if expires != self._expires:
+                self._expires = expires
+                self._urls = {}
+            elif len(self._urls) >= self.max_entries:
+                self._urls.clear()
+            self._urls[cache_key] = url
+
+    def clear(self):
+        with self._lock:
+            self._expires = None
+            self._urls = {}
+
+    def __len__(self):
+        return len(self._urls)
 
 def merge_meta(headers, metadata):
     final_headers = headers.copy()
@@ -104,7 +196,7 @@ def query_args_hash_to_string(query_args):
     for k, v in query_args.items():
         piece = k
         if v != None:
-            piece += "=%s" % urllib.quote_plus(str(v))
+            piece += "=%s" % quote_plus(str(v))
         pairs.append(piece)
 
     return '&'.join(pairs)
@@ -144,9 +236,174 @@ class Location:
 
 
 
+class S3ResponseError(Exception):
+    """
+    Raised by the iterating helpers when S3 answers with an error, since
+    there is no single Response object to hand back to the caller.
+    """
+    def __init__(self, response):
+        Exception.__init__(self, response.message)
+        self.response = response
+
+
+
+class HTTPResult:
+    """
+    A fully read HTTP response, shaped like an App Engine urlfetch result so
+    the Response classes work the same whichever transport produced it.
+    Header names are lower-cased.
+    """
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    # httplib-style aliases used by some of the Response classes
+    @property
+    def status(self):
+        return self.status_code
+
+    @property
+    def msg(self):
+        return self.headers
+
+
+class URLFetchTransport:
+    """
+    Sends requests through App Engine's urlfetch service.  urlfetch always
+    reads the whole body, so a consumer is handed it in one piece.
+    """
+    def request(self, method, is_secure, host, path, data, headers, consumer=None):
+        url = "%s://%s%s" % (is_secure and 'https' or 'http', host, path)
+        result = fetch(url, data, method, headers)
+        if consumer is not None and result.status_code < 300:
+            consumer(result.content)
+            result = HTTPResult(result.status_code, result.headers, b'')
+        return result
+
+
+# whether error, raised sending a request on a kept-alive connection, means
+# the server had already closed it: the request never got there, so it is
+# safe to send again
+def is_stale_connection_error(error):
+    if isinstance(error, httplib.BadStatusLine):    # includes RemoteDisconnected
+        return True
+    return getattr(error, 'errno', None) in (errno.ECONNRESET, errno.EPIPE)
+
+
+class PooledHTTPTransport:
+    """
+    Sends requests over httplib connections that are kept alive and reused.
+
+    Idle connections are pooled per (scheme, host); at most max_idle_per_host
+    are kept for each, anything beyond that is closed when it is released.
+    The pool is safe to share between threads.
+
+    If consumer is given, a successful (2xx) body is not buffered: it is
+    passed to consumer READ_CHUNK_SIZE bytes at a time as it is read off the
+    socket, and the result's content is left empty.
+    """
+    def __init__(self, max_idle_per_host=10, timeout=None):
+        self.max_idle_per_host = max_idle_per_host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._idle = {}
+
+    def request(self, method, is_secure, host, path, data, headers, consumer=None):
+        pool_key = (is_secure, host)
+        connection, reused = self._acquire(pool_key)
+        try:
+            try:
+                resp = self._send(connection, method, path, data, headers)
+            except (httplib.HTTPException, IOError):
+                # a pooled connection may have been closed by the server
+                # while it sat idle, so retry that once on a fresh one.
+                # anything else (a timeout, or a failure on a new
+                # connection) may have reached the server, so let it raise
+                if not reused or not is_stale_connection_error(sys.exc_info()[1]):
+                    raise
+                connection.close()
+                connection = self._connect(pool_key)
+                resp = self._send(connection, method, path, data, headers)
+        except:
+            connection.close()
+            raise
+
+        result_headers = {}
+        for name, value in resp.getheaders():
+            name = name.lower()
+            if name in result_headers:
+                result_headers[name] += ", " + value
+            else:
+                result_headers[name] = value
+        if consumer is not None and resp.status < 300:
+            try:
+                chunk = resp.read(READ_CHUNK_SIZE)
+                while chunk:
+                    consumer(chunk)
+                    chunk = resp.read(READ_CHUNK_SIZE)
+            except:
+                # the rest of the body is still on the connection
+                connection.close()
+                raise
+            content = b''
+        else:
+            content = resp.read()
+
+        if resp.will_close:
+            connection.close()
+        else:
+            self._release(pool_key, connection)
+        return HTTPResult(resp.status, result_headers, content)
+
+    def close(self):
+        with self._lock:
+            idle = self._idle
+            self._idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _send(self, connection, method, path, data, headers):
+        connection.request(method, path, data, headers)
+        return connection.getresponse()
+
+    def _acquire(self, pool_key):
+        with self._lock:
+            connections = self._idle.get(pool_key)
+            if connections:
+                return connections.pop(), True
+        return self._connect(pool_key), False
+
+    def _release(self, pool_key, connection):
+        with self._lock:
+            connections = self._idle.setdefault(pool_key, [])
+            if len(connections) < self.max_idle_per_host:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def _connect(self, pool_key):
+        is_secure, host = pool_key
+        if is_secure:
+            return httplib.HTTPSConnection(host, timeout=self.timeout)
+        else:
+            return httplib.HTTPConnection(host, timeout=self.timeout)
+
+
+def default_transport():
+    if fetch is not None:
+        return URLFetchTransport()
+    return PooledHTTPTransport()
+
+
 class AWSAuthConnection:
+    # by default, run at most this many put_many/get_many requests at once
+    DEFAULT_CONCURRENCY = 8
+
     def __init__(self, aws_access_key_id, aws_secret_access_key, is_secure=True,
-            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN):
+            server=DEFAULT_HOST, port=None, calling_format=CallingFormat.SUBDOMAIN,
+            transport=None):
 
         if not port:
             port = PORTS_BY_SECURITY[is_secure]
@@ -157,6 +414,12 @@ class AWSAuthConnection:
         self.server = server
         self.port = port
         self.calling_format = calling_format
+        self._signer = HmacSigner(aws_secret_access_key)
+        if transport is None:
+            transport = default_transport()
+        self.transport = transport
+        # bucket -> (is_secure, host) for buckets known to live elsewhere
+        self._endpoints = {}
 
     def create_bucket(self, bucket, headers={}):
         return Response(self._make_request('PUT', bucket, '', {}, headers))
@@ -174,7 +437,7 @@ class AWSAuthConnection:
         return self._make_request('HEAD', bucket, '', {}, {})
 
     def list_bucket(self, bucket, options={}, headers={}):
-        return ListBucketResponse(self._make_request('GET', bucket, '', options, headers))
+        return self._list_bucket(bucket, options, headers)
 
     def delete_bucket(self, bucket, headers={}):
         return Response(self._make_request('DELETE', bucket, '', {}, headers))
@@ -230,13 +493,119 @@ class AWSAuthConnection:
     def list_all_my_buckets(self, headers={}):
         return ListAllMyBucketsResponse(self._make_request('GET', '', '', {}, headers))
 
+    # besides returning the location, this records the bucket's regional
+    # endpoint so later requests for it skip the redirect from the default
+    # host.  only done when talking to the default host.
     def get_bucket_location(self, bucket):
-        return LocationResponse(self._make_request('GET', bucket, '', {'location' : None}))
+        response = LocationResponse(self._make_request('GET', bucket, '', {'location' : None}))
+        location = getattr(response, 'location', None)
+        if location and self.server == DEFAULT_HOST and bucket not in self._endpoints:
+            server = REGION_HOSTS.get(location, 's3-%s.amazonaws.com' % location)
+            if self.calling_format == CallingFormat.SUBDOMAIN:
+                server = "%s.%s" % (bucket, server)
+            elif self.calling_format == CallingFormat.VANITY:
+                server = bucket
+            self._endpoints[bucket] = (self.is_secure, "%s:%d" % (server, self.port))
+        return response
+
+    def clear_endpoints(self):
+        self._endpoints.clear()
+
+    # puts several objects at once.  items is a dict or an iterable of
+    # (key, object) pairs; the responses come back in the same order.
+    def put_many(self, bucket, items, headers={}, concurrency=DEFAULT_CONCURRENCY):
+        if isinstance(items, dict):
+            items = items.items()
+        return self._run_many(
+                lambda item: self.put(bucket, item[0], item[1], headers),
+                items, concurrency)
+
+    # gets several objects at once, returning the responses in key order.
+    def get_many(self, bucket, keys, headers={}, concurrency=DEFAULT_CONCURRENCY):
+        return self._run_many(
+                lambda key: self.get(bucket, key, headers),
+                keys, concurrency)
+
+    # walks every key in the bucket, following the list markers page by page.
+    # while the caller works through one page the next is already being
+    # fetched in the background, and only those two pages are ever held.
+    def iter_bucket(self, bucket, prefix='', options={}, headers={}, prefetch=True):
+        options = dict(options)
+        if prefix:
+            options['prefix'] = prefix
+
+        pool = None
+        if prefetch:
+            pool = ThreadPool(1)
+        try:
+            page = self.list_bucket(bucket, options, headers)
+            while page is not None:
+                if page.http_response.status_code >= 300:
+                    raise S3ResponseError(page)
+
+                # a truncated page may hold only common prefixes, so carry
+                # on for as long as there is a marker to carry on from
+                marker = page.next_page_marker()
+                pending = None
+                if marker is not None:
+                    options['marker'] = marker
+                    if pool is not None:
+                        pending = pool.apply_async(
+                                self.list_bucket, (bucket, dict(options), headers))
+
+                entries = page.entries
+                page = None
+                for entry in entries:
+                    yield entry
+                entries = None
+
+                if pending is not None:
+                    page = pending.get()
+                elif marker is not None:
+                    page = self.list_bucket(bucket, options, headers)
+        finally:
+            if pool is not None:
+                pool.terminate()
+
+    # lists every key in the bucket into a single ListingTable, following
+    # the list markers page by page.
+    def list_bucket_table(self, bucket, prefix='', options={}, headers={}):
+        options = dict(options)
+        if prefix:
+            options['prefix'] = prefix
+
+        table = ListingTable()
+        while True:
+            page = self._list_bucket(bucket, options, headers, table)
+            if page.http_response.status_code >= 300:
+                raise S3ResponseError(page)
+            marker = page.next_page_marker()
+            if marker is None:
+                return table
+            options['marker'] = marker
 
     # end public methods
 
-
-    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
+    # the listing is parsed as it streams in from the transport, rather than
+    # after the whole body has been read
+    def _list_bucket(self, bucket, options, headers, table=None):
+        parser = ListBucketParser(table)
+        http_response = self._make_request('GET', bucket, '', options, headers, consumer=parser.feed)
+        return ListBucketResponse(http_response, table, parser)
+
+    def _run_many(self, func, args, concurrency):
+        args = list(args)
+        if concurrency <= 1 or len(args) <= 1:
+            return [func(arg) for arg in args]
+        pool = ThreadPool(min(concurrency, len(args)))
+        try:
+            return pool.map(func, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    def _make_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={},
+                      consumer=None):
 
         server = ''
         if bucket == '':
@@ -255,7 +624,7 @@ class AWSAuthConnection:
 
         # add the slash after the bucket regardless
         # the key will be appended if it is non-empty
-        path += "/%s" % urllib.quote_plus(key)
+        path += "/%s" % quote_plus(key)
 
 
         # build the path_argument string
@@ -264,98 +633,58 @@ class AWSAuthConnection:
         if len(query_args):
             path += "?" + query_args_hash_to_string(query_args)
 
-        is_secure = self.is_secure
-        host = "%s:%d" % (server, self.port)
-        while True:
-          
-            final_headers = merge_meta(headers, metadata);
-            # add auth header
-            self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
-            resp = fetch("https://" + host + path,data,method,final_headers)
-            
-            
-            if resp.status_code < 300 or resp.status_code >= 400:
-                return resp
-            # handle redirect
-            try:
-                location = resp.headers['location']
-            except:
-                return resp
-            # (close connection)
-           # resp.read()
-            scheme, host, path, params, query, fragment \
-                    = urlparse.urlparse(location)
-            if scheme == "http":    is_secure = True
-            elif scheme == "https": is_secure = False
-            else: raise invalidURL("Not http/https: " + location)
-            if query: path += "?" + query
-            # retry with redirect
-            
-    def _xmake_request(self, method, bucket='', key='', query_args={}, headers={}, data='', metadata={}):
-
-        server = ''
-        if bucket == '':
-            server = self.server
-        elif self.calling_format == CallingFormat.SUBDOMAIN:
-            server = "%s.%s" % (bucket, self.server)
-        elif self.calling_format == CallingFormat.VANITY:
-            server = bucket
+        endpoint = None
+        if bucket != '':
+            endpoint = self._endpoints.get(bucket)
+        if endpoint is not None:
+            is_secure, host = endpoint
         else:
-            server = self.server
-
-        path = ''
-
-        if (bucket != '') and (self.calling_format == CallingFormat.PATH):
-            path += "/%s" % bucket
-
-        # add the slash after the bucket regardless
-        # the key will be appended if it is non-empty
-        path += "/%s" % urllib.quote_plus(key)
-
-
-        # build the path_argument string
-        # add the ? in all cases since 
-        # signature and credentials follow path args
-        if len(query_args):
-            path += "?" + query_args_hash_to_string(query_args)
-
-        is_secure = self.is_secure
-        host = "%s:%d" % (server, self.port)
+            is_secure = self.is_secure
+            host = "%s:%d" % (server, self.port)
+
+        final_headers = merge_meta(headers, metadata)
+        # add auth header.  the signature covers the bucket and key but not
+        # the host, so it stays valid when a redirect sends us elsewhere
+        self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
+        redirects = 0
         while True:
-            if (is_secure):
-                connection = httplib.HTTPSConnection(host)
+            if consumer is not None:
+                resp = self.transport.request(method, is_secure, host, path, data, final_headers, consumer)
             else:
-                connection = httplib.HTTPConnection(host)
+                resp = self.transport.request(method, is_secure, host, path, data, final_headers)
 
-            final_headers = merge_meta(headers, metadata);
-            # add auth header
-            self._add_aws_auth_header(final_headers, method, bucket, key, query_args)
-
-            connection.request(method, path, data, final_headers)
-            resp = connection.getresponse()
-            if resp.status < 300 or resp.status >= 400:
+            if resp.status_code < 300 or resp.status_code >= 400:
                 return resp
             # handle redirect
-            location = resp.getheader('location')
-            if not location:
+            try:
+                location = resp.headers['location']
+            except KeyError:
                 return resp
-            # (close connection)
-            resp.read()
+            redirects += 1
+            if redirects > MAX_REDIRECTS:
+                # endpoints redirecting to each other; don't keep sending
+                # the bucket's requests round the loop
+                if bucket != '':
+                    self._endpoints.pop(bucket, None)
+                raise httplib.HTTPException("more than %d redirects for %s" % (MAX_REDIRECTS, location))
             scheme, host, path, params, query, fragment \
                     = urlparse.urlparse(location)
-            if scheme == "http":    is_secure = True
-            elif scheme == "https": is_secure = False
-            else: raise invalidURL("Not http/https: " + location)
+            if scheme == "http":    is_secure = False
+            elif scheme == "https": is_secure = True
+            else: raise httplib.InvalidURL("Not http/https: " + location)
             if query: path += "?" + query
-            # retry with redirect
+            # remember where the bucket lives, so the next request for it
+            # goes straight there.  then retry with redirect
+            if bucket != '':
+                self._endpoints[bucket] = (is_secure, host)
 
     def _add_aws_auth_header(self, headers, method, bucket, key, query_args):
-        if not headers.has_key('Date'):
+        if 'Date' not in headers:
             headers['Date'] = time.strftime("%a, %d %b %Y %X GMT", time.gmtime())
 
         c_string = canonical_string(method, bucket, key, query_args, headers)
         headers['Authorization'] = \
-            "AWS %s:%s" % (self.aws_access_key_id, encode(self.aws_secret_access_key, c_string))
+            "AWS %s:%s" % (self.aws_access_key_id, self._signer.sign(c_string))
 
 
 class QueryStringAuthGenerator:
@@ -370,6 +699,7 @@ class QueryStringAuthGenerator:
 
         self.aws_access_key_id = aws_access_key_id
         self.aws_secret_access_key = aws_secret_access_key
+        self._signer = HmacSigner(aws_secret_access_key)
         if (is_secure):
             self.protocol = 'https'
         else:
@@ -381,6 +711,8 @@ class QueryStringAuthGenerator:
         self.calling_format = calling_format
         self.__expires_in = QueryStringAuthGenerator.DEFAULT_EXPIRES_IN
         self.__expires = None
+        self.__expires_window = None
+        self.__url_cache = None
 
         # for backwards compatibility with older versions
         self.server_name = "%s:%s" % (self.server, self.port)
@@ -393,6 +725,16 @@ class QueryStringAuthGenerator:
         self.__expires = expires
         self.__expires_in = None
 
+    # rounds relative expiry times up to a multiple of window seconds, so
+    # every URL generated inside one window shares its Expires value and can
+    # be served from the signed url cache.  a window of None turns this off.
+    def set_expires_window(self, window, max_entries=10000):
+        self.__expires_window = window
+        if window:
+            self.__url_cache = SignedURLCache(max_entries)
+        else:
+            self.__url_cache = None
+
     def create_bucket(self, bucket, headers={}):
         return self.generate_url('PUT', bucket, '', {}, headers)
 
@@ -445,42 +787,96 @@ class QueryStringAuthGenerator:
         full_url = self.generate_url(self, bucket, key)
         return full_url[:full_url.index('?')]
 
-    def generate_url(self, method, bucket='', key='', query_args={}, headers={}):
-        expires = 0
+    def _expires(self):
         if self.__expires_in != None:
             expires = int(time.time() + self.__expires_in)
+            if self.__expires_window:
+                window = self.__expires_window
+                expires = (expires // window + 1) * window
+            return expires
         elif self.__expires != None:
-            expires = int(self.__expires)
+            return int(self.__expires)
         else:
-            raise "Invalid expires state"
+            raise ValueError("Invalid expires state")
+
+    def generate_url(self, method, bucket='', key='', query_args={}, headers={}):
+        expires = self._expires()
+
+        url_cache = self.__url_cache
+        if url_cache is not None:
+            cache_key = (method, bucket, key,
+                         tuple(sorted(query_args.items())),
+                         tuple(sorted(headers.items())))
+            url = url_cache.get(expires, cache_key)
+            if url is not None:
+                return url
 
         canonical_str = canonical_string(method, bucket, key, query_args, headers, expires)
-        encoded_canonical = encode(self.aws_secret_access_key, canonical_str)
+        encoded_canonical = self._signer.sign(canonical_str)
 
         url = CallingFormat.build_url_base(self.protocol, self.server, self.port, bucket, self.calling_format)
 
-        url += "/%s" % urllib.quote_plus(key)
+        url += "/%s" % quote_plus(key)
+
+        signed_args = dict(query_args)
+        signed_args['Signature'] = encoded_canonical
+        signed_args['Expires'] = expires
+        signed_args['AWSAccessKeyId'] = self.aws_access_key_id
 
-        query_args['Signature'] = encoded_canonical
-        query_args['Expires'] = expires
-        query_args['AWSAccessKeyId'] = self.aws_access_key_id
+        url += "?%s" % query_args_hash_to_string(signed_args)
 
-        url += "?%s" % query_args_hash_to_string(query_args)
+        if url_cache is not None:
+            url_cache.put(expires, cache_key, url)
 
         return url
 
+    # signs urls for many keys of one bucket in a single pass.  the expiry
+    # (now + expires_in, or the generator's own setting) and everything in the
+    # string to sign apart from the key are worked out once.  nothing shared
+    # is modified, so this can be called from several threads at once.
+    def generate_urls(self, method, bucket, keys, expires_in=None, query_args={}, headers={}):
+        if expires_in is None:
+            expires = self._expires()
+        else:
+            expires = int(time.time() + expires_in)
+
+        sign = self._signer.sign
+        signed_headers = canonical_headers(method, headers, expires)
+        if bucket != "":
+            resource_base = "/%s/" % bucket
+        else:
+            resource_base = "/"
+        subresource = canonical_subresource(query_args)
+
+        url_base = CallingFormat.build_url_base(self.protocol, self.server, self.port, bucket, self.calling_format)
+        url_args = dict(query_args)
+        url_args['Expires'] = expires
+        url_args['AWSAccessKeyId'] = self.aws_access_key_id
+        url_args = query_args_hash_to_string(url_args)
+
+        urls = []
+        for key in keys:
+            quoted_key = quote_plus(key)
+            signature = sign(signed_headers + resource_base + quoted_key + subresource, True)
+            urls.append("%s/%s?%s&Signature=%s" % (url_base, quoted_key, url_args, signature))
+        return urls
+
 
 class S3Object:
     def __init__(self, data, metadata={}):
         self.data = data
         self.metadata = metadata
 
-class Owner:
+class Owner(object):
+    __slots__ = ('id', 'display_name')
+
     def __init__(self, id='', display_name=''):
         self.id = id
         self.display_name = display_name
 
-class ListEntry:
+class ListEntry(object):
+    __slots__ = ('key', 'last_modified', 'etag', 'size', 'storage_class', 'owner')
+
     def __init__(self, key='', last_modified=None, etag='', size=0, storage_class='', owner=None):
         self.key = key
         self.last_modified = last_modified
@@ -489,15 +885,103 @@ class ListEntry:
         self.storage_class = storage_class
         self.owner = owner
 
-class CommonPrefixEntry:
-    def __init(self, prefix=''):
+class CommonPrefixEntry(object):
+    __slots__ = ('prefix',)
+
+    def __init__(self, prefix=''):
         self.prefix = prefix
 
-class Bucket:
+class Bucket(object):
+    __slots__ = ('name', 'creation_date')
+
     def __init__(self, name='', creation_date=''):
         self.name = name
         self.creation_date = creation_date
 
+# converts an S3 timestamp such as 2010-01-01T00:00:00.000Z to epoch seconds
+def parse_timestamp(timestamp):
+    return calendar.timegm((
+            int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+            int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+            0, 0, 0))
+
+class ListingTable(object):
+    """
+    Column-oriented bucket listing.
+
+    Keys and etags are kept in lists, sizes and last-modified times (as
+    epoch seconds) in 64-bit integer arrays, so a listing of millions of keys
+    costs a few machine words per key rather than an object per key.  The
+    filtering methods scan a column and return a new table.
+    """
+    __slots__ = ('keys', 'etags', 'sizes', 'last_modified')
+
+    def __init__(self):
+        self.keys = []
+        self.etags = []
+        self.sizes = array(INT64_TYPECODE)
+        self.last_modified = array(INT64_TYPECODE)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def append(self, key, last_modified, etag, size):
+        self.keys.append(key)
+        self.etags.append(etag)
+        self.sizes.append(size)
+        self.last_modified.append(last_modified)
+
+    def append_entry(self, entry):
+        last_modified = entry.last_modified
+        if last_modified:
+            last_modified = parse_timestamp(last_modified)
+        else:
+            last_modified = 0
+        self.append(entry.key, last_modified, entry.etag, entry.size)
+
+    def entry(self, index):
+        return ListEntry(self.keys[index], self.last_modified[index],
+                         self.etags[index], self.sizes[index])
+
+    def total_size(self):
+        return sum(self.sizes)
+
+    def take(self, indexes):
+        table = ListingTable()
+        keys = self.keys
+        etags = self.etags
+        sizes = self.sizes
+        last_modified = self.last_modified
+        table.keys = [keys[i] for i in indexes]
+        table.etags = [etags[i] for i in indexes]
+        table.sizes = array(INT64_TYPECODE, [sizes[i] for i in indexes])
+        table.last_modified = array(INT64_TYPECODE, [last_modified[i] for i in indexes])
+        return table
+
+    def filter(self, min_size=None, max_size=None, modified_before=None, modified_after=None):
+        """
+        Returns the rows whose size falls in [min_size, max_size] and whose
+        last-modified time falls in [modified_after, modified_before).
+        Criteria left as None are not applied.
+        """
+        indexes = range(len(self.keys))
+        sizes = self.sizes
+        last_modified = self.last_modified
+        if min_size is not None:
+            indexes = [i for i in indexes if sizes[i] >= min_size]
+        if max_size is not None:
+            indexes = [i for i in indexes if sizes[i] <= max_size]
+        if modified_before is not None:
+            indexes = [i for i in indexes if last_modified[i] < modified_before]
+        if modified_after is not None:
+            indexes = [i for i in indexes if last_modified[i] >= modified_after]
+        return self.take(indexes)
+
+    def older_than(self, age, now=None):
+        if now is None:
+            now = time.time()
+        return self.filter(modified_before=now - age)
+
 class Response:
     def __init__(self, http_response):
         self.http_response = http_response
@@ -512,12 +996,17 @@ class Response:
 
 
 class ListBucketResponse(Response):
-    def __init__(self, http_response):
+    # when a ListingTable is given, the keys are appended to it and entries
+    # is left empty.  when a ListBucketParser is given, the transport has
+    # already streamed the body into it.
+    def __init__(self, http_response, table=None, parser=None):
         Response.__init__(self, http_response)
         if http_response.status_code < 300:
-#        if http_response.status < 300:
-            handler = ListBucketHandler()
-            xml.sax.parseString(self.body, handler)
+            handler = parser
+            if handler is None:
+                handler = ListBucketParser(table)
+            handler.feed(self.body)
+            handler.close()
             self.entries = handler.entries
             self.common_prefixes = handler.common_prefixes
             self.name = handler.name
@@ -527,9 +1016,25 @@ class ListBucketResponse(Response):
             self.delimiter = handler.delimiter
             self.max_keys = handler.max_keys
             self.next_marker = handler.next_marker
+            self.last_key = handler.last_key
         else:
             self.entries = []
 
+    # the marker to list the following page from, or None after the last
+    # page.  S3 only sends NextMarker for delimited listings; otherwise the
+    # next page starts after the last key or common prefix on this one.
+    def next_page_marker(self):
+        if not self.is_truncated:
+            return None
+        if self.next_marker:
+            return self.next_marker
+        marker = self.last_key
+        if self.common_prefixes:
+            marker = max(marker, self.common_prefixes[-1].prefix)
+        if not marker or marker <= self.marker:
+            return None
+        return marker
+
 class ListAllMyBucketsResponse(Response):
     def __init__(self, http_response):
         Response.__init__(self, http_response)
@@ -549,7 +1054,7 @@ class GetResponse(Response):
 
     def get_aws_metadata(self, headers):
         metadata = {}
-        for hkey in headers.keys():
+        for hkey in list(headers.keys()):
             if hkey.lower().startswith(METADATA_PREFIX):
                 metadata[hkey[len(METADATA_PREFIX):]] = headers[hkey]
                 del headers[hkey]
@@ -632,6 +1137,138 @@ class ListBucketHandler(xml.sax.ContentHandler):
         self.curr_text += content
 
 
+class ListBucketParser:
+    """
+    Incremental parser for ListBucketResult documents.
+
+    Unlike ListBucketHandler it can be fed the body a chunk at a time as it
+    arrives, collects character data in a list instead of concatenating it,
+    and looks closing tags up in a table instead of walking an elif chain.
+    The parsed values end up in the same attributes ListBucketHandler uses,
+    or, if a ListingTable is given, the keys are appended to it instead.
+    """
+    def __init__(self, table=None):
+        self.entries = []
+        self.table = table
+        self.common_prefixes = []
+        self.name = ''
+        self.marker = ''
+        self.prefix = ''
+        self.is_truncated = False
+        self.delimiter = ''
+        self.max_keys = 0
+        self.next_marker = ''
+        self.last_key = ''
+        self._curr_entry = None
+        self._curr_common_prefix = None
+        self._text = []
+
+        parser = expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self._start_element
+        parser.EndElementHandler = self._end_element
+        parser.CharacterDataHandler = self._text.append
+        self._parser = parser
+
+    def feed(self, data):
+        self._parser.Parse(data, False)
+
+    def close(self):
+        self._parser.Parse(b'', True)
+        self._parser = None
+
+    def _start_element(self, name, attrs):
+        del self._text[:]
+        if name == 'Contents':
+            self._curr_entry = ListEntry()
+        elif name == 'Owner':
+            self._curr_entry.owner = Owner()
+        elif name == 'CommonPrefixes':
+            self._curr_common_prefix = CommonPrefixEntry()
+
+    def _end_element(self, name):
+        handler = self._end_handlers.get(name)
+        if handler is not None:
+            handler(self, ''.join(self._text))
+        del self._text[:]
+
+    def _end_contents(self, text):
+        self.last_key = self._curr_entry.key
+        if self.table is not None:
+            self.table.append_entry(self._curr_entry)
+        else:
+            self.entries.append(self._curr_entry)
+        self._curr_entry = None
+
+    def _end_common_prefixes(self, text):
+        self.common_prefixes.append(self._curr_common_prefix)
+        self._curr_common_prefix = None
+
+    def _end_prefix(self, text):
+        if self._curr_common_prefix is not None:
+            self._curr_common_prefix.prefix = text
+        else:
+            self.prefix = text
+
+    def _end_key(self, text):
+        self._curr_entry.key = text
+
+    def _end_last_modified(self, text):
+        self._curr_entry.last_modified = text
+
+    def _end_etag(self, text):
+        self._curr_entry.etag = text
+
+    def _end_size(self, text):
+        self._curr_entry.size = int(text)
+
+    def _end_storage_class(self, text):
+        self._curr_entry.storage_class = text
+
+    def _end_id(self, text):
+        self._curr_entry.owner.id = text
+
+    def _end_display_name(self, text):
+        self._curr_entry.owner.display_name = text
+
+    def _end_name(self, text):
+        self.name = text
+
+    def _end_marker(self, text):
+        self.marker = text
+
+    def _end_is_truncated(self, text):
+        self.is_truncated = text == 'true'
+
+    def _end_delimiter(self, text):
+        self.delimiter = text
+
+    def _end_max_keys(self, text):
+        self.max_keys = int(text)
+
+    def _end_next_marker(self, text):
+        self.next_marker = text
+
+    _end_handlers = {
+        'Contents': _end_contents,
+        'CommonPrefixes': _end_common_prefixes,
+        'Prefix': _end_prefix,
+        'Key': _end_key,
+        'LastModified': _end_last_modified,
+        'ETag': _end_etag,
+        'Size': _end_size,
+        'StorageClass': _end_storage_class,
+        'ID': _end_id,
+        'DisplayName': _end_display_name,
+        'Name': _end_name,
+        'Marker': _end_marker,
+        'IsTruncated': _end_is_truncated,
+        'Delimiter': _end_delimiter,
+        'MaxKeys': _end_max_keys,
+        'NextMarker': _end_next_marker,
+    }
+
+
 class ListAllMyBucketsHandler(xml.sax.ContentHandler):
     def __init__(self):
         self.entries = []
@@ -650,8 +1287,10 @@ class ListAllMyBucketsHandler(xml.sax.ContentHandler):
         elif name == 'Bucket':
             self.entries.append(self.curr_entry)
 
+        self.curr_text = ''
+
     def characters(self, content):
-        self.curr_text = content
+        self.curr_text += content
 
 
 class LocationHandler(xml.sax.ContentHandler):
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+# An in-process stand-in for the parts of S3 that GoogleS3 talks to, for
+# running tests and benchmarks on a laptop with no network.
+#
+#     server = LocalS3Server()
+#     server.start()
+#     conn = server.connection()
+#     conn.create_bucket('recordings')
+#     conn.put('recordings', 'hello.wav', GoogleS3.S3Object(wav))
+#     ...
+#     server.stop()
+#
+# Supported: bucket create/head/delete/location, list all buckets, object
+# put/get/head/delete with x-amz-meta- headers, listing with prefix, marker,
+# max-keys and delimiter, multipart uploads, and ACLs (stored and echoed
+# back, never enforced).  Only path-style addressing is understood, so
+# connections must use CallingFormat.PATH.  Signatures are not checked.
+
+import bisect
+import hashlib
+import threading
+import time
+from xml.sax.saxutils import escape
+
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote_plus
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote_plus
+
+import GoogleS3
+
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+DEFAULT_MAX_KEYS = 1000
+OWNER_ID = 'bcaf1ffd86f41161ca5fb16fd081034f'
+OWNER_NAME = 'localS3'
+
+DEFAULT_ACL = ('<AccessControlPolicy xmlns="%s"><Owner><ID>%s</ID><DisplayName>%s</DisplayName></Owner>'
+               '<AccessControlList><Grant><Grantee xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+               'xsi:type="CanonicalUser"><ID>%s</ID><DisplayName>%s</DisplayName></Grantee>'
+               '<Permission>FULL_CONTROL</Permission></Grant></AccessControlList></AccessControlPolicy>'
+               % (S3_XMLNS, OWNER_ID, OWNER_NAME, OWNER_ID, OWNER_NAME))
+
+
+def iso_timestamp(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime(seconds))
+
+
+class StoredObject(object):
+    __slots__ = ('data', 'content_type', 'metadata', 'etag', 'last_modified', 'acl')
+
+    def __init__(self, data, content_type, metadata, acl=None):
+        self.data = data
+        self.content_type = content_type
+        self.metadata = metadata
+        self.etag = '"%s"' % hashlib.md5(data).hexdigest()
+        self.last_modified = time.time()
+        self.acl = acl
+
+
+class MultipartUpload(object):
+    __slots__ = ('content_type', 'metadata', 'parts')
+
+    def __init__(self, content_type, metadata):
+        self.content_type = content_type
+        self.metadata = metadata
+        self.parts = {}
+
+
+class StoredBucket(object):
+    """
+    A bucket's objects, with the key names also kept sorted for listing.
+    """
+    def __init__(self, location=''):
+        self.objects = {}
+        self.keys = []
+        self.uploads = {}
+        self.location = location
+        self.created = time.time()
+        self.acl = None
+
+    def put(self, key, obj):
+        if key not in self.objects:
+            bisect.insort(self.keys, key)
+        self.objects[key] = obj
+
+    def delete(self, key):
+        if key in self.objects:
+            del self.objects[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+
+    def list(self, prefix='', marker='', max_keys=DEFAULT_MAX_KEYS, delimiter=''):
+        """
+        Returns (keys, common prefixes, is truncated, next marker).
+        """
+        keys = self.keys
+        start = bisect.bisect_right(keys, marker)
+        if prefix:
+            start = max(start, bisect.bisect_left(keys, prefix))
+
+        contents = []
+        common_prefixes = []
+        next_marker = ''
+        i = start
+        while i < len(keys):
+            key = keys[i]
+            if not key.startswith(prefix):
+                break
+            if len(contents) + len(common_prefixes) >= max_keys:
+                return contents, common_prefixes, True, next_marker
+            if delimiter:
+                cut = key.find(delimiter, len(prefix))
+                if cut >= 0:
+                    common_prefix = key[:cut + len(delimiter)]
+                    # a prefix handed out as the marker was already listed
+                    if common_prefix > marker:
+                        common_prefixes.append(common_prefix)
+                        next_marker = common_prefix
+                    # skip the rest of the keys rolled up into this prefix
+                    i = bisect.bisect_left(keys, common_prefix[:-1] + chr(ord(common_prefix[-1]) + 1))
+                    continue
+            contents.append(key)
+            next_marker = key
+            i += 1
+        return contents, common_prefixes, False, ''
+
+
+class LocalS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "LocalS3/1.0"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch('GET')
+
+    def do_HEAD(self):
+        self.dispatch('HEAD')
+
+    def do_PUT(self):
+        self.dispatch('PUT')
+
+    def do_POST(self):
+        self.dispatch('POST')
+
+    def do_DELETE(self):
+        self.dispatch('DELETE')
+
+    def dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        self.body = self.rfile.read(length)
+        self.method = method
+
+        url = urlparse(self.path)
+        path = url.path.split('/', 2)
+        bucket = unquote_plus(path[1])
+        key = len(path) > 2 and unquote_plus(path[2]) or ''
+        query = dict((k, v[-1]) for k, v in parse_qs(url.query, keep_blank_values=True).items())
+
+        # the store is only touched under the lock; the response is written
+        # after it is released so slow clients don't hold up the others
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            location = bucket and server.redirects.get(bucket)
+            if location:
+                self.reply(307, headers={'Location': location + self.path})
+            elif not bucket:
+                self.list_all_my_buckets(bucket, key, query)
+            elif not key:
+                getattr(self, '%s_bucket' % method.lower())(bucket, key, query)
+            else:
+                getattr(self, '%s_object' % method.lower())(bucket, key, query)
+
+        status, body, headers = self.response
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(body)
+
+    # responses
+
+    def reply(self, status, body=b'', headers={}):
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        self.response = (status, body, headers)
+
+    def reply_xml(self, body, status=200):
+        self.reply(status, '<?xml version="1.0" encoding="UTF-8"?>' + body,
+                   {'Content-Type': 'application/xml'})
+
+    # echoes a stored ACL document back exactly as it was put
+    def reply_acl(self, acl):
+        if acl:
+            self.reply(200, acl, {'Content-Type': 'application/xml'})
+        else:
+            self.reply_xml(DEFAULT_ACL)
+
+    def error(self, status, code, message):
+        self.reply(status, '<?xml version="1.0" encoding="UTF-8"?><Error><Code>%s</Code>'
+                   '<Message>%s</Message><Resource>%s</Resource></Error>'
+                   % (code, escape(message), escape(self.path)),
+                   {'Content-Type': 'application/xml'})
+
+    def stored_bucket(self, bucket):
+        stored = self.server.buckets.get(bucket)
+        if stored is None:
+            self.error(404, 'NoSuchBucket', 'The specified bucket does not exist')
+        return stored
+
+    # buckets
+
+    def list_all_my_buckets(self, bucket, key, query):
+        if self.method != 'GET':
+            return self.error(405, 'MethodNotAllowed', 'The specified method is not allowed')
+        buckets = "".join(
+                '<Bucket><Name>%s</Name><CreationDate>%s</CreationDate></Bucket>'
+                % (escape(name), iso_timestamp(stored.created))
+                for name, stored in sorted(self.server.buckets.items()))
+        self.reply_xml('<ListAllMyBucketsResult xmlns="%s"><Owner><ID>%s</ID><DisplayName>%s</DisplayName>'
+                       '</Owner><Buckets>%s</Buckets></ListAllMyBucketsResult>'
+                       % (S3_XMLNS, OWNER_ID, OWNER_NAME, buckets))
+
+    def put_bucket(self, bucket, key, query):
+        buckets = self.server.buckets
+        if 'acl' in query:
+            stored = self.stored_bucket(bucket)
+            if stored is not None:
+                stored.acl = self.body
+                self.reply(200)
+            return
+        if bucket in buckets:
+            return self.reply(200)
+        location = ''
+        if self.body:
+            start = self.body.find(b'<LocationConstraint>')
+            end = self.body.find(b'</LocationConstraint>')
+            if start >= 0 and end > start:
+                location = self.body[start + len(b'<LocationConstraint>'):end].decode('utf-8')
+        buckets[bucket] = StoredBucket(location)
+        self.reply(200, headers={'Location': '/' + bucket})
+
+    def head_bucket(self, bucket, key, query):
+        if self.stored_bucket(bucket) is not None:
+            self.reply(200)
+
+    def delete_bucket(self, bucket, key, query):
+        stored = self.stored_bucket(bucket)
+        if stored is None:
+            return
+        if stored.objects:
+            return self.error(409, 'BucketNotEmpty', 'The bucket you tried to delete is not empty')
+        del self.server.buckets[bucket]
+        self.reply(204)
+
+    def post_bucket(self, bucket, key, query):
+        self.error(405, 'MethodNotAllowed', 'The specified method is not allowed')
+
+    def get_bucket(self, bucket, key, query):
+        stored = self.stored_bucket(bucket)
+        if stored is None:
+            return
+        if 'location' in query:
+            return self.reply_xml('<LocationConstraint xmlns="%s">%s</LocationConstraint>'
+                                  % (S3_XMLNS, escape(stored.location)))
+        if 'acl' in query:
+            return self.reply_acl(stored.acl)
+
+        prefix = query.get('prefix', '')
+        marker = query.get('marker', '')
+        delimiter = query.get('delimiter', '')
+        max_keys = int(query.get('max-keys', DEFAULT_MAX_KEYS))
+        keys, common_prefixes, is_truncated, next_marker = \
+            stored.list(prefix, marker, max_keys, delimiter)
+
+        parts = ['<ListBucketResult xmlns="%s"><Name>%s</Name><Prefix>%s</Prefix><Marker>%s</Marker>'
+                 % (S3_XMLNS, escape(bucket), escape(prefix), escape(marker))]
+        if is_truncated:
+            parts.append('<NextMarker>%s</NextMarker>' % escape(next_marker))
+        parts.append('<MaxKeys>%d</MaxKeys>' % max_keys)
+        if delimiter:
+            parts.append('<Delimiter>%s</Delimiter>' % escape(delimiter))
+        parts.append('<IsTruncated>%s</IsTruncated>' % (is_truncated and 'true' or 'false'))
+        objects = stored.objects
+        for key in keys:
+            obj = objects[key]
+            parts.append('<Contents><Key>%s</Key><LastModified>%s</LastModified><ETag>%s</ETag>'
+                         '<Size>%d</Size><Owner><ID>%s</ID><DisplayName>%s</DisplayName></Owner>'
+                         '<StorageClass>STANDARD</StorageClass></Contents>'
+                         % (escape(key), iso_timestamp(obj.last_modified), escape(obj.etag),
+                            len(obj.data), OWNER_ID, OWNER_NAME))
+        for common_prefix in common_prefixes:
+            parts.append('<CommonPrefixes><Prefix>%s</Prefix></CommonPrefixes>' % escape(common_prefix))
+        parts.append('</ListBucketResult>')
+        self.reply_xml("".join(parts))
+
+    # objects
+
+    def put_object(self, bucket, key, query):
+        stored = self.stored_bucket(bucket)
+        if stored is None:
+            return
+        if 'acl' in query:
+            obj = stored.objects.get(key)
+            if obj is None:
+                return self.error(404, 'NoSuchKey', 'The specified key does not exist.')
+            obj.acl = self.body
+            return self.reply(200)
+        if 'uploadId' in query:
+            upload = stored.uploads.get(query['uploadId'])
+            if upload is None:
+                return self.error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            part = StoredObject(self.body, None, None)
+            upload.parts[int(query['partNumber'])] = part
+            return self.reply(200, headers={'ETag': part.etag})
+
+        obj = StoredObject(self.body, self.headers.get('Content-Type'), self.metadata_headers())
+        stored.put(key, obj)
+        self.reply(200, headers={'ETag': obj.etag})
+
+    def post_object(self, bucket, key, query):
+        stored = self.stored_bucket(bucket)
+        if stored is None:
+            return
+        if 'uploads' in query:
+            self.server.upload_count += 1
+            upload_id = 'upload-%d' % self.server.upload_count
+            stored.uploads[upload_id] = MultipartUpload(
+                    self.headers.get('Content-Type'), self.metadata_headers())
+            return self.reply_xml('<InitiateMultipartUploadResult xmlns="%s"><Bucket>%s</Bucket>'
+                                  '<Key>%s</Key><UploadId>%s</UploadId></InitiateMultipartUploadResult>'
+                                  % (S3_XMLNS, escape(bucket), escape(key), upload_id))
+        if 'uploadId' in query:
+            # the part list in the request body is not checked; every
+            # uploaded part is joined in part number order
+            upload = stored.uploads.pop(query['uploadId'], None)
+            if upload is None:
+                return self.error(404, 'NoSuchUpload', 'The specified upload does not exist.')
+            parts = upload.parts
+            data = b"".join(parts[number].data for number in sorted(parts))
+            obj = StoredObject(data, upload.content_type, upload.metadata)
+            stored.put(key, obj)
+            return self.reply_xml('<CompleteMultipartUploadResult xmlns="%s"><Bucket>%s</Bucket>'
+                                  '<Key>%s</Key><ETag>%s</ETag></CompleteMultipartUploadResult>'
+                                  % (S3_XMLNS, escape(bucket), escape(key), escape(obj.etag)))
+        self.error(405, 'MethodNotAllowed', 'The specified method is not allowed')
+
+    def get_object(self, bucket, key, query):
+        stored = self.stored_bucket(bucket)
+        if stored is None:
+            return
+        obj = stored.objects.get(key)
+        if obj is None:
+            return self.error(404, 'NoSuchKey', 'The specified key does not exist.')
+        if 'acl' in query:
+            return self.reply_acl(obj.acl)
+        headers = dict(obj.metadata)
+        headers['ETag'] = obj.etag
+        headers['Last-Modified'] = time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(obj.last_modified))
+        if obj.content_type:
+            headers['Content-Type'] = obj.content_type
+        self.reply(200, obj.data, headers)
+
+    head_object = get_object
+
+    def delete_object(self, bucket, key, query):
+        stored = self.stored_bucket(bucket)
+        if stored is None:
+            return
+        if 'uploadId' in query:
+            stored.uploads.pop(query['uploadId'], None)
+        else:
+            stored.delete(key)
+        self.reply(204)
+
+    def metadata_headers(self):
+        metadata = {}
+        for name in self.headers.keys():
+            if name.lower().startswith(GoogleS3.METADATA_PREFIX):
+                metadata[name.lower()] = self.headers[name]
+        return metadata
+
+
+class LocalS3Server(ThreadingMixIn, HTTPServer):
+    """
+    The stand-in server.  Port 0 picks a free port; the chosen one is in
+    self.port once the server is created.
+
+    requests and connections count what the server has seen, which is
+    handy for checking connection reuse and redirect caching.
+    """
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), LocalS3Handler)
+        self.host, self.port = self.server_address[:2]
+        self.lock = threading.Lock()
+        self.buckets = {}
+        self.redirects = {}
+        self.requests = 0
+        self.connections = 0
+        self.upload_count = 0
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    # answers every request for the bucket with a redirect to location_base
+    # (e.g. 'http://127.0.0.1:8001'), the way S3 redirects requests for a
+    # bucket that lives in another region.
+    def redirect_bucket(self, bucket, location_base):
+        with self.lock:
+            self.redirects[bucket] = location_base
+
+    def connection(self, aws_access_key_id='local', aws_secret_access_key='local', **options):
+        options.setdefault('is_secure', False)
+        options.setdefault('calling_format', GoogleS3.CallingFormat.PATH)
+        if 'transport' not in options:
+            options['transport'] = GoogleS3.PooledHTTPTransport()
+        return GoogleS3.AWSAuthConnection(aws_access_key_id, aws_secret_access_key,
+                                          server=self.host, port=self.port, **options)
+
+
+if __name__ == '__main__':
+    import sys
+    port = len(sys.argv) > 1 and int(sys.argv[1]) or 8000
+    server = LocalS3Server(port=port)
+    print ("LocalS3 listening on http://%s:%d/" % (server.host, server.port))
+    server.serve_forever()
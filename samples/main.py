@@ -205,6 +205,36 @@ class TropoDemoContinue(webapp.RequestHandler):
     
 
 
+def fetch_weather(zip):
+    """
+    Look up the current conditions for a zip code, as a sentence for say.
+    """
+    google_weather_url = "%s?weather=%s&hl=en" % (GOOGLE_WEATHER_API_URL, zip)
+    logging.info ("weather url: %s " % google_weather_url)
+    resp = urlfetch.fetch(google_weather_url, deadline=3)
+    if (resp.status_code != 200):
+        raise IOError("weather service returned %d" % resp.status_code)
+    xml = resp.content
+    logging.info ("weather xml: %s " % xml)
+    doc = ElementTree.fromstring(xml)
+    logging.info ("doc: %s " % doc)
+    condition = doc.find("weather/current_conditions/condition").attrib['data']
+    temp_f  = doc.find("weather/current_conditions/temp_f").attrib['data']
+    wind_condition = doc.find("weather/current_conditions/wind_condition").attrib['data']
+    city = doc.find("weather/forecast_information/city").attrib['data']
+    logging.info ("condition: %s temp_f: %s wind_condition: %s city: %s" % (condition, temp_f, wind_condition, city))
+    # condition: Partly Cloudy temp_f: 73 wind_condition: Wind: NW at 10 mph city: Portsmouth, NH
+    temp = "%s degrees" % temp_f
+    wind = ciscotropowebapi.normalize_text (wind_condition)
+    return "Current city is %s . Weather conditions are %s. Temperature is %s. Winds are %s ." % (city, condition, temp, wind)
+
+# conditions change slowly; a failing weather service shouldn't hold up calls.
+# App Engine can't run the background thread a timeout needs, so slow fetches
+# are bounded by the urlfetch deadline and repeated failures by the breaker
+weather_lookup = ciscotropowebapi.CachedLookup(
+    fetch_weather, ttl=600, timeout=None,
+    fallback="Sorry, weather information is not available right now.")
+
 class Weather(webapp.RequestHandler):
     def post (self):
         json = self.request.body
@@ -212,39 +242,11 @@ class Weather(webapp.RequestHandler):
         tropo = tropo.Tropo()
         result = tropo.Result(json);
         zip = result.getValue()
-        google_weather_url = "%s?weather=%s&hl=en" % (GOOGLE_WEATHER_API_URL, zip)
-        resp = urlfetch.fetch(google_weather_url)
-
-        logging.info ("weather url: %s " % google_weather_url)
-        if (resp.status_code == 200):
-            xml = resp.content
-            logging.info ("weather xml: %s " % xml)
-            doc = ElementTree.fromstring(xml)            
-            logging.info ("doc: %s " % doc)
-            condition = doc.find("weather/current_conditions/condition").attrib['data']
-            temp_f  = doc.find("weather/current_conditions/temp_f").attrib['data']
-            wind_condition = doc.find("weather/current_conditions/wind_condition").attrib['data']
-            city = doc.find("weather/forecast_information/city").attrib['data']
-            logging.info ("condition: %s temp_f: %s wind_condition: %s city: %s" % (condition, temp_f, wind_condition, city))
-            tropo = tropo.Tropo()
-            # condition: Partly Cloudy temp_f: 73 wind_condition: Wind: NW at 10 mph city: Portsmouth, NH
-            temp = "%s degrees" % temp_f
-            wind = self.english_expand (wind_condition)
-            tropo.say("Current city is %s . Weather conditions are %s. Temperature is %s. Winds are %s ." % (city, condition, temp, wind))        
-            json = tropo.RenderJson()
-
-            self.response.out.write(json)
-
+        tropo = tropo.Tropo()
+        tropo.say(weather_lookup.get(zip))
+        json = tropo.RenderJson()
 
-    def english_expand(self, expr):
-        result = expr.replace("NW", "North West")
-        result = expr.replace("NE", "North East")
-        result = expr.replace("N", "North")
-        result = expr.replace("SW", "South West")
-        result = expr.replace("SE", "South East")
-        result = expr.replace("S", "South")
-        result = expr.replace("mph", "miles per hour")
-        return result
+        self.response.out.write(json)
 
 
 class ReceiveRecording(webapp.RequestHandler):
@@ -308,6 +310,10 @@ def main():
 
   ],
                                          debug=True)
+    # answer Tropo's retries of a slow webhook without running it twice
+    application = ciscotropowebapi.WebhookDeduplicator().middleware(application)
+    # during call storms, answer with a canned "call back later" instead
+    application = ciscotropowebapi.AdmissionController(max_in_flight=50).middleware(application)
     util.run_wsgi_app(application)
 
 
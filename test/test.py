@@ -14,10 +14,28 @@ except ImportError:
         except ImportError:
             import json as jsonlib
 
+import keyword
+import os
 import unittest
+import shutil
+import subprocess
 import sys
+import tempfile
+import threading
 sys.path = ['..'] + sys.path
 from ciscotropowebapi import Choices, Say, Tropo
+from ciscotropowebapi import DeferredExecutor, accepts_gzip
+from ciscotropowebapi import AppRegistry, CallFlow, Endpoint, ResultBatch, Session
+from ciscotropowebapi import LRUCache, WebhookDeduplicator, webhook_key
+from ciscotropowebapi import AdmissionController, request_start_time
+from ciscotropowebapi import CachedLookup, CircuitOpenError
+from ciscotropowebapi import SSML, SSMLSlot, TextNormalizer
+from ciscotropowebapi import BulkMessageGenerator
+from ciscotropowebapi import BloomFilter, BroadcastPlanner
+from ciscotropowebapi import PhoneNumberNormalizer
+import ciscotropowebapi
+import gzip
+import io
 
 
 class TestTropoPython(unittest.TestCase):
@@ -239,6 +257,94 @@ class TestTropoPython(unittest.TestCase):
         wanted_obj = jsonlib.loads(wanted_json)
         self.assertEqual(rendered_obj, wanted_obj)
 
+    def test_say_normalize(self):
+        """
+        Test the "say" Tropo class method with text normalization.
+        """
+        tropo = Tropo()
+        tropo.say(["Wind: NW at 10mph", "http://example.com/N.wav"], normalize=True)
+        tropo.say("Call (415) 555-0100", normalize=TextNormalizer(phone_numbers=False))
+        rendered_obj = jsonlib.loads(tropo.RenderJson())
+        wanted_json = '{"tropo": [{"say": [{"value": "Wind: North West at 10 miles per hour"}, {"value": "http://example.com/N.wav"}]}, {"say": {"value": "Call (415) 555-0100"}}]}'
+        self.assertEqual(rendered_obj, jsonlib.loads(wanted_json))
+
+    def test_text_normalizer(self):
+        """
+        Test TextNormalizer substitutions, phone numbers and digit groups.
+        """
+        normalize = TextNormalizer()
+        self.assertEqual(normalize(u"Dr. Smith, NNE at 5 km/h, 50% & 73\u00b0F"),
+                         "Doctor Smith, North North East at 5 kilometers per hour, 50 percent and 73 degrees Fahrenheit")
+        self.assertEqual(normalize("Call +1 415.555.0100 now"), "Call 4 1 5, 5 5 5, 0 1 0 0 now")
+        self.assertEqual(normalize("Account 123456789, room 101"), "Account 1 2 3 4, 5 6 7 8, 9, room 101")
+        self.assertEqual(normalize("Pi is 3.14159265 or 31415926.5"), "Pi is 3.14159265 or 31415926.5")
+        self.assertEqual(normalize("Your account is 1234567."), "Your account is 1 2 3 4, 5 6 7.")
+        self.assertEqual(normalize("SNOW in New York"), "SNOW in New York")
+        self.assertEqual(normalize("Winds from the SW, heading E, N 45"),
+                         "Winds from the South West, heading East, North 45")
+        for text in ("U.S. Army", "Vitamin E", "ft. Worth", "St. Mary's", "Plan B or W", "mi casa", "N.E. region"):
+            self.assertEqual(normalize(text), text)
+        normalize("Wind: NW at 10 mph")
+        self.assertEqual(normalize.cache.stats()["hits"], 0)
+        normalize("Wind: NW at 10 mph")
+        self.assertEqual(normalize.cache.stats()["hits"], 1)
+        custom = TextNormalizer([("ACME", "Acme Corporation")], digit_group_min=None)
+        self.assertEqual(custom("ACME, account 123456789"), "Acme Corporation, account 123456789")
+
+    def test_ssml(self):
+        """
+        Test building SSML say values.
+        """
+        inner = SSML("slow <down>").emphasis("now", level="strong")
+        prompt = SSML().text("Balance & fees:").say_as(1234, "digits").pause(300) \
+                       .audio("http://example.com/a.wav?x=1&y=2", "Thank you.").prosody(inner, rate="slow")
+        wanted = ('<speak>Balance &amp; fees: <say-as interpret-as="digits">1234</say-as> <break time="300ms"/> '
+                  '<audio src="http://example.com/a.wav?x=1&amp;y=2">Thank you.</audio> '
+                  '<prosody rate="slow">slow &lt;down&gt; <emphasis level="strong">now</emphasis></prosody></speak>')
+        self.assertEqual(prompt.render(), wanted)
+        self.assertTrue(prompt.render() is str(prompt))
+        tropo = Tropo()
+        tropo.say([prompt, "Goodbye"], normalize=True)
+        rendered_obj = jsonlib.loads(tropo.RenderJson())
+        self.assertEqual(rendered_obj, {"tropo": [{"say": [{"value": wanted}, {"value": "Goodbye"}]}]})
+
+        balance = SSML("Your balance is").say_as(SSMLSlot("amount"), "currency").pause(strength="weak").compile()
+        self.assertEqual(balance.slot_names, ["amount"])
+        self.assertEqual(balance.render(amount="<$5>"),
+                         '<speak>Your balance is <say-as interpret-as="currency">&lt;$5&gt;</say-as> <break strength="weak"/></speak>')
+        self.assertRaises(KeyError, balance.render)
+        # per-call values don't go into the fragment caches
+        SSML("Your account number is").say_as(0, "digits").render()
+        caches = (ciscotropowebapi._ssml_texts, ciscotropowebapi._ssml_say_as)
+        cached = repr(caches)
+        for i in range(100):
+            balance.render(amount="$%d.00" % i)
+            SSML("Your account number is").say_as(10000000 + i, "digits").render()
+        self.assertEqual(repr(caches), cached)
+        self.assertRaises(ValueError, SSML().say_as(SSMLSlot("amount"), "currency").render)
+
+    def test_normalize_numbers(self):
+        """
+        Test the normalize option of the call, message, redirect and transfer Tropo class methods.
+        """
+        tropo = Tropo()
+        tropo.call(self.MY_PHONE, normalize=True, **{'from': "(800) 555-1212"})
+        tropo.message("Hello", [self.MY_PHONE, "tel:+1-602-123-4567"], normalize=True, network='SMS')
+        tropo.redirect("sip:6021234567@sbc.example.com", normalize=True)
+        tropo.transfer(self.TO, normalize=PhoneNumberNormalizer())
+        rendered_obj = jsonlib.loads(tropo.RenderJson())
+        wanted_json = '{"tropo": [{"call": {"to": "+16021234567", "from": "+18005551212"}}, {"message": {"say": {"value": "Hello"}, "to": ["+16021234567", "+16021234567"], "network": "SMS"}}, {"redirect": {"to": "sip:+16021234567@sbc.example.com"}}, {"transfer": {"to": "+18005551212"}}]}'
+        self.assertEqual(rendered_obj, jsonlib.loads(wanted_json))
+        self.assertRaises(ValueError, Tropo().call, "555-1212", normalize=True)
+
+        # short codes and addresses go through as they are
+        tropo = Tropo()
+        tropo.message("Hello", ["12345", "alice@example.com", "sip:alice@example.com"], normalize=True, network='SMS')
+        tropo.call("+44 (0) 20 7946 0018", normalize=True, **{'from': "+1 800 FLOWERS"})
+        rendered_obj = jsonlib.loads(tropo.RenderJson())
+        self.assertEqual(rendered_obj["tropo"][0]["message"]["to"], ["12345", "alice@example.com", "sip:alice@example.com"])
+        self.assertEqual(rendered_obj["tropo"][1]["call"], {"to": "+442079460018", "from": "+1 800 FLOWERS"})
+
     def test_startRecording(self):
         """
         Test the "startRecording" Tropo class method.
@@ -295,6 +401,819 @@ class TestTropoPython(unittest.TestCase):
         wanted_obj = jsonlib.loads(wanted_json)
         self.assertEqual(rendered_obj, wanted_obj)
 
+    def test_session(self):
+        """
+        Test parsing a Session payload into typed attributes.
+        """
+        session = Session('{"session": {"id": "abc", "accountId": "33932", "userType": "HUMAN", '
+                          '"from": {"id": "6021234567", "name": "unknown", "channel": "VOICE", "network": "SIP"}, '
+                          '"to": {"id": "8005551212"}, "headers": {"Call-ID": "xyz"}, "lambda": 1, "def": 2}}')
+        self.assertEqual(session.id, "abc")
+        self.assertEqual(session.userType, "HUMAN")
+        self.assertEqual(session.from_, Endpoint("6021234567", "unknown", "VOICE", "SIP"))
+        self.assertEqual(session.from_['channel'], "VOICE")
+        self.assertEqual(session.to.id, "8005551212")
+        self.assertEqual(session.to.get('network'), None)
+        self.assertEqual(session.initialText, None)
+        self.assertEqual(session.headers["Call-ID"], "xyz")
+        self.assertTrue(session.headers is session.headers)
+        self.assertEqual((session.lambda_, session.def_), (1, 2))
+        self.assertFalse(hasattr(session, "applicationId"))
+        self.assertFalse(hasattr(session, "__dict__"))
+        self.assertTrue(set(keyword.kwlist) <= ciscotropowebapi._KEYWORDS)
+
+    def test_session_headers(self):
+        """
+        Test the case-insensitive SIP header index and its typed accessors.
+        """
+        headers = {"Call-ID": "xyz", "x-sbc-Trunk": "carrier-a", "X-SBC-region": "us-west",
+                   "Diversion": '"Front Desk" <sip:+14155550100@sbc.example.com>;reason=unconditional;counter=1, '
+                                '<tel:+14155550199>;reason=no-answer',
+                   "P-Asserted-Identity": ['<sip:+16021234567@carrier.example.com;user=phone>', '<tel:+16021234567>'],
+                   "p-asserted-identity": '"Caller, Jr" <sip:alt@example.com>'}
+        session = Session({"session": {"id": "abc", "headers": headers}})
+        self.assertEqual(session.headers["CALL-ID"], "xyz")
+        self.assertEqual(session.headers.call_id, "xyz")
+        self.assertEqual(session.headers.get("User-Agent", "none"), "none")
+        self.assertTrue("diversion" in session.headers)
+        self.assertEqual(len(session.headers.get_all("p-asserted-identity")), 3)
+        self.assertEqual(session.headers.sbc, {"trunk": "carrier-a", "region": "us-west"})
+        diversion = session.headers.diversion
+        self.assertEqual([d.uri for d in diversion], ["sip:+14155550100@sbc.example.com", "tel:+14155550199"])
+        self.assertEqual(diversion[0].display_name, "Front Desk")
+        self.assertEqual(diversion[0].params, {"reason": "unconditional", "counter": "1"})
+        self.assertEqual(diversion[1].user, "+14155550199")
+        self.assertTrue(session.headers.diversion is diversion)
+        identities = session.headers.addresses("P-Asserted-Identity")
+        self.assertEqual(sorted(a.user for a in identities), ["+16021234567", "+16021234567", "alt"])
+        self.assertEqual([a.display_name for a in identities if a.user == "alt"], ["Caller, Jr"])
+        self.assertEqual(identities[0].params, {})
+        self.assertTrue(session.headers.asserted_identity is identities[0])
+        self.assertEqual(sorted(session.headers.keys()), sorted(headers.keys()))
+        self.assertEqual(dict(zip(session.headers.keys(), session.headers.values())), headers)
+
+        empty = Session({"session": {"id": "abc", "headers": {"Call-ID": "xyz", "X-Empty": []}}}).headers
+        self.assertFalse("x-empty" in empty)
+        self.assertRaises(KeyError, lambda: empty["X-Empty"])
+        self.assertEqual(empty.get("X-Empty", "none"), "none")
+        self.assertEqual(empty.get_all("X-Empty"), [])
+        self.assertEqual((len(empty), empty.keys()), (1, ["Call-ID"]))
+
+        session = Session({"session": {"id": "abc", "headers": headers}}, parse_headers=False)
+        self.assertEqual(session.headers, None)
+
+    def test_cold_import(self):
+        """
+        Test that importing the module doesn't import what it only needs later.
+        """
+        code = ("import sys; import ciscotropowebapi; print(sorted(m for m in "
+                "('json', 'simplejson', 'django', 'logging', 'threading', 'pickle', 'queue', 'Queue', 'array') "
+                "if m in sys.modules))")
+        root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+        process = subprocess.Popen([sys.executable, '-c', code], cwd=root, stdout=subprocess.PIPE)
+        self.assertEqual(process.communicate()[0].decode('utf-8').strip(), "[]")
+
+    def test_fork(self):
+        """
+        Test that a forked document renders its shared steps followed by
+        its own, and that the parent and forks don't affect each other.
+        """
+        preamble = Tropo()
+        preamble.say("Welcome to Acme.")
+        preamble.startRecording(self.RECORDING_URL)
+        preamble.on(event="error", next="/error.json")
+
+        first = preamble.fork()
+        first.transfer(self.MY_PHONE)
+        second = preamble.fork()
+        second.hangup()
+        preamble.reject()
+        nested = first.fork()
+        nested.say("Goodbye")
+
+        wanted = [{"say": {"value": "Welcome to Acme."}},
+                  {"startRecording": {"url": self.RECORDING_URL}},
+                  {"on": {"event": "error", "next": "/error.json"}}]
+        self.assertEqual(jsonlib.loads(first.RenderJson()),
+                         {"tropo": wanted + [{"transfer": {"to": self.MY_PHONE}}]})
+        self.assertEqual(jsonlib.loads(first.RenderJson(pretty=True)), jsonlib.loads(first.RenderJson()))
+        self.assertEqual(jsonlib.loads(second.RenderJson()), {"tropo": wanted + [{"hangup": {}}]})
+        self.assertEqual(jsonlib.loads(preamble.RenderJson()), {"tropo": wanted + [{"reject": {}}]})
+        self.assertEqual(jsonlib.loads(nested.RenderJson()),
+                         {"tropo": wanted + [{"transfer": {"to": self.MY_PHONE}}, {"say": {"value": "Goodbye"}}]})
+        self.assertEqual(jsonlib.loads(Tropo().fork().RenderJson()), {"tropo": []})
+
+        self.assertTrue(first._prefix is second._prefix)
+        self.assertFalse(preamble.fork()._prefix is first._prefix)
+
+    def test_compact(self):
+        """
+        Test compact rendering: adjacent says merged, None options dropped,
+        no spaces, and the same result with or without a forked prefix.
+        """
+        tropo = Tropo()
+        tropo.say("Welcome to Acme.")
+        tropo.say(["Calls may be recorded.", "Please hold."], name=None)
+        tropo.on(event="error", next="/error.json")
+        tropo.say("Goodbye")
+        rendered = tropo.RenderJson(compact=True)
+        print ("===============test_compact=================")
+        print ("render json: %s" % rendered)
+        self.assertFalse(", " in rendered or ": " in rendered)
+        wanted_json = '{"tropo": [{"say": [{"value": "Welcome to Acme."}, {"value": "Calls may be recorded."}, {"value": "Please hold."}]}, {"on": {"event": "error", "next": "/error.json"}}, {"say": {"value": "Goodbye"}}]}'
+        self.assertEqual(jsonlib.loads(rendered), jsonlib.loads(wanted_json))
+        self.assertEqual(len(jsonlib.loads(tropo.RenderJson())['tropo']), 4)
+
+        forked = tropo.fork()
+        forked.say("Really, goodbye")
+        forked.hangup()
+        wanted_obj = jsonlib.loads(wanted_json)
+        wanted_obj['tropo'][-1]['say'] = [{"value": "Goodbye"}, {"value": "Really, goodbye"}]
+        wanted_obj['tropo'].append({"hangup": {}})
+        self.assertEqual(jsonlib.loads(forked.RenderJson(compact=True)), wanted_obj)
+        other = tropo.fork()
+        other.hangup()
+        self.assertEqual(jsonlib.loads(other.RenderJson(compact=True))['tropo'][-1], {"hangup": {}})
+
+    def test_render_response(self):
+        """
+        Test that big documents are gzipped only when the client accepts it.
+        """
+        tropo = Tropo()
+        tropo.say(["Prompt number %d" % i for i in range(100)])
+        body, headers = tropo.RenderResponse()
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertEqual(jsonlib.loads(body.decode('utf-8')), jsonlib.loads(tropo.RenderJson()))
+
+        body, headers = tropo.RenderResponse(accept_encoding="gzip, deflate")
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(headers['Content-Length'], str(len(body)))
+        unzipped = gzip.GzipFile(fileobj=io.BytesIO(body)).read()
+        self.assertEqual(unzipped.decode('utf-8'), tropo.RenderJson(compact=True))
+
+        small = Tropo()
+        small.hangup()
+        body, headers = small.RenderResponse(accept_encoding="gzip")
+        self.assertFalse('Content-Encoding' in headers)
+        self.assertTrue(accepts_gzip("deflate, gzip;q=0.5"))
+        self.assertFalse(accepts_gzip("gzip;q=0, deflate"))
+        self.assertFalse(accepts_gzip(None))
+
+
+class TestResultBatch(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for ResultBatch.
+    """
+    RESULTS = [
+        '{"result": {"sessionId": "s1", "sequence": 1, "actions": {"name": "zip", "attempts": 1, "disposition": "SUCCESS", "confidence": 90, "interpretation": "94107", "utterance": "9 4 1 0 7"}}}',
+        '',
+        '{"result": {"sessionId": "s2", "sequence": 1, "actions": [{"name": "zip", "attempts": 3, "disposition": "NOMATCH", "confidence": 20}, {"name": "message", "disposition": "SUCCESS", "duration": 12.5}]}}',
+        {"result": {"sessionId": "s3", "sequence": 2, "actions": [{"name": "zip", "attempts": 2, "disposition": "SUCCESS", "confidence": 70, "interpretation": "10001"}]}},
+        '{"result": {"sessionId": "s4", "sequence": 1, "error": "hung up"}}',
+    ]
+
+    def check_batch(self, batch):
+        self.assertEqual((len(batch), batch.results), (4, 4))
+        self.assertEqual(batch.name, ["zip", "zip", "message", "zip"])
+        self.assertEqual(batch.interpretation, ["94107", None, None, "10001"])
+        self.assertEqual(list(batch.column("attempts")), [1, 3, 0, 2])
+        self.assertEqual(list(batch.column("duration"))[2], 12.5)
+        self.assertEqual(batch.disposition_counts(), {"SUCCESS": 3, "NOMATCH": 1})
+        self.assertEqual(batch.disposition_counts(name="zip"), {"SUCCESS": 2, "NOMATCH": 1})
+        stats = batch.confidence_stats(name="zip")
+        self.assertEqual((stats["count"], stats["mean"], stats["min"], stats["median"]), (3, 60.0, 20.0, 70.0))
+        stats = batch.confidence_stats(name="zip", disposition="SUCCESS")
+        self.assertEqual((stats["count"], stats["min"], stats["median"]), (2, 70.0, 80.0))
+        self.assertEqual(batch.duration_stats()["count"], 1)
+        self.assertEqual(batch.confidence_stats(name="record")["count"], 0)
+        self.assertEqual(batch.select(name="zip").session_id, ["s1", "s2", "s3"])
+        self.assertRaises(KeyError, batch.column, "xml")
+
+    def test_load(self):
+        """
+        Test loading results into columns with array.array.
+        """
+        batch = ResultBatch.load(self.RESULTS, use_numpy=False)
+        self.check_batch(batch)
+        self.assertEqual(batch.column("confidence").typecode, "d")
+
+    def test_load_ndjson(self):
+        """
+        Test loading results from an NDJSON file, with NumPy if it is installed.
+        """
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "results.ndjson")
+            with open(path, "w") as f:
+                for result in self.RESULTS:
+                    if isinstance(result, dict):
+                        result = jsonlib.dumps(result)
+                    f.write(result + "\n")
+            self.check_batch(ResultBatch.load_ndjson(path))
+        finally:
+            shutil.rmtree(directory)
+
+
+class TestBulkMessageGenerator(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for BulkMessageGenerator.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def recipients(self, count):
+        for i in range(count):
+            yield {"to": "+1415555%04d" % i, "name": "Customer %d" % i}
+
+    def read_lines(self, name):
+        with open(os.path.join(self.directory, name)) as f:
+            return [jsonlib.loads(line) for line in f]
+
+    def test_generate(self):
+        """
+        Test that worker processes write the same documents, in order, as one process.
+        """
+        for workers in (1, 2):
+            generator = BulkMessageGenerator("Hi %(name)s", workers=workers, chunk_size=7,
+                                             channel='TEXT', network='SMS')
+            path = os.path.join(self.directory, "workers-%d.ndjson" % workers)
+            self.assertEqual(generator.generate(self.recipients(50), path), 50)
+        documents = self.read_lines("workers-1.ndjson")
+        self.assertEqual(documents, self.read_lines("workers-2.ndjson"))
+        tropo = Tropo()
+        tropo.message("Hi Customer 49", "+14155550049", channel='TEXT', network='SMS')
+        self.assertEqual(documents[-1], jsonlib.loads(tropo.RenderJson()))
+
+    def test_session_payloads(self):
+        """
+        Test rendering Session API launch payloads.
+        """
+        generator = BulkMessageGenerator("Your code is ready", mode='session', token='abc', workers=1)
+        self.assertEqual(jsonlib.loads(generator.render("6021234567")),
+                         {"token": "abc", "numberToDial": "6021234567", "message": "Your code is ready"})
+        self.assertRaises(ValueError, BulkMessageGenerator, "Hi", mode='session')
+        self.assertRaises(ValueError, BulkMessageGenerator, "Hi", mode='fax')
+
+
+class TestBroadcastPlanner(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for BroadcastPlanner.
+    """
+    NUMBERS = ["(415) 555-0100", "+1 415 555 0101", "14155550100", "415.555.0102", "not a number",
+               "4155550101", "+44 20 7946 0018", "", "415-555-0103"]
+
+    def test_bloom_filter(self):
+        """
+        Test BloomFilter membership.
+        """
+        bloom = BloomFilter(capacity=1000, error_rate=0.001)
+        numbers = ["+1415555%04d" % i for i in range(1000)]
+        self.assertEqual([bloom.add(n) for n in numbers].count(True), 0)
+        self.assertTrue(all(n in bloom for n in numbers))
+        self.assertEqual(len(bloom), 1000)
+        # hashing is stable, so the false positives are the same every run
+        false_positives = sum(1 for i in range(10000) if "+1602555%04d" % i in bloom)
+        self.assertEqual(false_positives, 6)
+
+    def test_batches(self):
+        """
+        Test normalizing, deduplicating and batching recipients.
+        """
+        for exact in (False, True):
+            planner = BroadcastPlanner(batch_size=2, exact=exact)
+            batches = list(planner.batches(iter(self.NUMBERS)))
+            self.assertEqual(batches, [["+14155550100", "+14155550101"], ["+14155550102", "+442079460018"],
+                                       ["+14155550103"]])
+            self.assertEqual(planner.report.as_dict(), {"total": 9, "accepted": 5, "duplicates": 2,
+                                                        "invalid": 2, "batches": 3})
+        self.assertRaises(ValueError, BroadcastPlanner, batch_size=0)
+
+    def test_documents(self):
+        """
+        Test rendering a message document per batch.
+        """
+        planner = BroadcastPlanner(batch_size=3)
+        documents = [jsonlib.loads(json) for json in
+                     planner.documents(self.NUMBERS, "Polls close at 8pm.", channel='TEXT', network='SMS')]
+        tropo = Tropo()
+        tropo.message("Polls close at 8pm.", ["+14155550100", "+14155550101", "+14155550102"],
+                      channel='TEXT', network='SMS')
+        self.assertEqual(documents[0], jsonlib.loads(tropo.RenderJson()))
+        self.assertEqual(documents[1]["tropo"][0]["message"]["to"], ["+442079460018", "+14155550103"])
+
+
+class TestPhoneNumberNormalizer(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for PhoneNumberNormalizer.
+    """
+
+    def test_normalize(self):
+        """
+        Test putting numbers and URIs in E.164 form.
+        """
+        normalize = PhoneNumberNormalizer()
+        self.assertEqual(normalize("(415) 555-0100"), "+14155550100")
+        self.assertEqual(normalize("1-415-555-0100"), "+14155550100")
+        self.assertEqual(normalize("011 44 20 7946 0018"), "+442079460018")
+        self.assertEqual(normalize("tel:+44-20-7946-0018;ext=5"), "+442079460018")
+        self.assertEqual(normalize("sip:4155550100@sbc.example.com;user=phone"),
+                         "sip:+14155550100@sbc.example.com;user=phone")
+        self.assertEqual(normalize("sip:alice@example.com"), "sip:alice@example.com")
+        self.assertEqual(PhoneNumberNormalizer("44")("020 7946 0018"), "+442079460018")
+        self.assertEqual(PhoneNumberNormalizer("44")("00 1 415 555 0100"), "+14155550100")
+        self.assertEqual(normalize("+44 (0) 20 7946 0018"), "+442079460018")
+        self.assertEqual(PhoneNumberNormalizer("44")("(0)20 7946 0018"), "+442079460018")
+        for number in ("555-1212", "+1 015 555 0100", "call me", "+0 123 456 789", "+1234567890123456",
+                       "442079460018", "44 20 7946 0018", "914155550100"):
+            self.assertRaises(ValueError, normalize, number)
+            self.assertFalse(normalize.is_valid(number))
+        self.assertRaises(ValueError, PhoneNumberNormalizer, "0")
+        for value in ("12345", "sip:alice@example.com", "alice@example.com", "+1 800 FLOWERS"):
+            self.assertEqual(normalize.normalize_or_keep(value), value)
+        self.assertEqual(normalize.normalize_or_keep("(415) 555-0100"), "+14155550100")
+        self.assertRaises(ValueError, normalize.normalize_or_keep, "555-1212")
+
+    def test_cache(self):
+        """
+        Test that repeat numbers, valid or not, are answered from the cache.
+        """
+        normalize = PhoneNumberNormalizer(cache_size=2)
+        normalize("6021234567")
+        self.assertRaises(ValueError, normalize, "555-1212")
+        self.assertEqual(normalize("6021234567"), "+16021234567")
+        self.assertRaises(ValueError, normalize, "555-1212")
+        self.assertEqual(normalize.normalize_or_none("555-1212"), None)
+        stats = normalize.cache.stats()
+        self.assertEqual((stats["hits"], stats["size"]), (3, 2))
+
+
+class TestCallFlow(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for CallFlow.
+    """
+    SALES = "+14155550100"
+
+    def build_flow(self):
+        flow = CallFlow("/ivr", start="menu")
+        flow.state("menu", say="Welcome to Acme.",
+                   ask="For sales press 1, for support press 2.",
+                   choices={"1": "sales", "2": "support"},
+                   on_incomplete="goodbye", attempts=3)
+        flow.state("sales", say="Connecting you to sales.", transfer=self.SALES)
+        flow.state("support", say="Please hold.", next="goodbye", on_error="goodbye")
+        flow.state("goodbye", say="Goodbye.", hangup=True)
+        return flow
+
+    def result(self, interpretation):
+        return jsonlib.dumps({"result": {"sessionId": "abc", "sequence": 2, "complete": True,
+                                         "actions": [{"name": "menu", "interpretation": interpretation}]}})
+
+    def test_start(self):
+        """
+        Test that a new session gets the start state's document.
+        """
+        ivr = self.build_flow().compile()
+        rendered_obj = jsonlib.loads(ivr.respond("/ivr", '{"session": {}}'))
+        wanted_json = '{"tropo": [{"say": {"value": "Welcome to Acme."}}, {"ask": {"choices": {"value": "1, 2"}, "attempts": 3, "say": {"value": "For sales press 1, for support press 2."}}}, {"on": {"event": "continue", "next": "/ivr/menu/answer"}}, {"on": {"event": "incomplete", "next": "/ivr/goodbye"}}]}'
+        self.assertEqual(rendered_obj, jsonlib.loads(wanted_json))
+        self.assertTrue(ivr.respond("/ivr/") is ivr.respond("/ivr/menu"))
+
+    def test_transitions(self):
+        """
+        Test that answers lead to the right states and bad answers reprompt.
+        """
+        ivr = self.build_flow().compile()
+        rendered_obj = jsonlib.loads(ivr.respond("/ivr/menu/answer", self.result("1")))
+        self.assertEqual(rendered_obj["tropo"][-1], {"transfer": {"to": self.SALES}})
+        rendered_obj = jsonlib.loads(ivr.respond("/ivr/menu/answer", self.result("2")))
+        self.assertEqual(rendered_obj["tropo"], [{"on": {"event": "error", "next": "/ivr/goodbye"}},
+                                                 {"say": {"value": "Please hold."}},
+                                                 {"on": {"event": "continue", "next": "/ivr/goodbye"}}])
+        self.assertEqual(ivr.respond("/ivr/menu/answer", self.result("7")), ivr.respond("/ivr/menu"))
+        self.assertEqual(ivr.respond("/ivr/nowhere"), None)
+
+    def test_invalid_flows(self):
+        """
+        Test that mistakes in a flow are caught when it is compiled.
+        """
+        flow = self.build_flow()
+        flow.state("broken", say="Oops", next="missing")
+        self.assertRaises(ValueError, flow.compile)
+        self.assertRaises(ValueError, flow.state, "menu", say="again")
+        self.assertRaises(ValueError, flow.state, "other", ask="Yes?", next="goodbye")
+        self.assertRaises(ValueError, CallFlow("/ivr", start="nowhere").compile)
+
+    def test_wsgi(self):
+        """
+        Test serving the flow as a WSGI application.
+        """
+        from wsgiref.util import setup_testing_defaults
+        ivr = self.build_flow().compile()
+        body = self.result("1").encode('utf-8')
+        environ = {'PATH_INFO': '/ivr/menu/answer', 'REQUEST_METHOD': 'POST',
+                   'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)}
+        setup_testing_defaults(environ)
+        statuses = []
+        chunks = ivr(environ, lambda status, headers: statuses.append(status))
+        self.assertEqual(statuses, ['200 OK'])
+        self.assertEqual(jsonlib.loads(b"".join(chunks).decode('utf-8'))["tropo"][-1], {"transfer": {"to": self.SALES}})
+
+
+class TestWebhookDeduplicator(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for LRUCache and WebhookDeduplicator.
+    """
+    RESULT = '{"result": {"sessionId": "abc", "sequence": 2, "actions": {"name": "zip", "interpretation": "94107"}}}'
+
+    def handle(self, body):
+        self.calls.append(body)
+        return '{"tropo":[{"hangup":null}]}'
+
+    def setUp(self):
+        self.calls = []
+
+    def test_lru_cache(self):
+        """
+        Test LRU eviction and expiry.
+        """
+        now = [1000.0]
+        cache = LRUCache(max_size=2, ttl=10, clock=lambda: now[0])
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.put("c", 3)
+        self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+        now[0] += 10
+        self.assertEqual(cache.get("a", "gone"), "gone")
+        self.assertEqual(cache.get_stale("a"), 1)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_webhook_key(self):
+        """
+        Test identifying webhook deliveries.
+        """
+        self.assertEqual(webhook_key(self.RESULT), ("result", "abc", 2))
+        self.assertEqual(webhook_key('{"session": {"id": "abc"}}'), ("session", "abc"))
+        self.assertEqual(webhook_key('{"other": 1}'), None)
+        self.assertEqual(webhook_key('filename=hello.wav'), None)
+
+    def test_respond(self):
+        """
+        Test that a retried webhook gets the cached response.
+        """
+        dedup = WebhookDeduplicator()
+        first = dedup.respond(self.RESULT, self.handle)
+        self.assertEqual(dedup.respond(self.RESULT, self.handle), first)
+        dedup.respond(self.RESULT.replace('"sequence": 2', '"sequence": 3'), self.handle)
+        dedup.respond('not json', self.handle)
+        self.assertEqual(len(self.calls), 3)
+        stats = dedup.stats()
+        self.assertEqual((stats["handled"], stats["replayed"], stats["in_flight"]), (2, 1, 0))
+
+    def test_concurrent_retry(self):
+        """
+        Test that a retry arriving during the first run waits for its response.
+        """
+        dedup = WebhookDeduplicator()
+        started = threading.Event()
+        release = threading.Event()
+        def slow(body):
+            started.set()
+            release.wait(5)
+            return self.handle(body)
+        responses = []
+        first = threading.Thread(target=lambda: responses.append(dedup.respond(self.RESULT, slow)))
+        first.start()
+        started.wait(5)
+        retry = threading.Thread(target=lambda: responses.append(dedup.respond(self.RESULT, slow)))
+        retry.start()
+        release.set()
+        first.join(5)
+        retry.join(5)
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(len(responses), 2)
+        self.assertEqual(responses[0], responses[1])
+
+    def test_middleware(self):
+        """
+        Test deduplicating webhooks in front of a WSGI application.
+        """
+        statuses = ["200 OK"]
+        def app(environ, start_response):
+            body = environ['wsgi.input'].read().decode('utf-8')
+            start_response(statuses[0], [('Content-Type', 'application/json')])
+            return [self.handle(body).encode('utf-8')]
+        wrapped = WebhookDeduplicator().middleware(app)
+        def post(body, content_type="application/json", chunked=False):
+            body = body.encode('utf-8')
+            environ = {'CONTENT_TYPE': content_type, 'wsgi.input': io.BytesIO(body)}
+            if not chunked:
+                environ['CONTENT_LENGTH'] = str(len(body))
+            started = []
+            data = b"".join(wrapped(environ, lambda status, headers: started.append(status)))
+            return started[0], data
+        statuses[0] = "500 Internal Server Error"
+        self.assertEqual(post(self.RESULT)[0], "500 Internal Server Error")
+        statuses[0] = "200 OK"
+        self.assertEqual(post(self.RESULT), ("200 OK", b'{"tropo":[{"hangup":null}]}'))
+        self.assertEqual(post(self.RESULT), ("200 OK", b'{"tropo":[{"hangup":null}]}'))
+        post("filename=hello.wav", content_type="application/x-www-form-urlencoded")
+        self.assertEqual(self.calls[2:], ["filename=hello.wav"])
+        for i in range(2):
+            post(self.RESULT, chunked=True)
+        self.assertEqual(self.calls[3:], [self.RESULT, self.RESULT])
+
+
+class TestAdmissionController(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for AdmissionController.
+    """
+
+    def post(self, app, body, **environ):
+        body = body.encode('utf-8')
+        environ.update({'CONTENT_LENGTH': str(len(body)), 'wsgi.input': io.BytesIO(body)})
+        started = []
+        data = b"".join(app(environ, lambda status, headers: started.append(status)))
+        return jsonlib.loads(data.decode('utf-8'))
+
+    def test_shedding(self):
+        """
+        Test that webhooks over the in-flight limit get the fallback documents.
+        """
+        reject = Tropo()
+        reject.reject()
+        controller = AdmissionController(max_in_flight=1, new_session_fallback=reject)
+        inner = []
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            if not inner:
+                inner.append(self.post(wrapped, '{"session": {"id": "abc"}}'))
+                inner.append(self.post(wrapped, '{"result": {"sessionId": "abc"}}'))
+            return [b'{"tropo":[{"say":[{"value":"Welcome"}]}]}']
+        wrapped = controller.middleware(app)
+        self.assertEqual(self.post(wrapped, '{"session": {"id": "xyz"}}'), {"tropo": [{"say": [{"value": "Welcome"}]}]})
+        self.assertEqual(inner[0], {"tropo": [{"reject": {}}]})
+        self.assertEqual(inner[1], {"tropo": [{"say": {"value": "We're sorry, all of our lines are busy. Please call back later."}},
+                                              {"hangup": {}}]})
+        stats = controller.stats()
+        self.assertEqual((stats["in_flight"], stats["peak_in_flight"], stats["admitted"], stats["shed"]), (0, 1, 1, 2))
+
+    def test_queue_delay(self):
+        """
+        Test shedding requests that waited too long before reaching the application.
+        """
+        self.assertEqual(request_start_time({'HTTP_X_REQUEST_START': 't=1262304000123'}), 1262304000.123)
+        self.assertEqual(request_start_time({'HTTP_X_REQUEST_START': '1262304000.5'}), 1262304000.5)
+        self.assertEqual(request_start_time({}), None)
+        controller = AdmissionController(max_queue_delay=2.0, fallback='{"tropo":[{"hangup":null}]}',
+                                         clock=lambda: 1262304003.0)
+        def app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'application/json')])
+            return [b'{"tropo":[]}']
+        wrapped = controller.middleware(app)
+        self.assertEqual(self.post(wrapped, '{}', HTTP_X_REQUEST_START='t=1262304002000'), {"tropo": []})
+        self.assertEqual(self.post(wrapped, '{}', HTTP_X_REQUEST_START='t=1262304000000'), {"tropo": [{"hangup": None}]})
+        self.assertEqual(controller.stats()["longest_queue_delay"], 3.0)
+
+
+class TestCachedLookup(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for CachedLookup.
+    """
+
+    def setUp(self):
+        self.now = 1000.0
+        self.fetched = []
+        self.failing = False
+
+    def fetch(self, zip):
+        self.fetched.append(zip)
+        if self.failing:
+            raise IOError("weather service is down")
+        return "Sunny in %s" % zip
+
+    def test_cache_and_breaker(self):
+        """
+        Test caching, stale values and fallbacks while the upstream fails.
+        """
+        weather = CachedLookup(self.fetch, ttl=60, failure_threshold=2, reset_timeout=30,
+                               clock=lambda: self.now)
+        self.assertEqual(weather.get("94107"), "Sunny in 94107")
+        self.assertEqual(weather.get("94107"), "Sunny in 94107")
+        self.assertEqual(self.fetched, ["94107"])
+
+        self.now += 61
+        self.failing = True
+        self.assertEqual(weather.get("94107"), "Sunny in 94107")
+        self.assertRaises(IOError, weather.get, "10001")
+        self.assertEqual(weather.stats()["breaker"], "open")
+        self.assertRaises(CircuitOpenError, weather.get, "10001")
+        self.assertEqual(len(self.fetched), 3)
+
+        weather.fallback = lambda zip: "No weather for %s" % zip
+        self.assertEqual(weather.get("10001"), "No weather for 10001")
+        self.now += 30
+        self.failing = False
+        self.assertEqual(weather.get("10001"), "Sunny in 10001")
+        stats = weather.stats()
+        self.assertEqual((stats["breaker"], stats["breaker_trips"], stats["failures"]), ("closed", 1, 2))
+        self.assertEqual((stats["stale_served"], stats["fallbacks_served"]), (1, 1))
+
+    def test_coalescing(self):
+        """
+        Test that concurrent misses share one fetch, and that slow fetches time out.
+        """
+        release = threading.Event()
+        def slow_fetch(zip):
+            release.wait(5)
+            return self.fetch(zip)
+        weather = CachedLookup(slow_fetch, timeout=0.05, fallback="Weather is not available.")
+        self.assertEqual(weather.get("94107"), "Weather is not available.")
+        weather.timeout = 5
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(weather.get("94107"))) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, ["Sunny in 94107"] * 4)
+        self.assertEqual(self.fetched, ["94107"])
+
+
+deferred_calls = []
+
+def record_call(value):
+    deferred_calls.append(value)
+
+
+class TestDeferredExecutor(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for DeferredExecutor.
+    """
+
+    def setUp(self):
+        del deferred_calls[:]
+        self.spool_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_defer(self):
+        """
+        Test that deferred work runs in the background and is counted.
+        """
+        executor = DeferredExecutor(max_workers=2)
+        done = threading.Event()
+        executor.defer(record_call, "first")
+        executor.defer(done.set)
+        self.assertTrue(executor.join(timeout=5))
+        self.assertTrue(done.is_set())
+        self.assertEqual(deferred_calls, ["first"])
+        stats = executor.stats()
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['queued'], 0)
+        executor.shutdown()
+        self.assertRaises(RuntimeError, executor.defer, record_call, "late")
+
+    def test_retry(self):
+        """
+        Test that failing work is retried, then given up on.
+        """
+        attempts = []
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 2:
+                raise IOError("S3 is down")
+        def broken():
+            raise IOError("S3 is down")
+        executor = DeferredExecutor(max_workers=1, max_attempts=2, retry_delay=0.01)
+        executor.defer(flaky)
+        executor.defer(broken)
+        for i in range(500):
+            stats = executor.stats()
+            if stats['completed'] + stats['failed'] == 2:
+                break
+            threading.Event().wait(0.01)
+        self.assertEqual(len(attempts), 2)
+        self.assertEqual((stats['completed'], stats['failed'], stats['retried']), (1, 1, 2))
+        executor.shutdown()
+
+    def test_spool_recover(self):
+        """
+        Test that spooled work left by one executor is run by the next.
+        """
+        executor = DeferredExecutor(spool_dir=self.spool_dir)
+        executor._start_workers = lambda: None
+        executor.defer(record_call, "recording.wav")
+        self.assertEqual(len(os.listdir(self.spool_dir)), 1)
+
+        executor = DeferredExecutor(spool_dir=self.spool_dir)
+        self.assertEqual(executor.recover(), 1)
+        self.assertTrue(executor.join(timeout=5))
+        self.assertEqual(deferred_calls, ["recording.wav"])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        executor.shutdown()
+
+    def test_recover_overflow(self):
+        """
+        Test recovering more spooled tasks than fit in the queue, without
+        queueing any task twice.
+        """
+        executor = DeferredExecutor(spool_dir=self.spool_dir)
+        executor._start_workers = lambda: None
+        for i in range(5):
+            executor.defer(record_call, "rec%d.wav" % i)
+        self.assertEqual(executor.recover(), 0)
+
+        executor = DeferredExecutor(max_queue=3, spool_dir=self.spool_dir)
+        executor._start_workers = lambda: None
+        self.assertEqual(executor.recover(), 3)
+        self.assertEqual(executor.recover(), 0)
+        del executor._start_workers
+        while len(deferred_calls) < 5:
+            executor.recover()
+            self.assertTrue(executor.join(timeout=5))
+        self.assertEqual(sorted(deferred_calls), ["rec%d.wav" % i for i in range(5)])
+        self.assertEqual(os.listdir(self.spool_dir), [])
+        executor.shutdown()
+
+
+class TestAppRegistry(unittest.TestCase):
+    """
+    Class implementing a set of unit tests for AppRegistry.
+    """
+
+    def setUp(self):
+        self.module_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.module_dir, "tenant_support.py"), "w") as f:
+            f.write("def handle(session):\n    return session.id\n")
+        sys.path.insert(0, self.module_dir)
+
+    def tearDown(self):
+        sys.path.remove(self.module_dir)
+        sys.modules.pop("tenant_support", None)
+        shutil.rmtree(self.module_dir)
+
+    def session(self, to, account_id="33932", **extra):
+        data = {"id": "abc", "accountId": account_id,
+                "to": {"id": to, "name": "unknown", "channel": "VOICE", "network": "SIP"}}
+        data.update(extra)
+        return Session(jsonlib.dumps({"session": data}))
+
+    def test_lookup(self):
+        """
+        Test matching sessions by application id, number and account.
+        """
+        registry = AppRegistry()
+        support = registry.register("support", "tenant_support:handle", numbers=["+1 (415) 555-0100"])
+        alerts = registry.register("alerts", record_call, application_id=123456, channel="sms")
+        fallback = registry.register("fallback", record_call, account_id="33932")
+        self.assertTrue(registry.lookup(self.session("14155550100")) is support)
+        self.assertTrue(registry.lookup(self.session("tel:+14155550100", applicationId="123456")) is alerts)
+        self.assertTrue(registry.lookup(self.session("9995551212")) is fallback)
+        self.assertEqual(registry.lookup(self.session("9995551212", account_id="1")), None)
+        self.assertEqual(alerts.config, {"channel": "sms"})
+        self.assertEqual(len(registry), 3)
+        self.assertRaises(ValueError, registry.register, "other", record_call, numbers=["14155550100"])
+        self.assertRaises(ValueError, registry.register, "support", record_call)
+        self.assertRaises(ValueError, registry.register, "bad", "tenant_support.handle")
+
+    def test_number_forms(self):
+        """
+        Test that a number matches however it was written at registration
+        and however Tropo sends it.
+        """
+        registry = AppRegistry()
+        support = registry.register("support", record_call, numbers=["+14155550100"])
+        sales = registry.register("sales", record_call, numbers=["6505550199", "tel:12125550123"])
+        shortcode = registry.register("shortcode", record_call, numbers=["87654"])
+        for to in ("4155550100", "14155550100", "+1 415-555-0100", "tel:+14155550100"):
+            self.assertTrue(registry.lookup(self.session(to, account_id="1")) is support)
+        for to in ("+16505550199", "2125550123"):
+            self.assertTrue(registry.lookup(self.session(to, account_id="1")) is sales)
+        self.assertTrue(registry.lookup(self.session("87654", account_id="1")) is shortcode)
+        self.assertRaises(ValueError, registry.register, "other", record_call, numbers=["(415) 555-0100"])
+
+    def test_lazy_import(self):
+        """
+        Test that handler modules are imported on first use only.
+        """
+        registry = AppRegistry()
+        registry.register("support", "tenant_support:handle", numbers=["sip:Support@example.com"])
+        self.assertFalse("tenant_support" in sys.modules)
+        self.assertEqual(registry.loaded(), [])
+        session = self.session("support@example.com")
+        app = registry.lookup(session)
+        self.assertEqual(app.handler(session), "abc")
+        self.assertTrue("tenant_support" in sys.modules)
+        self.assertTrue(app.handler is sys.modules["tenant_support"].handle)
+        self.assertEqual(registry.loaded(), ["support"])
+
 
 if __name__ == '__main__':
     """